@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+Benchmarks spatially_verify_kpts end to end on synthetic pairs.
+
+Sweeps the number of matches, the inlier ratio, the refine method and the
+affine hypothesis backend. The hypothesis strategy (--strategy) is fixed for
+a run. Each configuration reports throughput, p50 / p99
+latency and the peak memory traced by tracemalloc. Memory is measured in a
+separate untimed pass, and it includes numpy arrays but not buffers that C
+code allocates itself.
+
+CommandLine:
+    python tests/bench_spatial_verification.py
+    python tests/bench_spatial_verification.py --num-matches=50,500 --num-pairs=20
+    python tests/bench_spatial_verification.py --strategy=dedup --backends=python
+    python tests/bench_spatial_verification.py --out=bench_old.json
+    python tests/bench_spatial_verification.py --out=bench_new.json --compare=bench_old.json
+"""
+import gc
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import utool as ut
+import vtool_ibeis
+import vtool_ibeis.demodata as demodata
+import vtool_ibeis.spatial_verification as sver
+
+
+NUM_MATCHES_LIST = [50, 200, 1000, 5000]
+INLIER_RATIOS = [.2, .8]
+REFINE_METHODS = ['homog', 'affine']
+BACKENDS = ['python', 'c']
+
+
+def _git_hash():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=ut.get_module_dir(vtool_ibeis)).decode('utf8').strip()
+    except Exception:
+        return None
+
+
+def _config_key(row):
+    return (row['num_matches'], row['inlier_ratio'], row['refine_method'],
+            row['backend'])
+
+
+def benchmark_config(pairs, refine_method, backend,
+                     hypothesis_strategy='exhaustive'):
+    """
+    Times spatially_verify_kpts over a list of pairs with a fixed backend.
+
+    Returns:
+        dict: timing and memory statistics of the configuration
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> import sys, ubelt as ub
+        >>> sys.path.append(ub.Path(__file__).parent)
+        >>> from bench_spatial_verification import *  # NOQA
+        >>> pairs = [demodata.testdata_sver_pair(50, seed=seed)
+        >>>          for seed in range(3)]
+        >>> stats = benchmark_config(pairs, 'homog', 'python')
+        >>> print(sorted(stats.keys()))
+        ['num_pairs', 'num_verified', 'pairs_per_sec', 'peak_mem_bytes', 'time_p50', 'time_p99', 'time_total']
+    """
+    old_backend = sver.SVER_BACKEND
+    sver.SVER_BACKEND = backend
+    try:
+        def _verify(pair):
+            kpts1, kpts2, fm, fs = pair
+            return sver.spatially_verify_kpts(
+                kpts1, kpts2, fm, match_weights=fs,
+                refine_method=refine_method,
+                hypothesis_strategy=hypothesis_strategy)
+        # Warm up caches and lazy imports
+        _verify(pairs[0])
+        durations = []
+        num_verified = 0
+        # Like timeit, keep garbage collection out of the timings
+        gc.collect()
+        gc.disable()
+        try:
+            for pair in pairs:
+                tt = time.perf_counter()
+                svtup = _verify(pair)
+                durations.append(time.perf_counter() - tt)
+                num_verified += svtup is not None
+        finally:
+            gc.enable()
+        tracemalloc.start()
+        try:
+            for pair in pairs:
+                _verify(pair)
+            peak_mem = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    finally:
+        sver.SVER_BACKEND = old_backend
+    durations = np.array(durations)
+    stats = {
+        'num_pairs': len(pairs),
+        'num_verified': num_verified,
+        'time_total': float(durations.sum()),
+        'pairs_per_sec': float(len(pairs) / durations.sum()),
+        'time_p50': float(np.percentile(durations, 50)),
+        'time_p99': float(np.percentile(durations, 99)),
+        'peak_mem_bytes': int(peak_mem),
+    }
+    return stats
+
+
+def run_benchmarks(num_matches_list=NUM_MATCHES_LIST,
+                   inlier_ratios=INLIER_RATIOS, refine_methods=REFINE_METHODS,
+                   backends=BACKENDS, num_pairs=10, seed=0,
+                   hypothesis_strategy='exhaustive'):
+    """
+    Runs every configuration of the sweep.
+
+    Returns:
+        dict: results - machine information and a row per configuration
+    """
+    if not sver.HAVE_SVER_C_WRAPPER and 'c' in backends:
+        print('[bench] the C extension is not available, skipping it')
+        backends = [backend for backend in backends if backend != 'c']
+    rows = []
+    for num_matches in num_matches_list:
+        for inlier_ratio in inlier_ratios:
+            pairs = [demodata.testdata_sver_pair(num_matches, inlier_ratio,
+                                                 seed=seed + pairx)
+                     for pairx in range(num_pairs)]
+            for refine_method in refine_methods:
+                for backend in backends:
+                    row = {
+                        'num_matches': num_matches,
+                        'inlier_ratio': inlier_ratio,
+                        'refine_method': refine_method,
+                        'backend': backend,
+                    }
+                    row.update(benchmark_config(pairs, refine_method, backend,
+                                                hypothesis_strategy))
+                    print('[bench] {num_matches:5d} matches, inliers={inlier_ratio:.2f}, '
+                          '{refine_method:6s}, {backend:6s}: '
+                          '{pairs_per_sec:9.2f} pairs/s, '
+                          'p50={time_p50:.5f}s, p99={time_p99:.5f}s, '
+                          'peak={peak_mem_bytes:d}B'.format(**row))
+                    rows.append(row)
+    results = {
+        'git_hash': _git_hash(),
+        'vtool_ibeis_version': vtool_ibeis.__version__,
+        'numpy_version': np.__version__,
+        'python_version': platform.python_version(),
+        'machine': platform.platform(),
+        'have_c': sver.HAVE_SVER_C_WRAPPER,
+        'num_pairs': num_pairs,
+        'seed': seed,
+        'hypothesis_strategy': hypothesis_strategy,
+        'rows': rows,
+    }
+    return results
+
+
+def compare_results(old_results, new_results):
+    """
+    Prints the ratio of new to old latency of the configurations in both
+    results.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> import sys, ubelt as ub
+        >>> sys.path.append(ub.Path(__file__).parent)
+        >>> from bench_spatial_verification import *  # NOQA
+        >>> row = {'num_matches': 50, 'inlier_ratio': .5,
+        >>>        'refine_method': 'homog', 'backend': 'c',
+        >>>        'time_p50': .002, 'time_p99': .004}
+        >>> ratios = compare_results({'rows': [row]},
+        >>>                          {'rows': [dict(row, time_p50=.001)]})
+        >>> print(ratios)
+        [(50, 0.5, 'homog', 'c', 0.5, 1.0)]
+    """
+    old_rows = {_config_key(row): row for row in old_results['rows']}
+    ratios = []
+    for row in new_results['rows']:
+        key = _config_key(row)
+        if key not in old_rows:
+            continue
+        old_row = old_rows[key]
+        ratio_p50 = row['time_p50'] / old_row['time_p50']
+        ratio_p99 = row['time_p99'] / old_row['time_p99']
+        ratios.append(key + (round(ratio_p50, 4), round(ratio_p99, 4)))
+        print('[bench] %5d matches, inliers=%.2f, %-6s, %-6s: '
+              'p50 x%.3f, p99 x%.3f' % (key + (ratio_p50, ratio_p99)))
+    return ratios
+
+
+def main():
+    num_matches_list = ut.get_argval('--num-matches', type_=list,
+                                     default=NUM_MATCHES_LIST)
+    inlier_ratios = ut.get_argval('--inlier-ratios', type_=list,
+                                  default=INLIER_RATIOS)
+    refine_methods = ut.get_argval('--refine-methods', type_=list,
+                                   default=REFINE_METHODS)
+    backends = ut.get_argval('--backends', type_=list, default=BACKENDS)
+    num_pairs = ut.get_argval('--num-pairs', type_=int, default=10)
+    seed = ut.get_argval('--seed', type_=int, default=0)
+    hypothesis_strategy = ut.get_argval('--strategy', type_=str,
+                                        default='exhaustive')
+    out_fpath = ut.get_argval('--out', type_=str, default=None)
+    compare_fpath = ut.get_argval('--compare', type_=str, default=None)
+
+    results = run_benchmarks(
+        [int(num) for num in num_matches_list],
+        [float(ratio) for ratio in inlier_ratios], refine_methods, backends,
+        num_pairs=num_pairs, seed=seed,
+        hypothesis_strategy=hypothesis_strategy)
+    if out_fpath is not None:
+        with open(out_fpath, 'w') as file_:
+            json.dump(results, file_, indent=2)
+        print('[bench] wrote %s' % (out_fpath,))
+    if compare_fpath is not None:
+        with open(compare_fpath, 'r') as file_:
+            old_results = json.load(file_)
+        print('[bench] compared to %s (%s)' % (compare_fpath,
+                                              old_results.get('git_hash')))
+        compare_results(old_results, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -122,7 +122,7 @@ from vtool_ibeis.histogram import (argsubextrema2, argsubmax, argsubmax2,
                              maximum_parabola_point, show_hist_submaxima,
                              show_ori_image, show_ori_image_ondisk,
                              subbin_bounds, wrap_histogram,)
-from vtool_ibeis.features import (detect_opencv_keypoints,
+from vtool_ibeis.features import (FeatureStore, detect_opencv_keypoints,
                             extract_feature_from_patch, extract_features,
                             get_extract_features_default_params, test_mser,)
 from vtool_ibeis.linalg import (TRANSFORM_DTYPE, add_homogenous_coordinate,
@@ -253,16 +253,30 @@ from vtool_ibeis.chip import (ScaleStrat, apply_filter_funcs, compute_chip,
                         get_scaled_size_with_dlen, gridsearch_chipextract,
                         testshow_extramargin_info,)
 from vtool_ibeis.spatial_verification import (HAVE_SVER_C_WRAPPER, INDEX_DTYPE,
-                                        SV_DTYPE, VERBOSE_SVER,
+                                        KptsGeometry, SVER_BACKEND,
+                                        SVER_BACKEND_TRIALS,
+                                        SVER_BATCH_CHUNKSIZE,
+                                        SVER_DEDUP_BINFRAC,
+                                        SVER_DEDUP_PER_CELL, SVER_DEDUP_TOPK,
+                                        SVER_HYPOTHESIS_STRATEGIES,
+                                        SVER_MAX_HYPOTHESES, SVER_MEM_BUDGET,
+                                        SVER_PREEMPT_BLOCKSIZE, SV_DTYPE,
+                                        SverRecorder, VERBOSE_SVER,
                                         build_affine_lstsqrs_Mx6,
                                         build_lstsqrs_Mx9, compute_affine,
-                                        compute_homog,
+                                        check_sver_backend_parity,
+                                        choose_sver_backend, compute_homog,
                                         estimate_refined_transform,
                                         get_affine_inliers,
                                         get_best_affine_inliers,
                                         get_best_affine_inliers_,
+                                        get_best_affine_inliers_sampled,
+                                        get_best_affine_inliers_vectorized,
                                         get_normalized_affine_inliers,
                                         refine_inliers, spatially_verify_kpts,
+                                        spatially_verify_kpts_batch,
+                                        spatially_verify_kpts_nested,
+                                        sver_backend_report,
                                         test_affine_errors, test_homog_errors,
                                         testdata_matching_affine_inliers,
                                         testdata_matching_affine_inliers_normalized,
@@ -279,21 +293,29 @@ from vtool_ibeis.util_math import (TAU, beaton_tukey_loss, beaton_tukey_weight,
                              non_decreasing, non_increasing,
                              strictly_decreasing, strictly_increasing,
                              test_language_modulus,)
-from vtool_ibeis.matching import (AnnotPairFeatInfo, AssignTup, MatchingError,
-                            NORM_CHIP_CONFIG, PSEUDO_MAX_DIST,
+from vtool_ibeis.matching import (AnnotCache, AnnotPairFeatInfo, AssignTup,
+                            BATCH_WORKER_CACHE_SIZE, MatchPipeline, MatchView,
+                            MatchingError,
+                            NORM_CHIP_CONFIG,
+                            OneVsManyMatcher,
+                            PSEUDO_MAX_DIST,
                             PSEUDO_MAX_DIST_SQRD, PSEUDO_MAX_VEC_COMPONENT,
                             PairwiseMatch, SUM_OPS, VSONE_ASSIGN_CONFIG,
                             VSONE_DEFAULT_CONFIG, VSONE_FEAT_CONFIG,
                             VSONE_PI_DICT, VSONE_RATIO_CONFIG,
-                            VSONE_SVER_CONFIG, assign_symmetric_matches,
+                            VSONE_SVER_CONFIG, apply_all_batch,
+                            assign_symmetric_matches,
                             assign_unconstrained_matches,
                             asymmetric_correspondence, csum, demodata_match,
                             empty_assign, empty_neighbors,
                             ensure_metadata_dlen_sqrd, ensure_metadata_feats,
-                            ensure_metadata_flann, ensure_metadata_normxy,
+                            ensure_metadata_flann, ensure_metadata_kpts_geom,
+                            ensure_metadata_normxy,
                             ensure_metadata_vsone, flag_sym_slow,
-                            flag_symmetric_matches, invsum,
-                            normalized_nearest_neighbors,
+                            flag_symmetric_matches, invsum, load_matches,
+                            make_feature_matrix,
+                            normalized_nearest_neighbors, prefetch_matches,
+                            save_matches,
                             symmetric_correspondence, testdata_annot_metadata,)
 from vtool_ibeis.geometry import (bbox_center, bbox_from_center_wh, bbox_from_extent,
                             bbox_from_verts, bbox_from_xywh,
@@ -308,12 +330,29 @@ from vtool_ibeis.geometry import (bbox_center, bbox_from_center_wh, bbox_from_ex
                             scale_bbox, scale_extents, scaled_verts_from_bbox,
                             scaled_verts_from_bbox_gen, union_extents,
                             verts_from_bbox, verts_list_from_bboxes_list,)
-from vtool_ibeis.nearest_neighbors import (AnnoyWrapper, ann_flann_once,
-                                     assign_to_centroids, flann_augment,
+from vtool_ibeis.nearest_neighbors import (AnnoyWrapper, BruteForceIndex,
+                                     Cv2FlannIndex, FLANN_HASH_MODE,
+                                     FLANN_HASH_NUM_SAMPLES,
+                                     FLANN_INDEX_REGISTRY,
+                                     FLANN_REBUILD_FACTOR,
+                                     FLANN_REGISTRY_MAX_BYTES, KDTreeIndex,
+                                     NNIndex, NNIndexRegistry,
+                                     NN_AUTO_BACKENDS, NN_BACKENDS,
+                                     NN_BATCH_CHUNKSIZE,
+                                     NN_BRUTE_FORCE_MAX_VECS,
+                                     ann_flann_once, apply_flann_delta,
+                                     assign_to_centroids,
+                                     available_nn_backends, batch_nn_index,
+                                     choose_nn_backend,
+                                     flann_augment,
                                      flann_cache, flann_index_time_experiment,
-                                     get_flann_cfgstr, get_flann_fpath,
+                                     get_data_hashstr,
+                                     get_flann_cfgstr, get_flann_delta_fpath,
+                                     get_flann_fpath,
                                      get_flann_params, get_flann_params_cfgstr,
+                                     get_index_nbytes,
                                      get_kdtree_flann_params, invertible_stack,
+                                     make_nn_index, register_nn_backend,
                                      test_annoy, test_cv2_flann, tune_flann,)
 from vtool_ibeis.clustering2 import (AnnoyWraper, apply_grouping, apply_grouping_,
                                apply_grouping_iter, apply_grouping_iter2,
@@ -391,33 +430,44 @@ from vtool_ibeis.demodata import (DEFAULT_DTYPE, dummy_img, dummy_seed,
                             get_testdata_kpts, make_dummy_fm, perterb_kpts,
                             perterbed_grid_kpts, testdata_binary_scores,
                             testdata_dummy_matches, testdata_dummy_sift,
-                            testdata_nonmonotonic, testdata_ratio_matches,)
+                            testdata_nonmonotonic, testdata_ratio_matches,
+                            testdata_sver_pair,)
 
-__all__ = ['AnnotPairFeatInfo', 'AnnoyWraper', 'AnnoyWrapper', 'AssignTup',
-           'ConfusionMetrics', 'DATETIMEORIGINAL_TAGID', 'DEFAULT_DTYPE',
+__all__ = ['AnnotCache', 'AnnotPairFeatInfo', 'AnnoyWraper', 'AnnoyWrapper', 'AssignTup',
+           'BATCH_WORKER_CACHE_SIZE', 'BruteForceIndex',
+           'ConfusionMetrics', 'Cv2FlannIndex', 'DATETIMEORIGINAL_TAGID', 'DEFAULT_DTYPE',
            'EXIF_TAG_DATETIME', 'EXIF_TAG_GPS', 'EXIF_TAG_TO_TAGID',
-           'GPSDATE_CODE', 'GPSINFO_CODE', 'GPSLATITUDEREF_CODE',
+           'FLANN_HASH_MODE', 'FLANN_HASH_NUM_SAMPLES', 'FLANN_INDEX_REGISTRY',
+           'FLANN_REBUILD_FACTOR', 'FLANN_REGISTRY_MAX_BYTES',
+           'FeatureStore', 'GPSDATE_CODE', 'GPSINFO_CODE', 'GPSLATITUDEREF_CODE',
            'GPSLATITUDE_CODE', 'GPSLONGITUDEREF_CODE', 'GPSLONGITUDE_CODE',
            'GPSTIME_CODE', 'GPS_TAG_TO_GPSID', 'GRAVITY_THETA',
            'GaussianBlurInplace', 'HAVE_SVER_C_WRAPPER', 'INDEX_DTYPE',
-           'KPTS_DTYPE', 'L1', 'L2', 'L2_root_sift', 'L2_sift', 'L2_sift_sqrd',
-           'L2_sqrd', 'LINE_AA', 'LOC_DIMS', 'MatchingError',
-           'NORM_CHIP_CONFIG', 'ORIENTATION_000', 'ORIENTATION_090',
+           'KDTreeIndex', 'KPTS_DTYPE', 'KptsGeometry', 'L1', 'L2', 'L2_root_sift', 'L2_sift', 'L2_sift_sqrd',
+           'L2_sqrd', 'LINE_AA', 'LOC_DIMS', 'MatchPipeline', 'MatchView', 'MatchingError',
+           'NNIndex', 'NNIndexRegistry', 'NN_AUTO_BACKENDS', 'NN_BACKENDS',
+           'NN_BATCH_CHUNKSIZE',
+           'NN_BRUTE_FORCE_MAX_VECS', 'NORM_CHIP_CONFIG', 'ORIENTATION_000', 'ORIENTATION_090',
            'ORIENTATION_180', 'ORIENTATION_270', 'ORIENTATION_CODE',
            'ORIENTATION_DICT', 'ORIENTATION_DICT_INVERSE',
            'ORIENTATION_ORDER_LIST', 'ORIENTATION_UNDEFINED', 'ORI_DIM',
-           'PSEUDO_MAX_DIST', 'PSEUDO_MAX_DIST_SQRD',
+           'OneVsManyMatcher', 'PSEUDO_MAX_DIST', 'PSEUDO_MAX_DIST_SQRD',
            'PSEUDO_MAX_VEC_COMPONENT', 'PairwiseMatch', 'SCAX_DIM', 'SCAY_DIM',
            'SENSITIVITYTYPE_CODE', 'SHAPE_DIMS', 'SKEW_DIM', 'SUM_OPS',
+           'SVER_BACKEND', 'SVER_BACKEND_TRIALS', 'SVER_BATCH_CHUNKSIZE', 'SVER_DEDUP_BINFRAC',
+           'SVER_DEDUP_PER_CELL', 'SVER_DEDUP_TOPK',
+           'SVER_HYPOTHESIS_STRATEGIES',
+           'SVER_MAX_HYPOTHESES', 'SVER_MEM_BUDGET', 'SVER_PREEMPT_BLOCKSIZE',
            'SV_DTYPE', 'ScaleStrat', 'ScoreNormVisualizeClass',
-           'ScoreNormalizer', 'TAU', 'TEMP_VEC_DTYPE', 'TRANSFORM_DTYPE',
+           'ScoreNormalizer', 'SverRecorder', 'TAU', 'TEMP_VEC_DTYPE',
+           'TRANSFORM_DTYPE',
            'VALID_DISTS', 'VERBOSE_SVER', 'VSONE_ASSIGN_CONFIG',
            'VSONE_DEFAULT_CONFIG', 'VSONE_FEAT_CONFIG', 'VSONE_PI_DICT',
            'VSONE_RATIO_CONFIG', 'VSONE_SVER_CONFIG', 'XDIM', 'YDIM',
            'adaptive_scale', 'add_homogenous_coordinate',
            'affine_around_mat3x3', 'affine_mat3x3',
            'affine_warp_around_center', 'and_lists', 'ann_flann_once',
-           'apply_filter_funcs', 'apply_grouping', 'apply_grouping_',
+           'apply_all_batch', 'apply_filter_funcs', 'apply_flann_delta', 'apply_grouping', 'apply_grouping_',
            'apply_grouping_iter', 'apply_grouping_iter2',
            'apply_jagged_grouping', 'argsort_groups', 'argsort_records',
            'argsubextrema2', 'argsubmax', 'argsubmax2', 'argsubmaxima',
@@ -426,8 +476,8 @@ __all__ = ['AnnotPairFeatInfo', 'AnnoyWraper', 'AnnoyWrapper', 'AssignTup',
            'assign_to_centroids', 'assign_unconstrained_matches',
            'asymmetric_correspondence', 'atan2', 'atleast_3channels',
            'atleast_nd', 'atleast_nd', 'atleast_shape',
-           'augment_2x2_with_translation', 'bar_L2_sift', 'bar_cos_sift',
-           'bbox_center', 'bbox_from_center_wh', 'bbox_from_extent',
+           'augment_2x2_with_translation', 'available_nn_backends', 'bar_L2_sift', 'bar_cos_sift',
+           'batch_nn_index', 'bbox_center', 'bbox_from_center_wh', 'bbox_from_extent',
            'bbox_from_verts', 'bbox_from_xywh', 'bboxes_from_vert_list',
            'beaton_tukey_loss', 'beaton_tukey_weight', 'blend', 'blend_images',
            'blend_images_average', 'blend_images_average_stack',
@@ -436,7 +486,9 @@ __all__ = ['AnnotPairFeatInfo', 'AnnoyWraper', 'AnnoyWrapper', 'AssignTup',
            'build_lstsqrs_Mx9', 'calc_error_bars_from_sample',
            'calc_sample_from_error_bars', 'cast_split', 'check_exif_keys',
            'check_expr_eq', 'check_kpts_in_bounds', 'check_sift_validity',
-           'check_unused_kwargs', 'chip', 'circular_distance', 'clipnorm',
+           'check_sver_backend_parity', 'check_unused_kwargs', 'chip',
+           'choose_nn_backend',
+           'choose_sver_backend', 'circular_distance', 'clipnorm',
            'clipwhite', 'clipwhite_ondisk', 'closest_point',
            'closest_point_on_bbox', 'closest_point_on_line',
            'closest_point_on_line_segment', 'closest_point_on_vert_segments',
@@ -463,7 +515,8 @@ __all__ = ['AnnotPairFeatInfo', 'AnnoyWraper', 'AnnoyWrapper', 'AssignTup',
            'empty_neighbors', 'ensure_3channel', 'ensure_4channel',
            'ensure_alpha_channel', 'ensure_grayscale',
            'ensure_metadata_dlen_sqrd', 'ensure_metadata_feats',
-           'ensure_metadata_flann', 'ensure_metadata_normxy',
+           'ensure_metadata_flann', 'ensure_metadata_kpts_geom',
+           'ensure_metadata_normxy',
            'ensure_metadata_vsone', 'ensure_monotone_decreasing',
            'ensure_monotone_increasing', 'ensure_monotone_strictly_decreasing',
            'ensure_monotone_strictly_increasing', 'ensure_rng', 'ensure_shape',
@@ -490,15 +543,19 @@ __all__ = ['AnnotPairFeatInfo', 'AnnoyWraper', 'AnnoyWrapper', 'AssignTup',
            'generate_to_patch_transforms', 'geometry', 'get_RV_mats2x2',
            'get_RV_mats_3x3', 'get_V_mats', 'get_Z_mats', 'get_affine_inliers',
            'get_best_affine_inliers', 'get_best_affine_inliers_',
+           'get_best_affine_inliers_sampled',
+           'get_best_affine_inliers_vectorized',
            'get_covered_mask', 'get_crop_slices', 'get_cross_patch',
+           'get_data_hashstr',
            'get_dummy_dpts', 'get_dummy_invV_mats', 'get_dummy_kpts',
            'get_dummy_kpts_pair', 'get_dummy_matching_kpts', 'get_dummy_xy',
            'get_even_point_sample', 'get_exif_dict', 'get_exif_dict2',
            'get_exif_tagids', 'get_exist',
            'get_extract_features_default_params', 'get_extramargin_measures',
-           'get_flann_cfgstr', 'get_flann_fpath', 'get_flann_params',
+           'get_flann_cfgstr', 'get_flann_delta_fpath', 'get_flann_fpath', 'get_flann_params',
            'get_flann_params_cfgstr', 'get_grid_kpts', 'get_histinfo_str',
-           'get_image_to_chip_transform', 'get_invVR_mats2x2',
+           'get_image_to_chip_transform', 'get_index_nbytes',
+           'get_invVR_mats2x2',
            'get_invVR_mats3x3', 'get_invVR_mats_oris', 'get_invVR_mats_shape',
            'get_invVR_mats_sqrd_scale', 'get_invVR_mats_xys', 'get_invV_mats',
            'get_invV_mats2x2', 'get_invV_mats3x3', 'get_invVs',
@@ -542,9 +599,9 @@ __all__ = ['AnnotPairFeatInfo', 'AnnoyWraper', 'AnnoyWrapper', 'AssignTup',
            'iter_reduce_ufunc', 'jagged_group', 'keypoint', 'kp_cpp_infostr',
            'kpts_docrepr', 'kpts_matrices', 'kpts_repr',
            'learn_score_normalization', 'linalg', 'linear_interpolation',
-           'list_compress_', 'list_take_', 'logistic_01', 'logit',
+           'list_compress_', 'list_take_', 'load_matches', 'logistic_01', 'logit',
            'make_channels_comparable', 'make_dummy_fm',
-           'make_exif_dict_human_readable', 'make_test_image_keypoints',
+           'make_exif_dict_human_readable', 'make_feature_matrix', 'make_nn_index', 'make_test_image_keypoints',
            'make_video', 'make_video2', 'make_white_transparent', 'matching',
            'maxima_neighbors', 'maximum_parabola_point', 'median_abs_dev',
            'montage', 'mult_lists', 'multiaxis_reduce', 'multigroup_lookup',
@@ -563,11 +620,12 @@ __all__ = ['AnnotPairFeatInfo', 'AnnoyWraper', 'AnnoyWrapper', 'AssignTup',
            'patch_mag', 'patch_ori', 'pdist_argsort', 'pdist_indicies',
            'perlin_noise', 'perterb_kpts', 'perterbed_grid_kpts',
            'plot_centroids', 'plot_postbayes_pdf', 'plot_prebayes_pdf',
-           'point_inside_bbox', 'print_image_checks', 'random_affine_args',
+           'point_inside_bbox', 'prefetch_matches', 'print_image_checks', 'random_affine_args',
            'random_affine_transform', 'read_all_exif_tags', 'read_exif',
            'read_exif_tags', 'read_one_exif_tag', 'rebuild_partition',
            'rectify_invV_mats_are_up', 'rectify_to_float01',
            'rectify_to_square', 'rectify_to_uint8', 'refine_inliers',
+           'register_nn_backend',
            'remove_homogenous_coordinate', 'resize', 'resize_image_by_scale',
            'resize_mask', 'resize_thumb', 'resize_to_maxdims',
            'resize_to_maxdims_ondisk', 'resized_clamped_thumb_dims',
@@ -576,7 +634,7 @@ __all__ = ['AnnotPairFeatInfo', 'AnnoyWraper', 'AnnoyWrapper', 'AssignTup',
            'rotation_mat2x2', 'rotation_mat3x3', 'rowwise_operation',
            'safe_argmax', 'safe_cat', 'safe_div', 'safe_extreme', 'safe_max',
            'safe_min', 'safe_pdist', 'safe_vstack', 'sample_ell_border_pts',
-           'sample_ell_border_vals', 'sample_uniform', 'scale_around_mat3x3',
+           'sample_ell_border_vals', 'sample_uniform', 'save_matches', 'scale_around_mat3x3',
            'scale_bbox', 'scale_extents', 'scale_mat3x3',
            'scaled_verts_from_bbox', 'scaled_verts_from_bbox_gen',
            'score_normalization', 'shear', 'shear_mat3x3',
@@ -584,11 +642,14 @@ __all__ = ['AnnotPairFeatInfo', 'AnnoyWraper', 'AnnoyWrapper', 'AssignTup',
            'show_ori_image_ondisk', 'show_patch_orientation_estimation',
            'signed_cyclic_distance', 'signed_ori_distance',
            'significant_shape', 'sorted_indices_ranges',
-           'spatial_verification', 'spatially_verify_kpts', 'stack_image_list',
+           'spatial_verification', 'spatially_verify_kpts',
+           'spatially_verify_kpts_batch', 'spatially_verify_kpts_nested',
+           'stack_image_list',
            'stack_image_list_special', 'stack_image_recurse', 'stack_images',
            'stack_multi_images', 'stack_multi_images2', 'stack_square_images',
            'strictly_decreasing', 'strictly_increasing', 'structure_rows',
            'subbin_bounds', 'subpixel_values', 'subscale_peaks', 'svd',
+           'sver_backend_report',
            'symbolic', 'symbolic_randcheck', 'symmetric_correspondence',
            'sympy_latex_repr', 'sympy_mat', 'sympy_numpy_repr', 'take2',
            'take_col_per_row', 'test_affine_errors', 'test_annoy',
@@ -602,7 +663,7 @@ __all__ = ['AnnotPairFeatInfo', 'AnnoyWraper', 'AnnoyWrapper', 'AssignTup',
            'testdata_matching_affine_inliers_normalized',
            'testdata_nonmonotonic', 'testdata_patch', 'testdata_ratio_matches',
            'testdata_score_normalier', 'testdata_scores_labels',
-           'testdata_sift2', 'testshow_extramargin_info',
+           'testdata_sift2', 'testdata_sver_pair', 'testshow_extramargin_info',
            'to_undirected_edges', 'transform_around', 'transform_kpts',
            'transform_kpts_to_imgspace', 'transform_kpts_xys',
            'transform_points_with_homography', 'translation_mat3x3', 'trig',
@@ -1,6 +1,8 @@
 
 
 def main():  # nocover
+    import numpy as np
+    import utool as ut
     import vtool_ibeis
     print('Looks like the imports worked')
     print('vtool_ibeis = {!r}'.format(vtool_ibeis))
@@ -16,6 +18,18 @@ def main():  # nocover
     except Exception as ex:
         print(f'ex={ex}')
 
+    # Show which sver backend is chosen for each size of pair
+    import vtool_ibeis.demodata as demodata
+    from vtool_ibeis import spatial_verification as sver
+    for num_matches in [16, 64, 256, 1024]:
+        kpts1, kpts2, fm, fs = demodata.testdata_sver_pair(num_matches)
+        xy_thresh_sqrd = vtool_ibeis.get_kpts_dlen_sqrd(kpts2) * .01
+        sver.get_best_affine_inliers_(kpts1.astype(np.float64),
+                                      kpts2.astype(np.float64), fm, fs,
+                                      xy_thresh_sqrd, 2.0, sver.TAU / 4.0)
+    print('sver_backend_report = {}'.format(
+        ut.repr4(sver.sver_backend_report(), nl=3, precision=5)))
+
 
 if __name__ == '__main__':
     """
@@ -8,6 +8,7 @@ import numpy as np
 import utool as ut
 
 from vtool_ibeis._pyflann_backend import FLANN_CLS
+from vtool_ibeis.nearest_neighbors import AnnoyWrapper
 
 
 def tune_flann2(data):
@@ -23,30 +24,21 @@ def tune_flann2(data):
     return tuned_params
 
 
-class AnnoyWraper(object):
+class AnnoyWraper(AnnoyWrapper):
     """
     flann-like interface to annnoy
-    """
 
-    def __init__(self):
-        pass
+    Old method names of `nearest_neighbors.AnnoyWrapper`, which implements
+    the nearest neighbor backend protocol.
+    """
 
     def build_annoy(self, centroids, trees=3):
-        import annoy
-        self.a = annoy.AnnoyIndex(centroids.shape[1], metric='euclidean')
-        for i, v in enumerate(centroids):
-            self.a.add_item(i, v)
-        self.a.build(trees)
+        self.build_index(centroids, trees=trees)
 
     def query_annoy(self, query_vecs, num, checks=-1):
-        a = self.a
-        index_list = []
-        dist_list = []
-        for v in query_vecs:
-            idx, dist = a.get_nns_by_vector(v, num, search_k=checks, include_distances=True)
-            index_list.append(idx)
-            dist_list.append(dist)
-        return np.array(index_list), np.array(dist_list) ** 2
+        index_list, dist_list = self.nn_index(query_vecs, num, checks=checks)
+        shape = (len(query_vecs), num)
+        return index_list.reshape(shape), dist_list.reshape(shape)
 
     def nn(self, data_vecs, query_vecs, num, trees=3, checks=-1):
         self.build_annoy(data_vecs, trees)
@@ -617,6 +617,46 @@ def testdata_dummy_matches():
     return (kpts1, kpts2, fm, fs, rchip1, rchip2)
 
 
+def testdata_sver_pair(num_matches=100, inlier_ratio=.5, seed=0):
+    r"""
+    Synthetic keypoint pair for spatial verification of any size.
+
+    The second annotation is an affine warp of a perterbed grid in the first.
+    A `1 - inlier_ratio` fraction of the matches point to random keypoints.
+
+    Args:
+        num_matches (int): number of feature matches (default = 100)
+        inlier_ratio (float): expected fraction of correct matches
+        seed (int): random seed
+
+    Returns:
+        tuple: (kpts1, kpts2, fm, fs)
+
+    CommandLine:
+        python -m vtool_ibeis.demodata testdata_sver_pair
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.demodata import *  # NOQA
+        >>> kpts1, kpts2, fm, fs = testdata_sver_pair(50, inlier_ratio=.8)
+        >>> print((kpts1.shape, kpts2.shape, fm.shape, fs.shape))
+        ((64, 6), (64, 6), (50, 2), (50,))
+    """
+    num_side = max(int(np.ceil(np.sqrt(num_matches))), 1)
+    side = 20 * num_side + 60
+    kpts1 = perterbed_grid_kpts(wh=(side, side), wh_num=(num_side, num_side),
+                                seed=seed)
+    M = np.array([[1.1, .1, 20], [-.1, .9, 10], [0, 0, 1]])
+    kpts2 = perterb_kpts(ktool.transform_kpts(kpts1, M), xy_std=(1, 1),
+                         invV_std=(.3, .3, .3), ori_std=.02, seed=seed + 1)
+    rng = np.random.RandomState(seed)
+    fm = make_dummy_fm(num_matches).astype(np.int32)
+    is_outlier = rng.rand(num_matches) >= inlier_ratio
+    fm[is_outlier, 1] = rng.randint(0, len(kpts2), is_outlier.sum())
+    fs = rng.rand(num_matches)
+    return kpts1, kpts2, fm, fs
+
+
 def get_testdata_kpts(fname=None, with_vecs=False):
     if fname is None:
         kpts = get_dummy_kpts()
@@ -103,6 +103,141 @@ def get_extract_features_default_params():
     return param_dict
 
 
+class FeatureStore(ub.NiceRepr):
+    """
+    Content addressed on-disk store of extracted keypoints and descriptors.
+
+    Features are keyed by the hash of the chip file and the values of the
+    chip normalization and feature extraction config, so they are shared
+    between processes and runs. Each entry is a pair of `.npy` files that are
+    loaded memory mapped (and therefore read only).
+
+    Args:
+        dpath (str): directory of the store (defaults to the app cache dir)
+        appname (str): app name used for the default directory
+
+    CommandLine:
+        python -m vtool_ibeis.features FeatureStore
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.features import *  # NOQA
+        >>> import numpy as np
+        >>> import vtool_ibeis as vt
+        >>> dpath = ub.Path.appdir('vtool_ibeis', 'tests', 'featstore').delete().ensuredir()
+        >>> store = FeatureStore(dpath)
+        >>> fpath = dpath / 'chip.png'
+        >>> vt.imwrite(fpath, vt.demodata.dummy_img(16, 16))
+        >>> key = store.feat_key(fpath, {'ratio_thresh': .5})
+        >>> # Configs that do not change the features map to the same key
+        >>> assert key == store.feat_key(fpath, {})
+        >>> assert key != store.feat_key(fpath, {'histeq': True})
+        >>> assert store.load(key) is None
+        >>> kpts = vt.demodata.get_dummy_kpts(5)
+        >>> vecs = np.arange(5 * 128, dtype=np.uint8).reshape(5, 128)
+        >>> store.save(key, kpts, vecs)
+        >>> kpts_, vecs_ = store.load(key)
+        >>> assert isinstance(vecs_, np.memmap) and np.all(vecs_ == vecs)
+        >>> print(store)
+        <FeatureStore(nEntries=1)>
+    """
+
+    def __init__(store, dpath=None, appname='vtool_ibeis'):
+        if dpath is None:
+            dpath = ub.Path.appdir(appname, 'feature_store')
+        store.dpath = ub.Path(dpath)
+        # Maps (fpath, mtime, size) to the file hash
+        store._fpath_hashes = {}
+
+    def __nice__(store):
+        num = len(list(store.dpath.glob('*/*_vecs.npy')))
+        return 'nEntries=%d' % (num,)
+
+    def _file_hash(store, fpath):
+        stat = ub.Path(fpath).stat()
+        stat_key = (str(fpath), stat.st_mtime_ns, stat.st_size)
+        if stat_key not in store._fpath_hashes:
+            store._fpath_hashes[stat_key] = ub.hash_file(fpath,
+                                                         hasher='sha1')
+        return store._fpath_hashes[stat_key]
+
+    def feat_key(store, rchip_fpath, cfgdict={}):
+        """
+        Key of the features of a chip file under a config. Only the chip
+        normalization and feature extraction params affect the key.
+        """
+        from vtool_ibeis import matching
+        config = [
+            (pi.varname, cfgdict.get(pi.varname, pi.default))
+            for pi in matching.NORM_CHIP_CONFIG + matching.VSONE_FEAT_CONFIG
+        ]
+        cfg_hash = ub.hash_data(config, hasher='sha1')[0:16]
+        return store._file_hash(rchip_fpath)[0:24] + '_' + cfg_hash
+
+    def _fpaths(store, key):
+        dpath = store.dpath / key[0:2]
+        return dpath / (key + '_kpts.npy'), dpath / (key + '_vecs.npy')
+
+    def __contains__(store, key):
+        return store._fpaths(key)[1].exists()
+
+    def load(store, key):
+        """
+        Returns:
+            tuple: memory mapped (kpts, vecs) or None if not in the store
+        """
+        import numpy as np
+        kpts_fpath, vecs_fpath = store._fpaths(key)
+        # vecs are written last, so they mark a complete entry
+        if not vecs_fpath.exists():
+            return None
+        kpts = np.load(kpts_fpath, mmap_mode='r')
+        vecs = np.load(vecs_fpath, mmap_mode='r')
+        return kpts, vecs
+
+    def save(store, key, kpts, vecs):
+        """
+        Atomically writes the features of a key. Threads and processes may
+        save the same key at the same time.
+
+        Example:
+            >>> # ENABLE_DOCTEST
+            >>> from vtool_ibeis.features import *  # NOQA
+            >>> import numpy as np
+            >>> import vtool_ibeis as vt
+            >>> from concurrent import futures
+            >>> dpath = ub.Path.appdir('vtool_ibeis', 'tests', 'featstore_save').delete().ensuredir()
+            >>> store = FeatureStore(dpath)
+            >>> kpts = vt.demodata.get_dummy_kpts(5)
+            >>> vecs = np.arange(5 * 128, dtype=np.uint8).reshape(5, 128)
+            >>> with futures.ThreadPoolExecutor(4) as pool:
+            >>>     list(pool.map(lambda _: store.save('abcd', kpts, vecs),
+            >>>                   range(16)))
+            >>> kpts_, vecs_ = store.load('abcd')
+            >>> assert np.all(vecs_ == vecs)
+            >>> print(sorted(p.name for p in (dpath / 'ab').iterdir()))
+            ['abcd_kpts.npy', 'abcd_vecs.npy']
+        """
+        import os
+        import tempfile
+        import numpy as np
+        kpts_fpath, vecs_fpath = store._fpaths(key)
+        kpts_fpath.parent.ensuredir()
+        for fpath, data in [(kpts_fpath, kpts), (vecs_fpath, vecs)]:
+            # Write to a unique temporary file, then rename it into place
+            with tempfile.NamedTemporaryFile(
+                    dir=fpath.parent, prefix='.' + fpath.name + '.',
+                    suffix='.tmp.npy', delete=False) as file_:
+                tmp_fpath = file_.name
+                try:
+                    np.save(file_, np.ascontiguousarray(data))
+                except Exception:
+                    file_.close()
+                    os.remove(tmp_fpath)
+                    raise
+            os.replace(tmp_fpath, fpath)
+
+
 def detect_opencv_keypoints():
     import cv2
     import vtool_ibeis as vt
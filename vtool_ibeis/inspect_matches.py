@@ -120,6 +120,7 @@ class MatchInspector(INSPECT_BASE):
 
     def set_match(self, match=None, on_context=None, info_text=None):
         self.match = match
+        self._pipeline = None
         self.info_text = info_text
         self.on_context = on_context
         if self.isVisible():
@@ -254,8 +255,18 @@ class MatchInspector(INSPECT_BASE):
         matching.ensure_metadata_vsone(match.annot1, match.annot2,
                                        cfgdict=cfgdict)
 
+        # Only recompute the stages invalidated by the changed params
+        if self._pipeline is None:
+            self._pipeline = matching.MatchPipeline([match])
         match_config = self.config.asdict()
-        match.apply_all(match_config)
+        match_ = self._pipeline.run(match_config)[0]
+        # Copy everything the pipeline computed, but keep our annotations
+        state = match_.__getstate__()
+        del state['annot1'], state['annot2']
+        # The pipeline caches its stage outputs, so do not share the dicts
+        state['local_measures'] = state['local_measures'].copy()
+        state['global_measures'] = state['global_measures'].copy()
+        match.__dict__.update(state)
 
     def draw_pair(self):
         if self.match is None:
@@ -295,6 +306,7 @@ class MatchInspector(INSPECT_BASE):
 
     def on_chip_cfg_changed(self, *args):
         print('Update feats')
+        self._pipeline = None
         feat_keys = ['nchip', 'vecs', 'kpts', '_feats', 'flann']
         self.match.annot1._mutable = True
         self.match.annot2._mutable = True
@@ -308,6 +320,7 @@ class MatchInspector(INSPECT_BASE):
 
     def on_feat_cfg_changed(self, *args):
         print('Update feats')
+        self._pipeline = None
         feat_keys = ['vecs', 'kpts', '_feats', 'flann']
         self.match.annot1._mutable = True
         self.match.annot2._mutable = True
@@ -42,6 +42,7 @@ VSONE_ASSIGN_CONFIG = [
     ut.ParamInfo('weight', None, valid_values=[None, 'fgweights'],),
     ut.ParamInfo('K', 1, min_=1),
     ut.ParamInfo('Knorm', 1, min_=1),
+    ut.ParamInfo('nn_backend', 'auto', hideif='auto'),
 ]
 
 VSONE_RATIO_CONFIG = [
@@ -61,6 +62,14 @@ VSONE_SVER_CONFIG = [
                  hideif=lambda cfg: not cfg['sv_on']),
     ut.ParamInfo('sver_scale_thresh', 2.0, min_=1.0, max_=None,
                  hideif=lambda cfg: not cfg['sv_on']),
+    ut.ParamInfo('sver_hypothesis_strategy', 'exhaustive',
+                 valid_values=['exhaustive', 'topk_by_fs', 'preemptive',
+                               'dedup'],
+                 hideif=lambda cfg: not cfg['sv_on']),
+    ut.ParamInfo('sver_max_hypotheses', None, type_=int,
+                 hideif=lambda cfg: not cfg['sv_on']),
+    ut.ParamInfo('sver_nested_bins', False,
+                 hideif=lambda cfg: not cfg['sv_on'] or not cfg['thresh_bins']),
 
 ]
 
@@ -258,6 +267,8 @@ class PairwiseMatch(ub.NiceRepr):
             'annot2': _annot2,
             'fm': match.fm,
             'fs': match.fs,
+            'fm_norm1': getattr(match, 'fm_norm1', None),
+            'fm_norm2': getattr(match, 'fm_norm2', None),
             'H_21': match.H_21,
             'H_12': match.H_12,
             'global_measures': match.global_measures,
@@ -534,6 +545,10 @@ class PairwiseMatch(ub.NiceRepr):
             >>> match.apply_ratio_test(cfgdict, inplace=True)
             >>> flags1 = match.sver_flags(cfgdict)
             >>> flags2 = match.sver_flags(cfgbase)
+            >>> # Nested bins give the same result
+            >>> cfgdict3 = ut.dict_union(cfgdict, dict(sver_nested_bins=True))
+            >>> flags3 = match.sver_flags(cfgdict3)
+            >>> assert np.all(flags1 == flags3)
         """
         from vtool_ibeis import spatial_verification as sver
         import vtool_ibeis as vt
@@ -541,6 +556,9 @@ class PairwiseMatch(ub.NiceRepr):
         def _run_sver(kpts1, kpts2, fm, match_weights, **sver_kw):
             svtup = sver.spatially_verify_kpts(
                 kpts1, kpts2, fm, match_weights=match_weights, **sver_kw)
+            return _unpack_svtup(svtup)
+
+        def _unpack_svtup(svtup):
             if svtup is None:
                 errors = [np.empty(0), np.empty(0), np.empty(0)]
                 inliers = []
@@ -551,14 +569,22 @@ class PairwiseMatch(ub.NiceRepr):
             return svtup
 
         (sver_xy_thresh, sver_ori_thresh,
-         sver_scale_thresh, refine_method, thresh_bins) = match._take_params(
+         sver_scale_thresh, refine_method, thresh_bins,
+         sver_hypothesis_strategy, sver_max_hypotheses,
+         sver_nested_bins) = match._take_params(
              cfgdict, [
                  'sver_xy_thresh', 'sver_ori_thresh', 'sver_scale_thresh',
-                 'refine_method', 'thresh_bins'
+                 'refine_method', 'thresh_bins', 'sver_hypothesis_strategy',
+                 'sver_max_hypotheses', 'sver_nested_bins'
              ])
 
-        kpts1 = match.annot1['kpts']
-        kpts2 = match.annot2['kpts']
+        # Use the precomputed keypoint geometry when it is available
+        kpts1 = match.annot1.get('kpts_geom', None)
+        kpts2 = match.annot2.get('kpts_geom', None)
+        if kpts1 is None:
+            kpts1 = match.annot1['kpts']
+        if kpts2 is None:
+            kpts2 = match.annot2['kpts']
         dlen_sqrd2 = match.annot2['dlen_sqrd']
 
         sver_kw = dict(
@@ -566,6 +592,8 @@ class PairwiseMatch(ub.NiceRepr):
             scale_thresh=sver_scale_thresh,
             refine_method=refine_method,
             dlen_sqrd2=dlen_sqrd2,
+            hypothesis_strategy=sver_hypothesis_strategy,
+            max_hypotheses=sver_max_hypotheses,
         )
 
         if thresh_bins:
@@ -583,22 +611,37 @@ class PairwiseMatch(ub.NiceRepr):
             agg_H_12 = None
             prev_best = 50
 
-            for thresh in thresh_bins:
-                ratio = match.local_measures['ratio']
-
-                # These are of len(match.fm)=1000
-                # 100 of these are True
-                ratio_flags = ratio < thresh
+            ratio = match.local_measures['ratio']
+            # These are of len(match.fm)=1000
+            # 100 of these are True
+            ratio_flags_list = [ratio < thresh for thresh in thresh_bins]
+
+            use_nested = (sver_nested_bins and
+                          sver_hypothesis_strategy == 'exhaustive' and
+                          sver_max_hypotheses is None)
+            if use_nested:
+                # The bins are nested, so hypotheses are only evaluated once
+                nested_kw = ut.dict_subset(sver_kw, [
+                    'xy_thresh', 'ori_thresh', 'scale_thresh',
+                    'refine_method', 'dlen_sqrd2'])
+                nested_svtups = sver.spatially_verify_kpts_nested(
+                    kpts1, kpts2, match.fm, match.fs, ratio_flags_list,
+                    **nested_kw)
+
+            for count, ratio_flags in enumerate(ratio_flags_list):
                 ratio_idxs = np.where(ratio_flags)[0]
 
                 if len(ratio_idxs) == 0:
                     continue
 
-                # Filter matches at this level of the ratio test
-                fm = match.fm[ratio_flags]
-                match_weights = match.fs[ratio_flags]
-
-                svtup = _run_sver(kpts1, kpts2, fm, match_weights, **sver_kw)
+                if use_nested:
+                    svtup = _unpack_svtup(nested_svtups[count])
+                else:
+                    # Filter matches at this level of the ratio test
+                    fm = match.fm[ratio_flags]
+                    match_weights = match.fs[ratio_flags]
+                    svtup = _run_sver(kpts1, kpts2, fm, match_weights,
+                                      **sver_kw)
                 (inliers, errors, H_12) = svtup
                 n_inliers = len(inliers)
 
@@ -922,6 +965,1207 @@ class PairwiseMatch(ub.NiceRepr):
         return feat
 
 
+class MatchPipeline(ub.NiceRepr):
+    """
+    Runs the stages of `PairwiseMatch.apply_all` on a set of pairs and
+    memoizes the output of each stage on the config keys it reads.
+
+    The stages are assign (VSONE_ASSIGN_CONFIG), ratio test
+    (VSONE_RATIO_CONFIG) and spatial verification (VSONE_SVER_CONFIG). The
+    output of a stage is keyed by its params and the params of the stages
+    before it, so sweeping downstream params (e.g. `ratio_thresh` or
+    `sver_xy_thresh`) only recomputes the stages they invalidate.
+
+    Note:
+        The annotation features are computed once per annotation, as in
+        PairwiseMatch, so chip and feature params are not part of a sweep.
+        Returned matches are shared with the cache and should not be
+        modified in place.
+
+    Args:
+        matches (list): PairwiseMatch objects that define the pairs. Their
+            annots and global measures are used, and they are not modified.
+
+    CommandLine:
+        python -m vtool_ibeis.matching MatchPipeline
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> # xdoctest: +REQUIRES(module:pyflann_ibeis)
+        >>> from vtool_ibeis.matching import *  # NOQA
+        >>> import vtool_ibeis as vt
+        >>> kpts1, kpts2 = vt.demodata.testdata_sver_pair(100, seed=0)[0:2]
+        >>> rng = np.random.RandomState(0)
+        >>> vecs = rng.randint(0, 200, (100, 128))
+        >>> annot1 = {'kpts': kpts1, 'dlen_sqrd': 300 ** 2,
+        >>>           'vecs': (vecs + rng.randint(0, 40, vecs.shape)).astype(np.uint8)}
+        >>> annot2 = {'kpts': kpts2, 'dlen_sqrd': 300 ** 2,
+        >>>           'vecs': (vecs + rng.randint(0, 40, vecs.shape)).astype(np.uint8)}
+        >>> pipe = MatchPipeline([PairwiseMatch(annot1, annot2)])
+        >>> grid = {'ratio_thresh': [.6, .7, .8], 'sver_xy_thresh': [.001, .01]}
+        >>> for cfgdict, matches in pipe.sweep(ut.all_dict_combinations(grid)):
+        >>>     pass
+        >>> print(ut.repr2(pipe.stats(), nl=1, sorted_=True))
+        {
+            'assign': {'hits': 5, 'misses': 1},
+            'ratio': {'hits': 3, 'misses': 3},
+            'sver': {'hits': 0, 'misses': 6},
+        }
+        >>> # The result is the same as apply_all
+        >>> match = PairwiseMatch(annot1, annot2)
+        >>> match.apply_all(cfgdict)
+        >>> assert np.all(match.fm == matches[0].fm)
+    """
+    STAGES = [
+        ('assign', [pi.varname for pi in VSONE_ASSIGN_CONFIG]),
+        ('ratio', [pi.varname for pi in VSONE_RATIO_CONFIG]),
+        ('sver', [pi.varname for pi in VSONE_SVER_CONFIG]),
+    ]
+
+    def __init__(pipe, matches):
+        pipe.matches = list(matches)
+        pipe._cache = {stage: {} for stage, _ in pipe.STAGES}
+        pipe._stats = {stage: {'hits': 0, 'misses': 0}
+                       for stage, _ in pipe.STAGES}
+
+    def __nice__(pipe):
+        return 'nPairs=%d, nCached=%d' % (
+            len(pipe.matches), sum(map(len, pipe._cache.values())))
+
+    def _stage_keys(pipe, cfgdict):
+        """ The cache key of each stage for a config """
+        stage_keys = []
+        prefix = []
+        for stage, keys in pipe.STAGES:
+            params = list(zip(keys, PairwiseMatch._take_params(cfgdict,
+                                                               keys)))
+            if stage == 'sver' and not dict(params)['sv_on']:
+                # Without sver the other params are ignored
+                params = [('sv_on', False)]
+            prefix = prefix + params
+            stage_keys.append(ub.hash_data(prefix))
+        return stage_keys
+
+    def _run_stage(pipe, stage, inputs, cfgdict):
+        if stage == 'assign':
+            outputs = []
+            for match in inputs:
+                match_ = PairwiseMatch(match.annot1, match.annot2)
+                match_.verbose = match.verbose
+                match_.global_measures = match.global_measures.copy()
+                outputs.append(match_.assign(cfgdict))
+        elif stage == 'ratio':
+            outputs = [match.apply_ratio_test(cfgdict, inplace=False)
+                       for match in inputs]
+        elif stage == 'sver':
+            sv_on, = PairwiseMatch._take_params(cfgdict, ['sv_on'])
+            if sv_on:
+                outputs = [match.apply_sver(cfgdict, inplace=False)
+                           for match in inputs]
+            else:
+                outputs = inputs
+        return outputs
+
+    def run(pipe, cfgdict={}):
+        """
+        Returns:
+            list: the match of each pair under the config
+        """
+        outputs = pipe.matches
+        for (stage, _), key in zip(pipe.STAGES, pipe._stage_keys(cfgdict)):
+            cache = pipe._cache[stage]
+            if key in cache:
+                pipe._stats[stage]['hits'] += 1
+                outputs = cache[key]
+            else:
+                pipe._stats[stage]['misses'] += 1
+                outputs = pipe._run_stage(stage, outputs, cfgdict)
+                cache[key] = outputs
+        return outputs
+
+    def sweep(pipe, cfgdict_list):
+        """
+        Runs each config
+
+        Yields:
+            tuple: (cfgdict, matches)
+        """
+        for cfgdict in cfgdict_list:
+            yield cfgdict, pipe.run(cfgdict)
+
+    def clear(pipe, stage=None):
+        """ Clears the cache of a stage and the stages after it """
+        stages = [stage_ for stage_, _ in pipe.STAGES]
+        start = 0 if stage is None else stages.index(stage)
+        for stage_ in stages[start:]:
+            pipe._cache[stage_].clear()
+
+    def stats(pipe):
+        """
+        Returns:
+            dict: number of cache hits and misses of each stage
+        """
+        return ub.map_vals(dict, pipe._stats)
+
+
+class OneVsManyMatcher(ub.NiceRepr):
+    """
+    Matches a query annotation against many database annotations with a
+    single nearest neighbor query.
+
+    The descriptors of the database annotations are stacked into one FLANN
+    index with `nearest_neighbors.invertible_stack`. Each query runs one
+    `nn_index` call, and the neighbors are split back into one
+    `PairwiseMatch` per database annotation (annot1 is the database
+    annotation and annot2 is the query, as in an asymmetric
+    `PairwiseMatch.assign`). The returned matches are ready for
+    `apply_ratio_test` and `apply_sver`.
+
+    Note:
+        The normalizer of the ratio test is the (K + Knorm)-th neighbor among
+        all database features, not only among the features of the matched
+        annotation. Ratios are therefore never smaller (and the ratio test is
+        stricter) than with a one-vs-one assign.
+
+    The index is built by the first `query` (or by `build`) and depends on
+    the feature params of that cfgdict. A later query with different feature
+    params raises a ValueError. The stacked index always uses the flann
+    backend with `flann_params` (the nn_backend config is not used), and it
+    is owned by the matcher rather than shared through
+    `FLANN_INDEX_REGISTRY`.
+
+    Args:
+        annots (list): database annotation dicts (see PairwiseMatch)
+        flann_params (dict): parameters of the stacked index
+            (default is the same kdtree used by ensure_metadata_flann)
+
+    CommandLine:
+        python -m vtool_ibeis.matching OneVsManyMatcher
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> # xdoctest: +REQUIRES(module:pyflann_ibeis)
+        >>> from vtool_ibeis.matching import *  # NOQA
+        >>> import vtool_ibeis as vt
+        >>> rng = np.random.RandomState(0)
+        >>> def _demo_annot(aid, vecs):
+        >>>     kpts = vt.demodata.perterbed_grid_kpts(seed=aid, wh_num=(5, 4))
+        >>>     return {'aid': aid, 'kpts': kpts, 'vecs': vecs,
+        >>>             'dlen_sqrd': 300 ** 2 * 2}
+        >>> db_vecs = [rng.randint(0, 128, (20, 128)).astype(np.uint8)
+        >>>            for _ in range(3)]
+        >>> annots = [_demo_annot(aid, vecs) for aid, vecs in enumerate(db_vecs)]
+        >>> # The query shares its first 10 features with database annot 1
+        >>> qvecs = np.vstack([db_vecs[1][:10] + 1,
+        >>>                    rng.randint(0, 128, (10, 128))]).astype(np.uint8)
+        >>> qannot = _demo_annot(3, qvecs)
+        >>> matcher = OneVsManyMatcher(annots)
+        >>> cfgdict = {'checks': 800, 'ratio_thresh': .5}
+        >>> matches = matcher.query(qannot, cfgdict)
+        >>> print([len(match) for match in matches])
+        [2, 13, 5]
+        >>> match = matches[1].apply_ratio_test(cfgdict)
+        >>> print(match)
+        >>> assert np.all(match.fm == np.c_[np.arange(10), np.arange(10)])
+        >>> # The matches are a subset of one-vs-one matches
+        >>> match11 = PairwiseMatch(annots[1], qannot).assign(cfgdict)
+        >>> fm_sets = [set(map(tuple, m.fm)) for m in [matches[1], match11]]
+        >>> assert fm_sets[0].issubset(fm_sets[1])
+        >>> # The index can not be reused with other feature params
+        >>> if VSONE_FEAT_CONFIG:
+        >>>     pi = VSONE_FEAT_CONFIG[0]
+        >>>     other_cfg = {pi.varname: ('other', pi.default)}
+        >>>     ut.assert_raises(ValueError, matcher.query, qannot, other_cfg)
+    """
+
+    def __init__(matcher, annots, flann_params=None):
+        if flann_params is None:
+            flann_params = {'algorithm': 'kdtree', 'trees': 8}
+        matcher.annots = [annot if isinstance(annot, ut.LazyDict) else
+                          ut.LazyDict(annot) for annot in annots]
+        matcher.flann_params = flann_params
+        matcher.flann = None
+        matcher.idx2_label = None
+        matcher.idx2_fx = None
+        matcher.feat_params = None
+
+    def __nice__(matcher):
+        num_vecs = 0 if matcher.idx2_fx is None else len(matcher.idx2_fx)
+        return 'nAnnots=%d, nVecs=%d' % (len(matcher.annots), num_vecs)
+
+    @staticmethod
+    def _feat_params(cfgdict):
+        return {pi.varname: cfgdict.get(pi.varname, pi.default)
+                for pi in VSONE_FEAT_CONFIG}
+
+    def build(matcher, cfgdict={}):
+        """ Stacks the database descriptors and builds the index """
+        import vtool_ibeis as vt
+        matcher.feat_params = matcher._feat_params(cfgdict)
+        for annot in matcher.annots:
+            ensure_metadata_feats(annot, cfgdict=cfgdict)
+        vecs_list = [annot['vecs'] for annot in matcher.annots]
+        labels = np.arange(len(vecs_list))
+        idx2_vec, idx2_label, idx2_fx = vt.invertible_stack(vecs_list, labels)
+        if len(idx2_vec) == 0:
+            matcher.flann = None
+        else:
+            matcher.flann = vt.flann_cache(idx2_vec,
+                                           flann_params=matcher.flann_params,
+                                           verbose=False)
+        matcher.idx2_label = idx2_label
+        matcher.idx2_fx = idx2_fx
+        return matcher
+
+    def query(matcher, qannot, cfgdict={}):
+        """
+        Matches a query annotation against all database annotations
+
+        Args:
+            qannot (dict): query annotation
+            cfgdict (dict): uses the K, Knorm, checks, and weight assign
+                params
+
+        Returns:
+            list: a PairwiseMatch for each database annotation (in order)
+
+        Raises:
+            ValueError: if the index was built with other feature params
+        """
+        if matcher.idx2_fx is None:
+            matcher.build(cfgdict)
+        elif matcher._feat_params(cfgdict) != matcher.feat_params:
+            raise ValueError(
+                'The index was built with other feature params. Use a new '
+                'OneVsManyMatcher for these params')
+        if not isinstance(qannot, ut.LazyDict):
+            qannot = ut.LazyDict(qannot)
+        K, Knorm, checks, weight_key = PairwiseMatch._take_params(
+            cfgdict, ['K', 'Knorm', 'checks', 'weight'])
+        ensure_metadata_feats(qannot, cfgdict=cfgdict)
+        ensure_metadata_kpts_geom(qannot)
+        ensure_metadata_dlen_sqrd(qannot)
+
+        # Reduce K to allow some correspondences to be established
+        n_have = len(matcher.idx2_fx)
+        if n_have < 2:
+            fx2_to_idx, fx2_to_dist = empty_neighbors(0, 0)
+            K = 0
+        else:
+            if n_have < K + Knorm:
+                K, Knorm = n_have - 1, 1
+            fx2_to_idx, fx2_to_dist = normalized_nearest_neighbors(
+                matcher.flann, qannot['vecs'], K + Knorm, checks)
+        if K == 0 or len(fx2_to_idx) == 0:
+            idx_fm, match_dist, norm_dist = empty_assign()[0:3]
+        else:
+            idx_fm, match_dist, _, norm_dist = assign_unconstrained_matches(
+                fx2_to_idx, fx2_to_dist, K, Knorm)
+        match_label = matcher.idx2_label.take(idx_fm.T[0])
+        fm_all = np.vstack([matcher.idx2_fx.take(idx_fm.T[0]),
+                            idx_fm.T[1]]).T.astype(np.int32)
+
+        ratio = np.divide(match_dist, norm_dist)
+        ratio_score = (1.0 - ratio)
+
+        import vtool_ibeis as vt
+        unique_labels, groupxs = vt.group_indices(match_label)
+        # Keep the matches of each annotation in query feature order
+        label_to_groupx = {label: np.sort(groupx)
+                           for label, groupx in zip(unique_labels, groupxs)}
+        empty_groupx = np.empty(0, dtype=np.int64)
+        matches = []
+        for label, annot in enumerate(matcher.annots):
+            groupx = label_to_groupx.get(label, empty_groupx)
+            ensure_metadata_kpts_geom(annot)
+            match = PairwiseMatch(annot, qannot)
+            match.fm = fm_all.take(groupx, axis=0)
+            local_measures = match.local_measures
+            local_measures['match_dist'] = match_dist.take(groupx)
+            local_measures['norm_dist'] = norm_dist.take(groupx)
+            local_measures['ratio'] = ratio.take(groupx)
+            local_measures['ratio_score'] = ratio_score.take(groupx)
+            if weight_key is None:
+                match.fs = local_measures['ratio_score']
+            else:
+                weight1 = annot[weight_key].take(match.fm.T[0], axis=0)
+                weight2 = qannot[weight_key].take(match.fm.T[1], axis=0)
+                weight = np.sqrt(weight1 * weight2)
+                local_measures[weight_key] = weight
+                local_measures['weighted_ratio_score'] = (
+                    local_measures['ratio_score'] * weight)
+                local_measures['weighted_norm_dist'] = (
+                    local_measures['norm_dist'] * weight)
+                match.fs = local_measures['weighted_ratio_score']
+            # The normalizer may belong to a different annotation
+            match.fm_norm1 = None
+            match.fm_norm2 = None
+            matches.append(match)
+        return matches
+
+
+# Annotation values the apply_all pipeline reads. Only these are sent to
+# process workers.
+_BATCH_PIPELINE_KEYS = ['aid', 'kpts', 'vecs', 'dlen_sqrd']
+
+# Annotation values that missing pipeline values are computed from, in order
+# of preference. At most one is sent.
+_BATCH_SOURCE_KEYS = ['rchip_fpath', 'rchip']
+
+# Number of annotations each apply_all_batch process worker keeps around
+BATCH_WORKER_CACHE_SIZE = 256
+
+# Per-process state of an apply_all_batch worker
+_BATCH_WORKER_STATE = {
+    'annots': None,
+    'cache_size': None,
+}
+
+
+def _annot_batch_key(annot):
+    """ Annotations with an aid are shared by aid, otherwise by identity """
+    if 'aid' in annot:
+        return ('aid', annot['aid'])
+    return ('id', id(annot))
+
+
+def _portable_annot(annot, cfgdict):
+    """ The evaluated annotation values a worker needs to run the pipeline """
+    weight_key, = PairwiseMatch._take_params(cfgdict, ['weight'])
+    if isinstance(annot, ut.LazyDict):
+        stored = annot._stored_results
+    else:
+        stored = annot
+    keys = [key for key in _BATCH_PIPELINE_KEYS + [weight_key]
+            if key is not None and key in stored]
+    if not all(key in stored for key in ['kpts', 'vecs', 'dlen_sqrd']):
+        # The worker has to compute the features from the chip
+        for key in _BATCH_SOURCE_KEYS:
+            if key in stored:
+                keys.append(key)
+                break
+        if 'feat_store' in stored:
+            keys.append('feat_store')
+    return {key: stored[key] for key in keys}
+
+
+def _prepare_batch_annot(annot, cfgdict, need_flann):
+    """ Computes the features (and index) of an annotation once """
+    ensure_metadata_feats(annot, cfgdict=cfgdict)
+    ensure_metadata_kpts_geom(annot)
+    annot['kpts_geom']
+    annot['vecs']
+    if need_flann:
+        ensure_metadata_flann(annot, cfgdict=cfgdict)
+        annot['flann']
+    return annot
+
+
+def _update_batch_cache(cache, new_items, task, max_size):
+    """
+    Adds the annotations sent with a task to a worker cache, marks the
+    annotations of its pairs as used, and evicts the least recently used.
+
+    The parent runs this on a model of each worker cache (in the order the
+    tasks are submitted) to know which annotations a worker already has.
+    """
+    for annotx, item in new_items:
+        cache[annotx] = item
+    for _, annotx1, annotx2 in task:
+        cache.move_to_end(annotx1)
+        cache.move_to_end(annotx2)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+def _init_batch_worker(threads_per_worker, cache_size):
+    import collections
+    from vtool_ibeis import sver_pool
+    sver_pool._init_sver_worker(threads_per_worker)
+    _BATCH_WORKER_STATE['annots'] = collections.OrderedDict()
+    _BATCH_WORKER_STATE['cache_size'] = cache_size
+
+
+def _batch_worker_task(task, payloads, cfgdict):
+    """
+    Applies the pipeline to a chunk of pairs in a worker process. payloads
+    holds the annotations of the chunk this worker does not have yet.
+    """
+    annots = _BATCH_WORKER_STATE['annots']
+    new_items = [(annotx, ut.LazyDict(payload))
+                 for annotx, payload in payloads]
+    # Eviction happens after the task, so every annotation of it is kept
+    for annotx, annot in new_items:
+        annots[annotx] = annot
+    result_list = []
+    for pairx, annotx1, annotx2 in task:
+        match = PairwiseMatch(annots[annotx1], annots[annotx2])
+        match.apply_all(cfgdict)
+        # The parent already has the annotations
+        state = match.__getstate__()
+        del state['annot1'], state['annot2']
+        result_list.append((pairx, state))
+    _update_batch_cache(annots, new_items, task,
+                        _BATCH_WORKER_STATE['cache_size'])
+    return result_list
+
+
+def apply_all_batch(matches, cfgdict={}, executor='thread', n_workers=None,
+                    chunksize=16, threads_per_worker=1):
+    """
+    Runs PairwiseMatch.apply_all on many pairs in a pool of workers.
+
+    Annotations shared between pairs are only prepared once. Annotations with
+    the same aid (or the same object if there is no aid) are considered to
+    be shared.
+
+    * 'thread': the features and flann index of each annotation are computed
+      once up front, then the pairs are matched in threads.
+
+    * 'process': pairs are sorted by annotation and chunked, so a chunk
+      shares its annotations. Each worker is its own process, and the
+      evaluated annotation values the pipeline reads (aid, kpts, vecs,
+      dlen_sqrd and the weight key, or rchip_fpath / rchip if the features
+      still have to be computed) are sent with the first chunk that needs
+      them in that worker. A worker keeps the BATCH_WORKER_CACHE_SIZE most
+      recently used annotations (with their features and index), and the
+      parent tracks which ones so they are not sent again. A chunk goes to
+      the least busy worker and at most 2 chunks per worker are in flight.
+
+    * 'serial': apply_all in a loop.
+
+    Args:
+        matches (list): PairwiseMatch objects. Like apply_all they are
+            updated in place.
+        cfgdict (dict): pipeline config
+        executor (str): 'thread', 'process', or 'serial'
+        n_workers (int): number of workers (defaults to cpu count)
+        chunksize (int): number of pairs sent to a process at once
+        threads_per_worker (int): number of cv2 / BLAS threads of a process
+
+    Yields:
+        PairwiseMatch: the matches in the order they finish
+
+    CommandLine:
+        python -m vtool_ibeis.matching apply_all_batch
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> # xdoctest: +REQUIRES(module:pyflann_ibeis)
+        >>> from vtool_ibeis.matching import *  # NOQA
+        >>> import vtool_ibeis as vt
+        >>> kpts1, kpts2 = vt.demodata.testdata_sver_pair(100, seed=0)[0:2]
+        >>> kpts3 = vt.demodata.perterb_kpts(kpts1, xy_std=(1, 1), seed=1)
+        >>> rng = np.random.RandomState(0)
+        >>> vecs = rng.randint(0, 200, (100, 128))
+        >>> annots = []
+        >>> for aid, kpts in enumerate([kpts1, kpts2, kpts3]):
+        >>>     noise = rng.randint(0, 40, vecs.shape)
+        >>>     annots.append({'aid': aid, 'kpts': kpts,
+        >>>                    'vecs': (vecs + noise).astype(np.uint8),
+        >>>                    'dlen_sqrd': 300 ** 2})
+        >>> cfgdict = {'checks': 800}
+        >>> # The chip is not sent to workers once the features exist
+        >>> payload = _portable_annot(dict(annots[0], rchip=None), cfgdict)
+        >>> assert sorted(payload) == ['aid', 'dlen_sqrd', 'kpts', 'vecs']
+        >>> def _pairs():
+        >>>     return [PairwiseMatch(annots[aid1], annots[aid2])
+        >>>             for aid1, aid2 in [(0, 1), (0, 2), (1, 2), (2, 0)]]
+        >>> expected = _pairs()
+        >>> for match in expected:
+        >>>     match.apply_all(cfgdict)
+        >>> for executor in ['thread', 'process']:
+        >>>     matches = _pairs()
+        >>>     done = list(apply_all_batch(matches, cfgdict, executor, n_workers=2))
+        >>>     assert len(done) == len(matches)
+        >>>     for match, match_ in zip(expected, matches):
+        >>>         assert np.all(match.fm == match_.fm)
+        >>>         assert np.all(match.fm_norm1 == match_.fm_norm1)
+        >>>         assert np.allclose(match.H_12, match_.H_12)
+        >>> # Annotations evicted from a worker cache are sent again
+        >>> import vtool_ibeis.matching as matching
+        >>> old_size = matching.BATCH_WORKER_CACHE_SIZE
+        >>> matching.BATCH_WORKER_CACHE_SIZE = 1
+        >>> matches = _pairs()
+        >>> done = list(apply_all_batch(matches, cfgdict, 'process',
+        >>>                             n_workers=1, chunksize=1))
+        >>> matching.BATCH_WORKER_CACHE_SIZE = old_size
+        >>> assert all(np.all(m.fm == m_.fm) for m, m_ in zip(expected, matches))
+        >>> print(matches[0])
+        <PairwiseMatch(0-vs-1 100)>
+    """
+    from concurrent import futures
+    import multiprocessing
+    matches = list(matches)
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    symmetric, = PairwiseMatch._take_params(cfgdict, ['symmetric'])
+
+    # Find the annotations shared between pairs
+    key_to_annotx = {}
+    unique_annots = []
+    pair_annotxs = []
+    for match in matches:
+        annotxs = []
+        for annot in (match.annot1, match.annot2):
+            key = _annot_batch_key(annot)
+            if key not in key_to_annotx:
+                key_to_annotx[key] = len(unique_annots)
+                unique_annots.append(annot)
+            annotxs.append(key_to_annotx[key])
+        pair_annotxs.append(annotxs)
+
+    if executor == 'serial':
+        for match in matches:
+            match.apply_all(cfgdict)
+            yield match
+    elif executor == 'thread':
+        need_flann = np.zeros(len(unique_annots), dtype=bool)
+        for annotx1, annotx2 in pair_annotxs:
+            need_flann[annotx1] = True
+            need_flann[annotx2] |= symmetric
+        with futures.ThreadPoolExecutor(max_workers=n_workers) as pool:
+            list(pool.map(_prepare_batch_annot, unique_annots,
+                          [cfgdict] * len(unique_annots), need_flann))
+            # Pairs with the same aid use the same prepared annotation
+            for match, (annotx1, annotx2) in zip(matches, pair_annotxs):
+                match.annot1 = unique_annots[annotx1]
+                match.annot2 = unique_annots[annotx2]
+            future_to_match = {pool.submit(match.apply_all, cfgdict): match
+                               for match in matches}
+            for future in futures.as_completed(future_to_match):
+                future.result()
+                yield future_to_match[future]
+    elif executor == 'process':
+        import collections
+        import contextlib
+        n_workers = max(n_workers, 1)
+        cache_size = BATCH_WORKER_CACHE_SIZE
+        mp_context = multiprocessing.get_context('spawn')
+        # Chunks of pairs that share annotations
+        pairxs = sorted(range(len(matches)), key=lambda x: pair_annotxs[x])
+        task_iter = (
+            [(pairx,) + tuple(pair_annotxs[pairx])
+             for pairx in pairxs[start:start + chunksize]]
+            for start in range(0, len(pairxs), chunksize)
+        )
+        # Models of the annotations cached by each worker
+        worker_caches = [collections.OrderedDict() for _ in range(n_workers)]
+        num_in_flight = np.zeros(n_workers, dtype=int)
+        future_to_workerx = {}
+
+        def _submit_next(pools):
+            for task in task_iter:
+                workerx = int(num_in_flight.argmin())
+                cache = worker_caches[workerx]
+                new_annotxs = list(ub.unique(
+                    annotx for _, annotx1, annotx2 in task
+                    for annotx in (annotx1, annotx2) if annotx not in cache))
+                payloads = [(annotx, _portable_annot(unique_annots[annotx],
+                                                     cfgdict))
+                            for annotx in new_annotxs]
+                _update_batch_cache(
+                    cache, [(annotx, None) for annotx in new_annotxs], task,
+                    cache_size)
+                future = pools[workerx].submit(_batch_worker_task, task,
+                                               payloads, cfgdict)
+                future_to_workerx[future] = workerx
+                num_in_flight[workerx] += 1
+                return True
+            return False
+
+        with contextlib.ExitStack() as stack:
+            pools = [
+                stack.enter_context(futures.ProcessPoolExecutor(
+                    max_workers=1, mp_context=mp_context,
+                    initializer=_init_batch_worker,
+                    initargs=(threads_per_worker, cache_size)))
+                for _ in range(n_workers)
+            ]
+            while num_in_flight.sum() < 2 * n_workers and _submit_next(pools):
+                pass
+            while future_to_workerx:
+                done, _ = futures.wait(list(future_to_workerx.keys()),
+                                       return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    num_in_flight[future_to_workerx.pop(future)] -= 1
+                    for pairx, state in future.result():
+                        match = matches[pairx]
+                        match.__dict__.update(state)
+                        yield match
+                    # Keep the workers busy
+                    _submit_next(pools)
+    else:
+        raise KeyError('Unknown executor=%r' % (executor,))
+
+
+def _prefetch_annot(annot, keys):
+    for key in keys:
+        if key in annot:
+            annot[key]
+
+
+def prefetch_matches(matches, cfgdict={}, lookahead=8, n_workers=2,
+                     keys=('kpts', 'vecs')):
+    """
+    Iterates over matches while the chips and features of the next pairs
+    are loaded on a background thread pool.
+
+    The lazy values in `keys` of the annotations of up to `lookahead`
+    upcoming pairs are evaluated by the pool (e.g. reading the chip and
+    extracting or loading features), and a match is only yielded once its
+    annotations are ready, so `apply_all` does not wait on disk I/O.
+
+    Like `apply_all_batch`, pairs in the window that refer to the same aid
+    are given the same annotation object.
+
+    Args:
+        matches (iterable): PairwiseMatch objects in the order to process
+        cfgdict (dict): pipeline config used to set up the lazy annot values
+        lookahead (int): maximum number of pairs prefetched ahead
+        n_workers (int): number of threads
+        keys (tuple): annot keys to evaluate (e.g. add 'flann' to also build
+            the indexes in the background)
+
+    Yields:
+        PairwiseMatch: the matches in their original order
+
+    CommandLine:
+        python -m vtool_ibeis.matching prefetch_matches
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> # xdoctest: +REQUIRES(module:pyhesaff)
+        >>> from vtool_ibeis.matching import *  # NOQA
+        >>> import vtool_ibeis as vt
+        >>> dpath = ub.Path.appdir('vtool_ibeis', 'tests', 'prefetch').ensuredir()
+        >>> annots = []
+        >>> for aid in range(3):
+        >>>     kpts = vt.demodata.get_dummy_kpts_pair((100, 100))[0]
+        >>>     fpath = dpath / 'chip{}.png'.format(aid)
+        >>>     vt.imwrite(fpath, vt.demodata.get_kpts_dummy_img(kpts))
+        >>>     annots.append({'aid': aid, 'rchip_fpath': fpath})
+        >>> matches = [PairwiseMatch(annots[aid1], annots[aid2])
+        >>>            for aid1, aid2 in [(0, 1), (1, 2), (2, 0)]]
+        >>> for match in prefetch_matches(matches, lookahead=2):
+        >>>     assert 'vecs' in match.annot1.stored_keys()
+        >>>     assert 'vecs' in match.annot2.stored_keys()
+        >>>     match.apply_all({})
+        >>> # Annotations with the same aid are shared
+        >>> assert matches[0].annot2 is matches[1].annot1
+    """
+    import collections
+    from concurrent import futures
+    matches = iter(matches)
+    # Annotations and loads of the pairs in the window
+    key_to_annot = {}
+    key_to_future = {}
+    key_to_count = collections.Counter()
+    window = collections.deque()
+
+    def _schedule(pool, match):
+        for attr in ['annot1', 'annot2']:
+            annot = getattr(match, attr)
+            akey = _annot_batch_key(annot)
+            if akey in key_to_annot:
+                setattr(match, attr, key_to_annot[akey])
+            else:
+                key_to_annot[akey] = annot
+            key_to_count[akey] += 1
+        ensure_metadata_vsone(match.annot1, match.annot2, cfgdict)
+        akeys = []
+        for annot in [match.annot1, match.annot2]:
+            akey = _annot_batch_key(annot)
+            if akey not in key_to_future:
+                key_to_future[akey] = pool.submit(_prefetch_annot, annot,
+                                                  keys)
+            akeys.append(akey)
+        window.append((match, akeys))
+
+    pool = futures.ThreadPoolExecutor(max_workers=n_workers)
+    try:
+        for match in matches:
+            _schedule(pool, match)
+            if len(window) > lookahead:
+                break
+        while window:
+            match, akeys = window.popleft()
+            for akey in akeys:
+                # Reraises errors of the load
+                key_to_future[akey].result()
+            for akey in akeys:
+                key_to_count[akey] -= 1
+                if key_to_count[akey] == 0:
+                    del key_to_count[akey]
+                    del key_to_annot[akey]
+                    del key_to_future[akey]
+            # Keep the window full while the match is processed
+            for next_match in matches:
+                _schedule(pool, next_match)
+                break
+            yield match
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _nbytes(val, _seen=None):
+    """
+    Approximate number of bytes of memory held by an annotation value.
+    Memory mapped arrays are not counted and shared arrays count once.
+    """
+    if _seen is None:
+        _seen = set()
+    if id(val) in _seen:
+        return 0
+    _seen.add(id(val))
+    if isinstance(val, np.memmap):
+        return 0
+    if isinstance(val, np.ndarray):
+        if isinstance(val.base, np.memmap):
+            return 0
+        return val.nbytes
+    if isinstance(val, (tuple, list)):
+        return sum(_nbytes(item, _seen) for item in val)
+    if hasattr(val, 'used_memory'):
+        # A flann index
+        try:
+            return int(val.used_memory())
+        except Exception:
+            return 0
+    if hasattr(val, '__dict__') and not isinstance(val, type):
+        return sum(_nbytes(item, _seen) for item in val.__dict__.values()
+                   if isinstance(item, np.ndarray))
+    return 0
+
+
+class AnnotCache(ub.NiceRepr):
+    """
+    Memory bounded LRU cache of lazy annotations shared by PairwiseMatch
+    objects.
+
+    Annotations are registered by id with their base data (e.g.
+    `rchip_fpath`, or `kpts` and `vecs`). Every lookup of an id returns the
+    same `ut.LazyDict`, so rchips, features and flann indexes computed by one
+    match are reused by all others. The bytes held by cached arrays and flann
+    indexes are tracked, and least recently used annotations are dropped once
+    the total exceeds `max_bytes`. An evicted annotation is rebuilt from its
+    base data on the next lookup (matches that still reference it keep it
+    alive).
+
+    Sizes are measured when an annotation is looked up, and the annotation
+    handed out last is remeasured on the next lookup, because its values are
+    computed after it is handed out. Use `enforce` to remeasure everything.
+
+    Args:
+        max_bytes (int): memory cap of the cache
+        loader (func): optional function of an id that returns the base data
+            of annotations that were not registered
+
+    CommandLine:
+        python -m vtool_ibeis.matching AnnotCache
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.matching import *  # NOQA
+        >>> import vtool_ibeis as vt
+        >>> rng = np.random.RandomState(0)
+        >>> def loader(aid):
+        >>>     kpts = vt.demodata.perterbed_grid_kpts(seed=aid, wh_num=(10, 10))
+        >>>     vecs = rng.randint(0, 255, (100, 128)).astype(np.uint8)
+        >>>     return {'kpts': kpts, 'vecs': vecs}
+        >>> # Room for a little more than 2 annotations
+        >>> cache = AnnotCache(max_bytes=35000, loader=loader)
+        >>> annot = cache[1]
+        >>> assert cache[1] is annot
+        >>> assert cache.match(1, 2).annot1 is annot
+        >>> cache[3]
+        >>> print(ut.repr2(cache.stats(), sorted_=True))
+        {'evictions': 1, 'hits': 2, 'misses': 3, 'nbytes': 30400, 'num_entries': 2}
+        >>> assert 1 not in cache and 3 in cache
+    """
+
+    def __init__(cache, max_bytes=2 ** 31, loader=None):
+        import collections
+        cache.max_bytes = max_bytes
+        cache.loader = loader
+        cache._sources = {}
+        cache._entries = collections.OrderedDict()
+        cache._sizes = {}
+        cache._last = None
+        cache.hits = 0
+        cache.misses = 0
+        cache.evictions = 0
+
+    def __nice__(cache):
+        return 'num_entries=%d, nbytes=%d' % (len(cache._entries),
+                                             sum(cache._sizes.values()))
+
+    def __contains__(cache, aid):
+        return aid in cache._entries
+
+    def __len__(cache):
+        return len(cache._entries)
+
+    def register(cache, aid, annot):
+        """ Adds the base data of an annotation """
+        cache._sources[aid] = dict(annot)
+        cache.discard(aid)
+
+    def discard(cache, aid):
+        """ Drops the cached values of an annotation """
+        cache._entries.pop(aid, None)
+        cache._sizes.pop(aid, None)
+
+    def _measure(cache, aid):
+        annot = cache._entries[aid]
+        cache._sizes[aid] = sum(
+            _nbytes(annot._stored_results[key])
+            for key in annot.stored_keys())
+
+    def __getitem__(cache, aid):
+        if aid in cache._entries:
+            cache.hits += 1
+            cache._entries.move_to_end(aid)
+        else:
+            cache.misses += 1
+            if aid not in cache._sources:
+                if cache.loader is None:
+                    raise KeyError('Unknown annotation aid=%r' % (aid,))
+                cache._sources[aid] = dict(cache.loader(aid))
+            annot = ut.LazyDict(cache._sources[aid])
+            annot['aid'] = aid
+            cache._entries[aid] = annot
+        if cache._last is not None and cache._last in cache._entries:
+            cache._measure(cache._last)
+        cache._measure(aid)
+        cache._last = aid
+        cache._evict(keep=aid)
+        return cache._entries[aid]
+
+    def _evict(cache, keep=None):
+        total = sum(cache._sizes.values())
+        for aid in list(cache._entries.keys()):
+            if total <= cache.max_bytes:
+                break
+            if aid == keep:
+                continue
+            total -= cache._sizes.pop(aid, 0)
+            del cache._entries[aid]
+            cache.evictions += 1
+
+    def enforce(cache):
+        """ Remeasures all annotations and evicts past the memory cap """
+        for aid in cache._entries.keys():
+            cache._measure(aid)
+        cache._evict(keep=cache._last)
+
+    def match(cache, aid1, aid2):
+        """ Returns a PairwiseMatch of two cached annotations """
+        return PairwiseMatch(cache[aid1], cache[aid2])
+
+    def stats(cache):
+        """
+        Returns:
+            dict: hits, misses, evictions, nbytes and num_entries
+        """
+        return {
+            'hits': cache.hits,
+            'misses': cache.misses,
+            'evictions': cache.evictions,
+            'nbytes': sum(cache._sizes.values()),
+            'num_entries': len(cache._entries),
+        }
+
+
+# Format version of save_matches containers
+_SAVED_MATCHES_VERSION = 1
+
+
+def save_matches(matches, dpath):
+    """
+    Writes many matches into one columnar container.
+
+    The fm, fs and local measures of all matches are concatenated into single
+    arrays and an offsets array marks where each match starts. Global
+    measures, homographies and aids are stored as tables with a row per
+    match. Columns are `.npy` files so `load_matches` can memory map them.
+    Columns that numpy cannot store as a regular array (e.g. global measures
+    that contain None) are pickled together in `objects.pkl`.
+
+    Like `__getstate__` only the aids of the annotations are saved.
+
+    Args:
+        matches (list): PairwiseMatch objects
+        dpath (str): directory of the container
+
+    Returns:
+        ub.Path: dpath
+
+    CommandLine:
+        python -m vtool_ibeis.matching save_matches
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.matching import *  # NOQA
+        >>> import vtool_ibeis as vt
+        >>> matches = []
+        >>> for seed in range(3):
+        >>>     kpts1, kpts2, fm, fs = vt.demodata.testdata_sver_pair(10 * seed, seed=seed)
+        >>>     match = PairwiseMatch({'aid': seed, 'kpts': kpts1},
+        >>>                           {'aid': seed + 1, 'kpts': kpts2})
+        >>>     match.fm, match.fs = fm, fs
+        >>>     match.local_measures['ratio'] = fs / 2
+        >>>     match.global_measures['yaw'] = (seed, None)
+        >>>     matches.append(match)
+        >>> matches[0].H_12 = np.eye(3)
+        >>> matches.append(PairwiseMatch({'aid': 5}, {'aid': 6}))
+        >>> # A match without scores does not shift the scores of later matches
+        >>> matches[1].fs = None
+        >>> dpath = ub.Path.appdir('vtool_ibeis', 'tests', 'saved_matches').delete()
+        >>> save_matches(matches, dpath)
+        >>> views = load_matches(dpath)
+        >>> for view in views:
+        >>>     print(view)
+        <MatchView(0-vs-1 0)>
+        <MatchView(1-vs-2 10)>
+        <MatchView(2-vs-3 20)>
+        <MatchView(5-vs-6 None)>
+        >>> view = views[2]
+        >>> assert views[1].fs is None and np.all(view.fs == matches[2].fs)
+        >>> assert np.all(view.fm == matches[2].fm)
+        >>> assert np.all(view.local_measures['ratio'] == matches[2].fs / 2)
+        >>> assert view.global_measures['yaw'] == (2, None)
+        >>> assert view.H_12 is None and np.all(views[0].H_12 == np.eye(3))
+        >>> # Views behave like matches
+        >>> print(view.compress(view.fs > .5))
+        <PairwiseMatch(2-vs-3 11)>
+        >>> # Containers of other versions are rejected
+        >>> import json
+        >>> meta = json.loads((dpath / 'meta.json').read_text())
+        >>> (dpath / 'meta.json').write_text(json.dumps(dict(meta, version=2)))
+        >>> ut.assert_raises(IOError, load_matches, dpath)
+    """
+    import json
+    import pickle
+    dpath = ub.Path(dpath).ensuredir()
+    meta_fpath = dpath / 'meta.json'
+    # The meta file is written last and marks a complete container
+    if meta_fpath.exists():
+        meta_fpath.delete()
+    matches = list(matches)
+    num = len(matches)
+
+    has_fm = np.array([match.fm is not None for match in matches], dtype=bool)
+    has_fs = np.array([match.fs is not None for match in matches], dtype=bool)
+    lens = [0 if match.fm is None else len(match.fm) for match in matches]
+    offsets = np.zeros(num + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lens)
+
+    def _concat(parts, empty):
+        parts = [part for part in parts if part is not None]
+        return np.concatenate(parts, axis=0) if parts else empty
+
+    arrays = ub.odict([])
+    objects = {}
+    arrays['offsets'] = offsets
+    arrays['has_fm'] = has_fm
+    arrays['has_fs'] = has_fs
+    arrays['fm'] = _concat([match.fm for match in matches],
+                           np.empty((0, 2), dtype=np.int64))
+    # Missing scores are filled so every match stays aligned with offsets
+    arrays['fs'] = _concat([
+        np.full(len_, np.nan) if match.fs is None else match.fs
+        for match, len_ in zip(matches, lens)],
+        np.empty(0, dtype=np.float64))
+
+    local_keys = list(ub.unique(key for match in matches
+                                for key in match.local_measures.keys()))
+    global_keys = list(ub.unique(key for match in matches
+                                 for key in match.global_measures.keys()))
+    arrays['local_flags'] = np.array([
+        [key in match.local_measures for key in local_keys]
+        for match in matches], dtype=bool).reshape(num, len(local_keys))
+    arrays['global_flags'] = np.array([
+        [key in match.global_measures for key in global_keys]
+        for match in matches], dtype=bool).reshape(num, len(global_keys))
+    for kx, key in enumerate(local_keys):
+        arrays['local_%d' % (kx,)] = _concat([
+            match.local_measures.get(key, np.full(len_, np.nan))
+            for match, len_ in zip(matches, lens)],
+            np.empty(0, dtype=np.float64))
+
+    for attr in ['H_12', 'H_21']:
+        H_stack = np.full((num, 3, 3), np.nan)
+        for index, match in enumerate(matches):
+            if getattr(match, attr) is not None:
+                H_stack[index] = getattr(match, attr)
+        arrays[attr] = H_stack
+
+    def _add_column(name, values):
+        try:
+            column = np.asarray(values)
+        except ValueError:
+            # ragged values
+            column = None
+        if column is None or column.dtype.kind == 'O':
+            objects[name] = values
+        else:
+            arrays[name] = column
+
+    _add_column('aid1', [match.annot1.get('aid', None) for match in matches])
+    _add_column('aid2', [match.annot2.get('aid', None) for match in matches])
+    for gx, key in enumerate(global_keys):
+        _add_column('global_%d' % (gx,), [
+            match.global_measures.get(key, None) for match in matches])
+
+    for name, column in arrays.items():
+        np.save(dpath / (name + '.npy'), np.ascontiguousarray(column))
+    with open(dpath / 'objects.pkl', 'wb') as file_:
+        pickle.dump(objects, file_, protocol=pickle.HIGHEST_PROTOCOL)
+    meta = {
+        'version': _SAVED_MATCHES_VERSION,
+        'num_matches': num,
+        'local_keys': local_keys,
+        'global_keys': global_keys,
+        'object_columns': sorted(objects.keys()),
+    }
+    with open(meta_fpath, 'w') as file_:
+        json.dump(meta, file_)
+    return dpath
+
+
+def load_matches(dpath):
+    """
+    Loads matches written by `save_matches` as lightweight `MatchView`
+    objects. The columns are memory mapped and each view only reads its rows
+    when an attribute is first accessed.
+
+    Args:
+        dpath (str): directory of the container
+
+    Returns:
+        list: MatchView objects
+    """
+    columns = _MatchColumns(dpath)
+    return [MatchView(columns, index) for index in range(columns.num)]
+
+
+class _MatchColumns(object):
+    """
+    Lazily memory mapped columns of a `save_matches` container
+    """
+
+    def __init__(columns, dpath):
+        import json
+        columns.dpath = ub.Path(dpath)
+        meta_fpath = columns.dpath / 'meta.json'
+        if not meta_fpath.exists():
+            raise IOError('No saved matches in %s' % (columns.dpath,))
+        with open(meta_fpath, 'r') as file_:
+            columns.meta = json.load(file_)
+        if columns.meta.get('version') != _SAVED_MATCHES_VERSION:
+            raise IOError('Unknown saved matches version %r in %s' % (
+                columns.meta.get('version'), columns.dpath))
+        columns.num = columns.meta['num_matches']
+        columns._arrays = {}
+        columns._objects = None
+
+    def column(columns, name):
+        if name in columns.meta['object_columns']:
+            if columns._objects is None:
+                import pickle
+                with open(columns.dpath / 'objects.pkl', 'rb') as file_:
+                    columns._objects = pickle.load(file_)
+            return columns._objects[name]
+        if name not in columns._arrays:
+            columns._arrays[name] = np.load(columns.dpath / (name + '.npy'),
+                                            mmap_mode='r')
+        return columns._arrays[name]
+
+    def _row(columns, name, index):
+        value = columns.column(name)[index]
+        if isinstance(value, np.ndarray):
+            # Stacked tuples such as global measures of both annots
+            value = tuple(np.array(value))
+        return value
+
+    def materialize(columns, index, attr):
+        """ Returns the value of an attribute of a match """
+        if attr in {'annot1', 'annot2'}:
+            aid = columns.column('aid' + attr[-1])[index]
+            if isinstance(aid, np.generic):
+                aid = aid.item()
+            return ut.LazyDict({} if aid is None else {'aid': aid})
+        if attr in {'H_12', 'H_21'}:
+            H = np.array(columns.column(attr)[index])
+            return None if np.any(np.isnan(H)) else H
+        offsets = columns.column('offsets')
+        sl = slice(offsets[index], offsets[index + 1])
+        if attr in {'fm', 'fs'}:
+            if not columns.column('has_' + attr)[index]:
+                return None
+            return np.asarray(columns.column(attr)[sl])
+        if attr == 'local_measures':
+            flags = columns.column('local_flags')[index]
+            return ub.odict([
+                (key, np.asarray(columns.column('local_%d' % (kx,))[sl]))
+                for kx, key in enumerate(columns.meta['local_keys'])
+                if flags[kx]
+            ])
+        if attr == 'global_measures':
+            flags = columns.column('global_flags')[index]
+            return ub.odict([
+                (key, columns._row('global_%d' % (gx,), index))
+                for gx, key in enumerate(columns.meta['global_keys'])
+                if flags[gx]
+            ])
+        raise KeyError(attr)
+
+
+_MATCH_VIEW_ATTRS = {'annot1', 'annot2', 'fm', 'fs', 'H_12', 'H_21',
+                     'local_measures', 'global_measures'}
+
+
+class MatchView(PairwiseMatch):
+    """
+    A PairwiseMatch backed by a `save_matches` container.
+
+    The arrays of a view are read from the memory mapped columns the first
+    time they are accessed, so loading many matches is cheap. Arrays are read
+    only views into the columns. Operations that create a new match (e.g.
+    compress) return a regular PairwiseMatch, and so does pickling a view.
+    """
+
+    def __init__(view, columns, index):
+        view._columns = columns
+        view._index = index
+        view.verbose = False
+        view._inplace_default = False
+
+    def __getattr__(view, attr):
+        # Only called for attributes that are not set yet
+        if attr not in _MATCH_VIEW_ATTRS or '_columns' not in view.__dict__:
+            raise AttributeError(attr)
+        value = view._columns.materialize(view._index, attr)
+        setattr(view, attr, value)
+        return value
+
+    def __reduce__(view):
+        return (PairwiseMatch, (), view.__getstate__())
+
+    def _next_instance(view, inplace=None):
+        if inplace is None:
+            inplace = view._inplace_default
+        if inplace:
+            return view
+        match_ = PairwiseMatch(view.annot1, view.annot2)
+        match_.H_21 = view.H_21
+        match_.H_12 = view.H_12
+        match_._inplace_default = view._inplace_default
+        match_.global_measures = view.global_measures.copy()
+        return match_
+
+
 def invsum(x):
     return np.sum(1 / x)
 
@@ -1404,6 +2648,294 @@ class AnnotPairFeatInfo(object):
         # print(infostr)
 
 
+def _grouped_summary(opname, vals, offsets):
+    """
+    Summary op of each group of concatenated values
+
+    Args:
+        opname (str): key of SUM_OPS
+        vals (ndarray): concatenated float values of all groups
+        offsets (ndarray): start of each group and the end of the last group
+    """
+    lens = np.diff(offsets)
+    num = len(lens)
+    nonempty = lens > 0
+    starts = offsets[:-1][nonempty]
+
+    def _sum(x):
+        # reduceat only over nonempty groups, so each group ends at the start
+        # of the next one
+        sums = np.zeros(num, dtype=np.float64)
+        if len(starts):
+            sums[nonempty] = np.add.reduceat(x, starts)
+        return sums
+
+    if opname == 'sum':
+        return _sum(vals)
+    if opname == 'invsum':
+        return _sum(1 / vals)
+    means = _sum(vals) / lens
+    if opname == 'mean':
+        return means
+    if opname == 'std':
+        devs = vals - np.repeat(means, lens)
+        return np.sqrt(_sum(devs ** 2) / lens)
+    if opname == 'med':
+        group_ids = np.repeat(np.arange(num), lens)
+        sorted_vals = vals[np.lexsort((vals, group_ids))]
+        meds = np.full(num, np.nan)
+        lo = starts + (lens[nonempty] - 1) // 2
+        hi = starts + lens[nonempty] // 2
+        meds[nonempty] = (sorted_vals[lo] + sorted_vals[hi]) / 2
+        # np.median is nan if any value is nan
+        meds[_sum(np.isnan(vals)) > 0] = np.nan
+        return meds
+    raise KeyError('Unknown summary op %r' % (opname,))
+
+
+def make_feature_matrix(matches, local_keys=None, global_keys=None,
+                        summary_ops=None, sorters='ratio', indices=3,
+                        bin_key=None, bins=None, index=None, return_df=True):
+    """
+    Constructs the pairwise feature vectors of many matches at once.
+
+    Computes the same dimensions as `PairwiseMatch.make_feature_vector`, but
+    the column schema is built once and each dimension is computed for all
+    matches with grouped reductions over the concatenated local measures.
+
+    Unlike `make_feature_vector` the schema does not depend on the match.
+    Missing measures and ranks past the number of feature matches are nan,
+    integer `indices` give ranks `range(indices)`, and the length of
+    iterable global measures is taken from the first value that is not None.
+
+    Args:
+        matches (list): PairwiseMatch objects
+        local_keys (list): local measures (default is all measures)
+        global_keys (list): global measures (default is all measures)
+        summary_ops (set): see `_make_local_summary_feature_vector`
+        sorters (str | list): see `_make_local_top_feature_vector`
+        indices (int | slice | list): see `_make_local_top_feature_vector`
+        bin_key (str): local measure used to bin the summaries
+        bins (int | list): bin values
+        index (pd.Index): index of the returned DataFrame
+        return_df (bool): if False returns the matrix and its featinfo
+
+    Returns:
+        pd.DataFrame | Tuple[ndarray, AnnotPairFeatInfo]: float32 features
+
+    CommandLine:
+        python -m vtool_ibeis.matching make_feature_matrix
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.matching import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> matches = []
+        >>> for num in [0, 3, 20]:
+        >>>     match = PairwiseMatch({}, {})
+        >>>     match.fm = rng.randint(0, 100, (num, 2))
+        >>>     match.fs = rng.rand(num)
+        >>>     match.local_measures['ratio'] = rng.rand(num)
+        >>>     match.local_measures['norm_dist'] = rng.rand(num)
+        >>>     match.global_measures['time'] = tuple(rng.rand(2))
+        >>>     match.global_measures['gps'] = tuple(rng.rand(2, 2))
+        >>>     matches.append(match)
+        >>> kw = dict(summary_ops='all', bin_key='ratio', bins=[.5, .8])
+        >>> X = make_feature_matrix(matches, **kw)
+        >>> print(X.shape)
+        (3, 37)
+        >>> X_ = pd.DataFrame([m.make_feature_vector(**kw) for m in matches[1:]])
+        >>> assert np.allclose(X.iloc[2][X_.columns], X_.iloc[1], rtol=1e-5)
+        >>> assert np.allclose(X.iloc[1][X_.columns], X_.iloc[0], equal_nan=True)
+    """
+    import vtool_ibeis as vt
+    if summary_ops is None:
+        summary_ops = {'sum', 'mean', 'std', 'len'}
+    if summary_ops == 'all':
+        summary_ops = set(SUM_OPS.keys()).union({'len'})
+    summary_ops = set(summary_ops)
+    sorters = ut.ensure_iterable(sorters)
+    matches = list(matches)
+    num = len(matches)
+
+    if local_keys is None:
+        local_keys = list(ub.unique(key for match in matches
+                                    for key in match.local_measures.keys()))
+    if global_keys is None:
+        global_keys = sorted(set(key for match in matches
+                                 for key in match.global_measures.keys()))
+    lens = np.array([len(match) for match in matches], dtype=np.int64)
+    offsets = np.zeros(num + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lens)
+
+    def _concat_local(key):
+        parts = [match.local_measures.get(key, None) for match in matches]
+        parts = [np.full(len_, np.nan) if part is None else part
+                 for part, len_ in zip(parts, lens)]
+        if num == 0:
+            return np.empty(0, dtype=np.float64)
+        return np.concatenate(parts).astype(np.float64)
+
+    # The columns are computed in the order of make_feature_vector
+    columns = []
+    values = []
+
+    def _add(column, vals):
+        columns.append(column)
+        values.append(vals)
+
+    def _global_vals(key):
+        raw = [match.global_measures.get(key, (None, None))
+               for match in matches]
+        dims = None
+        for v1, v2 in raw:
+            for v in [v1, v2]:
+                if v is not None:
+                    dims = len(v) if ut.isiterable(v) else 0
+                    break
+            if dims is not None:
+                break
+        dims = 0 if dims is None else dims
+        shape = (num, dims) if dims else (num,)
+        vals1 = np.full(shape, np.nan)
+        vals2 = np.full(shape, np.nan)
+        for mx, (v1, v2) in enumerate(raw):
+            if v1 is not None:
+                vals1[mx] = v1
+            if v2 is not None:
+                vals2[mx] = v2
+        return dims, vals1, vals2
+
+    with warnings.catch_warnings(), np.errstate(all='ignore'):
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+
+        # Global features (see _make_global_feature_vector)
+        gfeat = {}
+        for key in global_keys:
+            assert key != 'yaw', 'yaw is depricated'
+            dims, vals1, vals2 = _global_vals(key)
+            if dims:
+                for i in range(dims):
+                    _add('global({}_1[{}])'.format(key, i), vals1[:, i])
+                    _add('global({}_2[{}])'.format(key, i), vals2[:, i])
+                if key == 'gps':
+                    delta = vt.haversine(vals1.T, vals2.T)
+                elif dims == 1:
+                    delta = np.abs(vals1 - vals2)[:, 0]
+                else:
+                    raise ValueError(
+                        'Cannot make a delta of global measure %r' % (key,))
+            else:
+                _add('global({}_1)'.format(key), vals1)
+                _add('global({}_2)'.format(key), vals2)
+                gfeat[key] = (vals1, vals2)
+                if key == 'view':
+                    delta = np.array([
+                        _rhomb_dist.VIEW_INT_DIST.get((v1, v2), np.nan)
+                        for v1, v2 in zip(vals1, vals2)], dtype=np.float64)
+                else:
+                    delta = np.abs(vals1 - vals2)
+            _add('global(delta_{})'.format(key), delta)
+            gfeat['delta_' + key] = delta
+        for key in ['qual', 'view']:
+            if key in gfeat:
+                vals1, vals2 = gfeat[key]
+                # np.sort puts a nan last
+                minv = np.fmin(vals1, vals2)
+                maxv = np.where(np.isnan(vals1) | np.isnan(vals2), np.nan,
+                                np.maximum(vals1, vals2))
+                _add('global(min_{})'.format(key), minv)
+                _add('global(max_{})'.format(key), maxv)
+        if 'delta_gps' in gfeat and 'delta_time' in gfeat:
+            hour_delta = gfeat['delta_time'] / 360
+            km_delta = gfeat['delta_gps']
+            speed = km_delta / hour_delta
+            speed[hour_delta == 0] = np.where(
+                km_delta[hour_delta == 0] == 0, 0, np.nan)
+            _add('global(speed)', speed)
+
+        # Local summary features (see _make_local_summary_feature_vector)
+        local_vals = ub.odict([(key, _concat_local(key))
+                               for key in local_keys])
+        summary_opnames = sorted(summary_ops - {'len'})
+        if bin_key is not None:
+            if bins is None:
+                raise ValueError('must choose bins')
+            if isinstance(bins, int):
+                bins = np.linspace(0, 1.0, bins + 1)
+            else:
+                bins = list(bins)
+            bin_ids = np.searchsorted(bins, _concat_local(bin_key))
+            dimkey_fmt = AnnotPairFeatInfo.binsum_fmt
+            group_ids = np.repeat(np.arange(num), lens)
+            for binid, binval in enumerate(bins, start=1):
+                flags = bin_ids <= binid
+                bin_lens = np.bincount(group_ids[flags], minlength=num)
+                bin_offsets = np.zeros(num + 1, dtype=np.int64)
+                bin_offsets[1:] = np.cumsum(bin_lens)
+                if 'len' in summary_ops:
+                    _add(dimkey_fmt.format(op='len', measure='matches',
+                                           bin_key=bin_key, binval=binval),
+                         bin_lens)
+                for opname in summary_opnames:
+                    for key, vals in local_vals.items():
+                        _add(dimkey_fmt.format(op=opname, measure=key,
+                                               bin_key=bin_key,
+                                               binval=binval),
+                             _grouped_summary(opname, vals[flags],
+                                              bin_offsets))
+        else:
+            dimkey_fmt = AnnotPairFeatInfo.sum_fmt
+            if 'len' in summary_ops:
+                _add(dimkey_fmt.format(op='len', measure='matches'), lens)
+            for opname in summary_opnames:
+                for key, vals in local_vals.items():
+                    _add(dimkey_fmt.format(op=opname, measure=key),
+                         _grouped_summary(opname, vals, offsets))
+
+        # Local top features (see _make_local_top_feature_vector)
+        if isinstance(indices, int):
+            indices = slice(indices)
+        if isinstance(indices, slice):
+            indices = list(range(*indices.indices(max(lens, default=0))))
+        group_ids = np.repeat(np.arange(num), lens)
+        for sorter in sorters:
+            # Position of the matches of each group in descending order
+            ascending = np.lexsort((_concat_local(sorter), group_ids))
+            for rank in indices:
+                rank_ = np.where(rank < 0, lens + rank, rank)
+                valid = (rank_ >= 0) & (rank_ < lens)
+                pos = np.where(valid, offsets[1:] - 1 - rank_, 0)
+                topxs = ascending[pos[valid]]
+                for key, vals in local_vals.items():
+                    col = np.full(num, np.nan)
+                    col[valid] = vals[topxs]
+                    values.append(col)
+                    columns.append((sorter, key, rank))
+        # Order the top columns by sorter, measure then rank
+        num_top = len(sorters) * len(indices) * len(local_vals)
+        if num_top:
+            top_cols = columns[-num_top:]
+            top_vals = values[-num_top:]
+            order = ut.argsort([
+                (sorters.index(s), local_keys.index(k), indices.index(r))
+                for s, k, r in top_cols])
+            columns[-num_top:] = [
+                AnnotPairFeatInfo.loc_fmt.format(
+                    sorter=top_cols[x][0], rank=top_cols[x][2],
+                    measure=top_cols[x][1])
+                for x in order]
+            values[-num_top:] = ut.take(top_vals, order)
+
+    featinfo = AnnotPairFeatInfo(columns)
+    X = np.empty((num, len(columns)), dtype=np.float32)
+    for cx, vals in enumerate(values):
+        X[:, cx] = vals
+    if return_df:
+        return pd.DataFrame(X, columns=featinfo.columns, index=index)
+    return X, featinfo
+
+
 def testdata_annot_metadata(rchip_fpath, cfgdict={}):
     metadata = ut.LazyDict({'rchip_fpath': rchip_fpath})
     ensure_metadata_feats(metadata, '', cfgdict)
@@ -1420,6 +2952,8 @@ def ensure_metadata_vsone(annot1, annot2, cfgdict={}):
 
     if symmetric:
         ensure_metadata_flann(annot2, cfgdict=cfgdict)
+    ensure_metadata_kpts_geom(annot1)
+    ensure_metadata_kpts_geom(annot2)
     ensure_metadata_dlen_sqrd(annot2)
     pass
 
@@ -1434,14 +2968,19 @@ def ensure_metadata_normxy(annot, cfgdict={}):
         annot.set_lazy_func('norm_xys', eval_normxy)
 
 
-def ensure_metadata_feats(annot, cfgdict={}):
+def ensure_metadata_feats(annot, cfgdict={}, feat_store=None):
     r"""
     Adds feature evaluation keys to a lazy dictionary
 
+    If a FeatureStore is given (or the annot has a `feat_store` key) and the
+    annot has an `rchip_fpath`, the features are loaded from the store and
+    only extracted (and saved) when they are missing.
+
     Args:
         annot (utool.LazyDict):
         suffix (str): (default = '')
         cfgdict (dict): (default = {})
+        feat_store (vtool_ibeis.FeatureStore): persistent feature cache
 
     CommandLine:
         python -m vtool_ibeis.matching --exec-ensure_metadata_feats
@@ -1459,6 +2998,27 @@ def ensure_metadata_feats(annot, cfgdict={}):
         >>> assert len(annot._stored_results) >= 4
         >>> annot['vecs']
         >>> assert len(annot._stored_results) >= 5
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> # xdoctest: +REQUIRES(module:pyhesaff)
+        >>> from vtool_ibeis.matching import *  # NOQA
+        >>> import vtool_ibeis as vt
+        >>> dpath = ub.Path.appdir('vtool_ibeis', 'tests', 'featstore2').delete().ensuredir()
+        >>> rchip_fpath = dpath / 'chip.png'
+        >>> vt.imwrite(rchip_fpath, vt.demodata.get_kpts_dummy_img(
+        >>>     vt.demodata.get_dummy_kpts_pair((100, 100))[0]))
+        >>> feat_store = vt.FeatureStore(dpath / 'store')
+        >>> annot1 = ut.LazyDict({'rchip_fpath': rchip_fpath})
+        >>> ensure_metadata_feats(annot1, feat_store=feat_store)
+        >>> vecs1 = annot1['vecs']
+        >>> # A new annotation loads the stored features
+        >>> annot2 = ut.LazyDict({'rchip_fpath': rchip_fpath,
+        >>>                       'feat_store': feat_store})
+        >>> ensure_metadata_feats(annot2)
+        >>> assert isinstance(annot2['vecs'], np.memmap)
+        >>> assert np.all(annot2['vecs'] == vecs1)
+        >>> assert 'nchip' not in annot2.stored_keys()
     """
     import vtool_ibeis as vt
     rchip_key = 'rchip'
@@ -1515,13 +3075,25 @@ def ensure_metadata_feats(annot, cfgdict={}):
             return nchip
         annot.set_lazy_func(nchip_key, eval_normchip)
 
+    if feat_store is None:
+        feat_store = annot.get('feat_store', None)
+
     if kpts_key not in annot or vecs_key not in annot:
         def eval_feats():
+            feat_key = None
+            if feat_store is not None and rchip_fpath_key in annot:
+                feat_key = feat_store.feat_key(annot[rchip_fpath_key],
+                                               cfgdict)
+                _feats = feat_store.load(feat_key)
+                if _feats is not None:
+                    return _feats
             rchip = annot[nchip_key]
             feat_cfgkeys = [pi.varname for pi in VSONE_FEAT_CONFIG]
             feat_cfgdict = {key: cfgdict[key] for key in feat_cfgkeys if
                             key in cfgdict}
             _feats = vt.extract_features(rchip, **feat_cfgdict)
+            if feat_key is not None:
+                feat_store.save(feat_key, *_feats)
             return _feats
 
         def eval_kpts():
@@ -1539,6 +3111,19 @@ def ensure_metadata_feats(annot, cfgdict={}):
     return annot
 
 
+def ensure_metadata_kpts_geom(annot):
+    """
+    Adds a lazy key for the precomputed keypoint geometry used in spatial
+    verification, so it is computed once per annotation instead of per pair.
+    """
+    if 'kpts_geom' not in annot:
+        def eval_kpts_geom():
+            from vtool_ibeis import spatial_verification as sver
+            return sver.KptsGeometry(annot['kpts'])
+        annot.set_lazy_func('kpts_geom', eval_kpts_geom)
+    return annot
+
+
 def ensure_metadata_dlen_sqrd(annot):
     if 'dlen_sqrd' not in annot:
         def eval_dlen_sqrd(annot):
@@ -1550,18 +3135,50 @@ def ensure_metadata_dlen_sqrd(annot):
 
 
 def ensure_metadata_flann(annot, cfgdict):
-    """ setup lazy flann evaluation """
+    """
+    setup lazy flann evaluation
+
+    The nn_backend config picks the nearest neighbor backend by name (see
+    `nearest_neighbors.NN_BACKENDS`). By default small annotations get an
+    exact `nearest_neighbors.BruteForceIndex`, which avoids building and
+    saving a kdtree.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> # xdoctest: +REQUIRES(module:pyflann_ibeis)
+        >>> from vtool_ibeis.matching import *  # NOQA
+        >>> import vtool_ibeis as vt
+        >>> vecs = vt.demodata.testdata_dummy_sift(vt.NN_BRUTE_FORCE_MAX_VECS + 1)
+        >>> annot1 = ensure_metadata_flann(ut.LazyDict({'vecs': vecs[0:10]}), {})
+        >>> annot2 = ensure_metadata_flann(ut.LazyDict({'vecs': vecs}), {})
+        >>> annot3 = ensure_metadata_flann(ut.LazyDict({'vecs': vecs[0:10]}),
+        >>>                                {'nn_backend': 'kdtree'})
+        >>> print(type(annot1['flann']).__name__)
+        BruteForceIndex
+        >>> assert not isinstance(annot2['flann'], vt.BruteForceIndex)
+        >>> print(type(annot3['flann']).__name__)
+        KDTreeIndex
+    """
     import vtool_ibeis as vt
     flann_params = {'algorithm': 'kdtree', 'trees': 8}
+    backend, = PairwiseMatch._take_params(cfgdict, ['nn_backend'])
 
     if 'flann' not in annot:
         def eval_flann():
             vecs = annot['vecs']
             if len(vecs) == 0:
                 _flann = None
+                return _flann
+            _backend = backend
+            if _backend == 'auto':
+                _backend = vt.choose_nn_backend(len(vecs))
+            if _backend == 'brute':
+                # Nothing to gain from hashing and caching the data
+                _flann = vt.make_nn_index(_backend)
+                _flann.build_index(vecs)
             else:
                 _flann = vt.flann_cache(vecs, flann_params=flann_params,
-                                        verbose=False)
+                                        verbose=False, backend=_backend)
             return _flann
         annot.set_lazy_func('flann', eval_flann)
     return annot
@@ -1647,14 +3264,51 @@ def asymmetric_correspondence(annot1, annot2, K, Knorm, checks, allow_shrink=Tru
     return fm, match_dist, norm_dist, fx1_norm, fx2_norm
 
 
-def normalized_nearest_neighbors(flann1, vecs2, K, checks=800):
+def normalized_nearest_neighbors(flann1, vecs2, K, checks=800,
+                                 nn_backend='auto', n_workers=0):
     """
     Computes matches from vecs2 to flann1.
 
     uses flann index to return nearest neighbors with distances normalized
     between 0 and 1 using sifts uint8 trick
+
+    Args:
+        flann1 (object): an index with the FLANN api (see
+            `nearest_neighbors.NNIndex`) or an array of database vectors,
+            which is indexed with nn_backend
+        vecs2 (ndarray): query vectors
+        K (int): number of neighbors
+        checks (int): search effort of approximate backends
+        nn_backend (str): backend used when flann1 is an array
+        n_workers (int): threads that query chunks of more than
+            `nearest_neighbors.NN_BATCH_CHUNKSIZE` vectors (see
+            `nearest_neighbors.batch_nn_index`). The default of 0 queries in
+            the calling thread, which may already be a pool worker, and lets
+            pyflann use its own cores.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.matching import *  # NOQA
+        >>> import vtool_ibeis as vt
+        >>> vecs1 = vt.demodata.testdata_dummy_sift(100, rng=np.random.RandomState(0))
+        >>> vecs2 = vt.demodata.testdata_dummy_sift(10, rng=np.random.RandomState(1))
+        >>> fx2_to_fx1, fx2_to_dist = normalized_nearest_neighbors(
+        >>>     vecs1, vecs2, 2, nn_backend='kdtree')
+        >>> fx2_to_fx1_, fx2_to_dist_ = normalized_nearest_neighbors(
+        >>>     vecs1, vecs2, 2, nn_backend='brute')
+        >>> assert np.all(fx2_to_fx1 == fx2_to_fx1_)
+        >>> assert np.allclose(fx2_to_dist, fx2_to_dist_, atol=1e-5)
+        >>> print(fx2_to_dist.shape)
+        (10, 2)
     """
     import vtool_ibeis as vt
+    if isinstance(flann1, np.ndarray):
+        vecs1 = flann1
+        if len(vecs1) == 0:
+            flann1 = None
+        else:
+            flann1 = vt.make_nn_index(nn_backend, num_vecs=len(vecs1))
+            flann1.build_index(vecs1)
     if K == 0:
         (fx2_to_fx1, _fx2_to_dist_sqrd) = empty_neighbors(len(vecs2), 0)
     elif len(vecs2) == 0:
@@ -1666,8 +3320,8 @@ def normalized_nearest_neighbors(flann1, vecs2, K, checks=800):
         raise MatchingError('not enough database features')
         #(fx2_to_fx1, _fx2_to_dist_sqrd) = empty_neighbors(len(vecs2), 0)
     else:
-        fx2_to_fx1, _fx2_to_dist_sqrd = flann1.nn_index(
-            vecs2, num_neighbors=K, checks=checks)
+        fx2_to_fx1, _fx2_to_dist_sqrd = vt.batch_nn_index(
+            flann1, vecs2, K, checks=checks, n_workers=n_workers)
     _fx2_to_dist = np.sqrt(_fx2_to_dist_sqrd.astype(np.float64))
     # normalized SIFT dist
     fx2_to_dist = np.divide(_fx2_to_dist, PSEUDO_MAX_DIST)
@@ -1679,56 +3333,90 @@ def normalized_nearest_neighbors(flann1, vecs2, K, checks=800):
 def assign_symmetric_matches(fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist,
                              K, Knorm=None):
     r"""
-    import vtool_ibeis as vt
-    from vtool_ibeis.matching import *
-    K = 2
-    Knorm = 1
-    feat1 = np.random.rand(5, 3)
-    feat2 = np.random.rand(7, 3)
+    Finds the mutual matches among the top K neighbors of both directions.
+
+    Each candidate pair (fx1, fx2) of both directions is encoded as an int64
+    key, and the mutual matches are the intersection of the keys. The
+    normalizers of both directions are looked up for the same matches, so
+    no further alignment is needed.
+
+    Returns:
+        tuple: (fm, match_dist, norm_fx1, norm_dist1, norm_fx2, norm_dist2)
+            with matches ordered by fx2 and then fx1
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.matching import *  # NOQA
+        >>> K, Knorm = 2, 1
+        >>> rng = np.random.RandomState(0)
+        >>> distmat = rng.rand(5, 7)
+        >>> fx1_to_fx2 = distmat.argsort(axis=1)[:, 0:K + Knorm].astype(np.int32)
+        >>> fx2_to_fx1 = distmat.T.argsort(axis=1)[:, 0:K + Knorm].astype(np.int32)
+        >>> fx1_to_dist = np.take_along_axis(distmat, fx1_to_fx2, axis=1)
+        >>> fx2_to_dist = np.take_along_axis(distmat.T, fx2_to_fx1, axis=1)
+        >>> assigntup = assign_symmetric_matches(
+        >>>     fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist, K, Knorm)
+        >>> fm, match_dist = assigntup[0:2]
+        >>> print(fm.T)
+        [[2 2 4 3 0 3 0 4]
+         [0 2 2 3 4 5 6 6]]
+        >>> assert np.all(match_dist == distmat[fm.T[0], fm.T[1]])
+        >>> # The same matches are flagged in both directions
+        >>> flags = flag_symmetric_matches(fx2_to_fx1, fx1_to_fx2, K)
+        >>> assert flags.sum() == len(fm)
+        >>> assert np.all(flags == flag_sym_slow(fx2_to_fx1, fx1_to_fx2, K))
 
-    # Assign distances
-    distmat = vt.L2(feat1[:, None], feat2[None, :])
+    Ignore:
+        import vtool_ibeis as vt
+        from vtool_ibeis.matching import *
+        K = 2
+        Knorm = 1
+        feat1 = np.random.rand(5, 3)
+        feat2 = np.random.rand(7, 3)
+
+        # Assign distances
+        distmat = vt.L2(feat1[:, None], feat2[None, :])
 
-    # Find nearest K
-    fx1_to_fx2 = distmat.argsort()[:, 0:K + Knorm]
-    fx2_to_fx1 = distmat.T.argsort()[:, 0:K + Knorm]
-    # and order their distances
-    fx1_to_dist = np.array([distmat[i].take(col) for i, col in enumerate(fx1_to_fx2)])
-    fx2_to_dist = np.array([distmat.T[j].take(row) for j, row in enumerate(fx2_to_fx1)])
+        # Find nearest K
+        fx1_to_fx2 = distmat.argsort()[:, 0:K + Knorm]
+        fx2_to_fx1 = distmat.T.argsort()[:, 0:K + Knorm]
+        # and order their distances
+        fx1_to_dist = np.array([distmat[i].take(col) for i, col in enumerate(fx1_to_fx2)])
+        fx2_to_dist = np.array([distmat.T[j].take(row) for j, row in enumerate(fx2_to_fx1)])
 
-    # flat_matx1 = fx1_to_fx2 + np.arange(distmat.shape[0])[:, None] * distmat.shape[1]
-    # fx1_to_dist = distmat.take(flat_matx1).reshape(fx1_to_fx2.shape)
+        # flat_matx1 = fx1_to_fx2 + np.arange(distmat.shape[0])[:, None] * distmat.shape[1]
+        # fx1_to_dist = distmat.take(flat_matx1).reshape(fx1_to_fx2.shape)
 
-    fx21 = pd.DataFrame(fx2_to_fx1)
-    fx21.columns.name = 'K'
-    fx21.index.name = 'fx1'
+        fx21 = pd.DataFrame(fx2_to_fx1)
+        fx21.columns.name = 'K'
+        fx21.index.name = 'fx1'
 
-    fx12 = pd.DataFrame(fx1_to_fx2)
-    fx12.columns.name = 'K'
-    fx12.index.name = 'fx2'
+        fx12 = pd.DataFrame(fx1_to_fx2)
+        fx12.columns.name = 'K'
+        fx12.index.name = 'fx2'
 
-    fx12 = fx12.T[0:K].T.astype(float)
-    fx21 = fx21.T[0:K].T.astype(float)
+        fx12 = fx12.T[0:K].T.astype(float)
+        fx21 = fx21.T[0:K].T.astype(float)
 
-    fx12.values[~fx1_to_flags] = np.nan
-    fx21.values[~fx2_to_flags] = np.nan
+        fx12.values[~fx1_to_flags] = np.nan
+        fx21.values[~fx2_to_flags] = np.nan
 
-    print('fx12.values =\n%r' % (fx12,))
-    print('fm_ =\n%r' % (fm_,))
+        print('fx12.values =\n%r' % (fx12,))
+        print('fm_ =\n%r' % (fm_,))
 
-    print('fx21.values =\n%r' % (fx21,))
-    print('fm =\n%r' % (fm,))
+        print('fx21.values =\n%r' % (fx21,))
+        print('fm =\n%r' % (fm,))
 
-    unflat_match_idx2 = -np.ones(fx2_to_fx1.shape)
-    unflat_match_idx2.ravel()[flat_match_idx2] = flat_match_idx2
-    inv_lookup21 = unflat_match_idx2.T[0:K].T
+        unflat_match_idx2 = -np.ones(fx2_to_fx1.shape)
+        unflat_match_idx2.ravel()[flat_match_idx2] = flat_match_idx2
+        inv_lookup21 = unflat_match_idx2.T[0:K].T
 
-    for fx2 in zip(fx12.values[fx1_to_flags]:
+        for fx2 in zip(fx12.values[fx1_to_flags]:
 
-    for fx1, fx2 in zip(match_fx1_, match_fx2_):
-        cx = np.where(fx2_to_fx1[fx2][0:K] == fx1)[0][0]
-        inv_idx = inv_lookup21[fx2][cx]
-        print('inv_idx = %r' % (inv_idx,))
+        for fx1, fx2 in zip(match_fx1_, match_fx2_):
+            cx = np.where(fx2_to_fx1[fx2][0:K] == fx1)[0][0]
+            inv_idx = inv_lookup21[fx2][cx]
+            print('inv_idx = %r' % (inv_idx,))
     """
     # Infer the valid internal query feature indexes and ranks
     if Knorm is None:
@@ -1737,74 +3425,38 @@ def assign_symmetric_matches(fx2_to_fx1, fx2_to_dist, fx1_to_fx2, fx1_to_dist,
         basic_norm_rank = K + Knorm - 1
 
     index_dtype = fx2_to_fx1.dtype
-
-    fx2_to_flags = flag_symmetric_matches(fx2_to_fx1, fx1_to_fx2, K)
-    flat_validx2 = np.flatnonzero(fx2_to_flags)
-    match_fx2   = np.floor_divide(flat_validx2, K, dtype=index_dtype)
-    match_rank2 = np.mod(flat_validx2, K, dtype=index_dtype)
-    flat_match_idx2 = np.ravel_multi_index((match_fx2, match_rank2),
-                                           dims=fx2_to_fx1.shape)
-    match_fx1 = fx2_to_fx1.take(flat_match_idx2)
-    match_dist1 = fx2_to_dist.take(flat_match_idx2)
-
-    # assert np.all(match_dist1 == fx2_to_dist[:, 0:K][fx2_to_flags])
-
+    match_21 = fx2_to_fx1[:, 0:K].astype(np.int64)
+    match_12 = fx1_to_fx2[:, 0:K].astype(np.int64)
+    num1 = len(fx1_to_fx2)
+    if match_21.size:
+        num1 = max(num1, int(match_21.max()) + 1)
+
+    # Encode each (fx1, fx2) candidate so keys sort by fx2 and then fx1
+    fx2_list = np.arange(len(fx2_to_fx1), dtype=np.int64)
+    fx1_list = np.arange(len(fx1_to_fx2), dtype=np.int64)
+    keys21 = (fx2_list[:, None] * num1 + match_21).ravel()
+    keys12 = (match_12 * num1 + fx1_list[:, None]).ravel()
+    # Matches are flat indices into the top K of each direction
+    _, flat_match_idx2, flat_match_idx1 = np.intersect1d(
+        keys21, keys12, return_indices=True)
+
+    match_fx2 = np.floor_divide(flat_match_idx2, K).astype(index_dtype)
+    match_rank2 = np.mod(flat_match_idx2, K)
+    match_fx1 = fx2_to_fx1[match_fx2, match_rank2]
+    match_dist = fx2_to_dist[match_fx2, match_rank2]
     fm = np.vstack((match_fx1, match_fx2)).T
 
-    # TODO: for each position in fm need to find corresponding position in fm_
-
     # Currently just use the last one as a normalizer
-    norm_rank = np.array([basic_norm_rank] * len(match_fx2),
-                         dtype=match_fx2.dtype)
-    # norm_rank = basic_norm_rank
-    flat_norm_idx1 = np.ravel_multi_index((match_fx2, norm_rank),
-                                          dims=fx2_to_fx1.shape)
-    norm_fx1 = fx2_to_fx1.take(flat_norm_idx1)
-    norm_dist1 = fx2_to_dist.take(flat_norm_idx1)
-    norm_fx1 = fx2_to_fx1[match_fx2, norm_rank]
-    norm_dist1 = fx2_to_dist[match_fx2, norm_rank]
-
-    # ---------
-    # REVERSE DIRECTION
-    fx1_to_flags = flag_symmetric_matches(fx1_to_fx2, fx2_to_fx1, K)
-    flat_validx1 = np.flatnonzero(fx1_to_flags)
-    match_fx1_   = np.floor_divide(flat_validx1, K, dtype=index_dtype)
-    match_rank1 = np.mod(flat_validx1, K, dtype=index_dtype)
-    flat_match_idx1 = np.ravel_multi_index((match_fx1_, match_rank1),
-                                           dims=fx1_to_fx2.shape)
-    match_fx2_ = fx1_to_fx2.take(flat_match_idx1)
-    # match_dist2_ = fx1_to_dist.take(flat_match_idx1)
-    fm_ = np.vstack((match_fx1_, match_fx2_)).T
-
-    flat_norm_idx2_ = np.ravel_multi_index((match_fx1_, norm_rank),
-                                           dims=fx1_to_fx2.shape)
-    norm_fx2_ = fx1_to_fx2.take(flat_norm_idx2_)
-    norm_dist2_ = fx1_to_dist.take(flat_norm_idx2_)
-
-    # ---------
-    # Align matches with the reverse direction
-
-    # Do this by enforcing a constant sorting. No lookup necessary
-    sortx = np.lexsort(fm.T)
-    sortx_ = np.lexsort(fm_.T)
-    # fm2_ = fm_.take(sortx_, axis=0)
-    # assert np.all(fm2 == fm2_)
-
-    a_fm = fm.take(sortx, axis=0)
-
-    a_match_dist = match_dist1[sortx]
-    # assert np.all(match_dist1[sortx] == match_dist2_[sortx_])
-
-    a_norm_fx1 = norm_fx1[sortx]
-    a_norm_dist1 = norm_dist1[sortx]
-
-    a_norm_fx2_ = norm_fx2_[sortx_]
-    a_norm_dist2_ = norm_dist2_[sortx_]
+    norm_fx1 = fx2_to_fx1[match_fx2, basic_norm_rank]
+    norm_dist1 = fx2_to_dist[match_fx2, basic_norm_rank]
 
-    np.minimum(a_norm_dist2_, a_norm_dist1)
+    # The normalizer of the reverse direction for the same matches
+    match_fx1_ = np.floor_divide(flat_match_idx1, K)
+    norm_fx2 = fx1_to_fx2[match_fx1_, basic_norm_rank]
+    norm_dist2 = fx1_to_dist[match_fx1_, basic_norm_rank]
 
-    assigntup = (a_fm, a_match_dist, a_norm_fx1, a_norm_dist1, a_norm_fx2_,
-                 a_norm_dist2_)
+    assigntup = (fm, match_dist, norm_fx1, norm_dist1, norm_fx2,
+                 norm_dist2)
     return assigntup
 
 
@@ -3,7 +3,12 @@ Wrapper around flann (with caching)
 
 python -c "import vtool_ibeis, doctest; print(doctest.testmod(vtool_ibeis.nearest_neighbors))"
 """
-from os.path import exists, normpath, join
+from os.path import exists, normpath, join, splitext
+import concurrent.futures
+import contextlib
+import os
+import re
+import threading
 import utool as ut
 import ubelt as ub
 import numpy as np
@@ -16,34 +21,552 @@ except Exception:
     pyflann = None
 
 
-class AnnoyWrapper(object):
+# Data with at most this many vectors is searched by the exact brute force
+# backend when the backend is chosen automatically
+NN_BRUTE_FORCE_MAX_VECS = ut.get_argval('--nn-brute-force-max-vecs', type_=int,
+                                        default=1000)
+
+
+class NNIndex(object):
+    """
+    Common protocol of the nearest neighbor backends in `NN_BACKENDS`.
+
+    The protocol is the subset of the FLANN api that vtool_ibeis uses, so a
+    pyflann index implements it as is:
+
+        * build_index(dvecs, **params)
+        * add_points(new_dvecs)
+        * remove_points(idxs)
+        * nn_index(qvecs, num_neighbors, checks=None) -> (idxs, sqrd_dists)
+        * save_index(fpath)
+        * load_index(fpath, dvecs)
+        * used_memory()
+        * get_indexed_shape()
+        * delete_index()
+
+    Like FLANN, distances are squared L2 distances, results are squeezed to
+    1d when num_neighbors is 1, and the id of a vector is its position in
+    the built data followed by the added points. Ids stay valid after
+    removing points.
+
+    Subclasses implement `_build`, `_query`, `_save`, `_load`, `_delete` and
+    `_used_memory` over the vectors that are not removed. Backends that
+    cannot modify an index rebuild it on `add_points` and `remove_points`.
+    """
+    default_params = {}
+
+    def __init__(self, **params):
+        self.params = ut.dict_union(self.default_params, params)
+        self.dvecs = None
+        self._removed = None
+        self._ids = None
+
+    def _build(self, dvecs):
+        raise NotImplementedError('abstract method')
+
+    def _query(self, qvecs, num_neighbors, checks):
+        """ returns 2d arrays of idxs into the built data and sqrd dists """
+        raise NotImplementedError('abstract method')
+
+    def _save(self, fpath):
+        raise NotImplementedError('abstract method')
+
+    def _load(self, fpath, dvecs):
+        raise NotImplementedError('abstract method')
+
+    def _used_memory(self):
+        return 0
+
+    def _delete(self):
+        pass
+
+    def _rebuild(self):
+        if self._removed.any():
+            self._ids = np.flatnonzero(~self._removed).astype(np.int32)
+            self._build(self.dvecs.take(self._ids, axis=0))
+        else:
+            self._ids = None
+            self._build(self.dvecs)
+
+    def build_index(self, dvecs, **params):
+        self.params.update(params)
+        self.dvecs = np.asarray(dvecs)
+        self._removed = np.zeros(len(self.dvecs), dtype=bool)
+        self._rebuild()
+
+    def add_points(self, new_dvecs, **kwargs):
+        self.dvecs = np.vstack([self.dvecs, new_dvecs])
+        self._removed = np.hstack([
+            self._removed, np.zeros(len(new_dvecs), dtype=bool)])
+        self._rebuild()
+
+    def remove_points(self, idxs):
+        self._removed[idxs] = True
+        self._rebuild()
+
+    def remove_point(self, idx):
+        self.remove_points([idx])
+
+    def get_indexed_shape(self):
+        num_data = len(self.dvecs) - int(self._removed.sum())
+        return (num_data, self.dvecs.shape[1])
+
+    def used_memory(self):
+        """ approximate number of bytes used by the index and its data """
+        return self.dvecs.nbytes + self._used_memory()
+
+    def nn_index(self, qvecs, num_neighbors=1, checks=None, **kwargs):
+        """
+        Returns:
+            tuple: (idxs, dists) - indices and squared distances of the
+                nearest database vectors, closest first
+        """
+        K = num_neighbors
+        num_data = self.get_indexed_shape()[0]
+        if K > num_data:
+            raise ValueError('cannot get %d neighbors of %d vectors' % (
+                K, num_data))
+        if checks is None:
+            checks = self.params.get('checks', None)
+        qvecs = np.atleast_2d(qvecs)
+        idxs, dists = self._query(qvecs, K, checks)
+        idxs = np.asarray(idxs, dtype=np.int32).reshape(len(qvecs), K)
+        dists = np.asarray(dists, dtype=np.float32).reshape(len(qvecs), K)
+        if self._ids is not None:
+            idxs = self._ids.take(idxs)
+        if K == 1:
+            idxs = idxs[:, 0]
+            dists = dists[:, 0]
+        return idxs, dists
+
+    def save_index(self, fpath):
+        self._save(fpath)
+
+    def delete_index(self):
+        """ frees the index and the reference to its data """
+        if self.dvecs is not None:
+            self._delete()
+            self.dvecs = None
+            self._removed = None
+            self._ids = None
+
+    def load_index(self, fpath, dvecs):
+        self.dvecs = np.asarray(dvecs)
+        self._removed = np.zeros(len(self.dvecs), dtype=bool)
+        self._ids = None
+        self._load(fpath, self.dvecs)
+
+
+class BruteForceIndex(NNIndex):
+    """
+    Exact nearest neighbors with the FLANN api.
+
+    Squared L2 distances are computed as ||a||² + ||b||² - 2ab with a float32
+    matrix product over blocks of query vectors, and the K nearest are
+    selected with argpartition. For a few hundred or thousand database
+    vectors this is faster than building and searching a kdtree.
+
+    The index is only the data, so `save_index` writes nothing.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> # xdoctest: +REQUIRES(module:pyflann_ibeis)
+        >>> from vtool_ibeis.nearest_neighbors import *  # NOQA
+        >>> from vtool_ibeis import demodata
+        >>> dvecs = demodata.testdata_dummy_sift(300, rng=np.random.RandomState(0))
+        >>> qvecs = demodata.testdata_dummy_sift(50, rng=np.random.RandomState(1))
+        >>> index = BruteForceIndex(block_size=16)
+        >>> index.build_index(dvecs)
+        >>> idxs, dists = index.nn_index(qvecs, 3)
+        >>> flann = FLANN_CLS()
+        >>> flann.build_index(dvecs, algorithm='linear')
+        >>> idxs_, dists_ = flann.nn_index(qvecs, 3)
+        >>> assert np.all(idxs == idxs_)
+        >>> assert np.allclose(dists, dists_, rtol=1e-4)
+        >>> print(index.nn_index(qvecs, 1)[0].shape)
+        (50,)
+    """
+    def __init__(self, block_size=1024, **params):
+        super(BruteForceIndex, self).__init__(**params)
+        self.block_size = block_size
+        self._fvecs = None
+        self._dnorms = None
+
+    def _build(self, dvecs):
+        self._fvecs = np.ascontiguousarray(dvecs, dtype=np.float32)
+        self._dnorms = np.einsum('ij,ij->i', self._fvecs, self._fvecs)
+
+    def _used_memory(self):
+        used = self._dnorms.nbytes
+        if self._fvecs is not self.dvecs:
+            used += self._fvecs.nbytes
+        return used
+
+    def _save(self, fpath):
+        pass
+
+    def _load(self, fpath, dvecs):
+        self._build(dvecs)
+
+    def _delete(self):
+        self._fvecs = None
+        self._dnorms = None
+
+    def _query(self, qvecs, num_neighbors, checks):
+        K = num_neighbors
+        num_data = len(self._fvecs)
+        idxs = np.empty((len(qvecs), K), dtype=np.int32)
+        dists = np.empty((len(qvecs), K), dtype=np.float32)
+        for start in range(0, len(qvecs), self.block_size):
+            stop = start + self.block_size
+            qblock = np.asarray(qvecs[start:stop], dtype=np.float32)
+            qnorms = np.einsum('ij,ij->i', qblock, qblock)
+            dist_block = qblock.dot(self._fvecs.T)
+            dist_block *= -2
+            dist_block += qnorms[:, None]
+            dist_block += self._dnorms[None, :]
+            # Cancellation can make distances of duplicates negative
+            np.maximum(dist_block, 0, out=dist_block)
+            if K < num_data:
+                part = np.argpartition(dist_block, K - 1, axis=1)[:, 0:K]
+            else:
+                part = np.broadcast_to(np.arange(num_data), dist_block.shape)
+            part_dists = np.take_along_axis(dist_block, part, axis=1)
+            order = np.argsort(part_dists, axis=1, kind='stable')
+            idxs[start:stop] = np.take_along_axis(part, order, axis=1)
+            dists[start:stop] = np.take_along_axis(part_dists, order, axis=1)
+        return idxs, dists
+
+
+class KDTreeIndex(NNIndex):
+    """
+    Exact nearest neighbors with a scipy cKDTree and the FLANN api.
+
+    The checks parameter is ignored. Set eps for approximate search
+    (see scipy.spatial.cKDTree.query).
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.nearest_neighbors import *  # NOQA
+        >>> from vtool_ibeis import demodata
+        >>> dvecs = demodata.testdata_dummy_sift(300, rng=np.random.RandomState(0))
+        >>> qvecs = demodata.testdata_dummy_sift(50, rng=np.random.RandomState(1))
+        >>> index = KDTreeIndex()
+        >>> index.build_index(dvecs)
+        >>> brute = BruteForceIndex()
+        >>> brute.build_index(dvecs)
+        >>> idxs, dists = index.nn_index(qvecs, 3)
+        >>> idxs_, dists_ = brute.nn_index(qvecs, 3)
+        >>> assert np.all(idxs == idxs_)
+        >>> assert np.allclose(dists, dists_, rtol=1e-4)
+        >>> # Removed points are skipped and the ids of the others are kept
+        >>> index.remove_points(idxs_.T[0])
+        >>> brute.remove_points(idxs_.T[0])
+        >>> idxs = index.nn_index(qvecs, 1)[0]
+        >>> assert not np.any(np.isin(idxs, idxs_.T[0]))
+        >>> assert np.all(idxs == brute.nn_index(qvecs, 1)[0])
+        >>> num_removed = len(np.unique(idxs_.T[0]))
+        >>> assert index.get_indexed_shape() == (300 - num_removed, 128)
+    """
+    default_params = {'eps': 0, 'leafsize': 16}
+
+    def __init__(self, **params):
+        super(KDTreeIndex, self).__init__(**params)
+        self.tree = None
+
+    def _build(self, dvecs):
+        from scipy.spatial import cKDTree
+        self.tree = cKDTree(dvecs, leafsize=self.params['leafsize'])
+
+    def _used_memory(self):
+        # the tree keeps a float64 copy of the data and a permutation
+        return self.tree.n * (self.tree.m * 8 + 8)
+
+    def _query(self, qvecs, num_neighbors, checks):
+        dists, idxs = self.tree.query(qvecs, k=num_neighbors,
+                                      eps=self.params['eps'])
+        return idxs, np.square(dists)
+
+    def _save(self, fpath):
+        import pickle
+        with open(fpath, 'wb') as file_:
+            pickle.dump(self.tree, file_, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _load(self, fpath, dvecs):
+        import pickle
+        with open(fpath, 'rb') as file_:
+            self.tree = pickle.load(file_)
+        if self.tree.n != len(dvecs):
+            raise ValueError('index was not built on this data')
+
+    def _delete(self):
+        self.tree = None
+
+
+class Cv2FlannIndex(NNIndex):
+    """
+    Approximate nearest neighbors with cv2.flann_Index and the FLANN api.
+
+    OpenCV builds its own copy of FLANN, so this works without pyflann.
+    Params use the FLANN names, e.g. algorithm='kdtree', trees=8, checks=32.
+    cv2 indexes cannot be modified, so adding or removing points rebuilds.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> # xdoctest: +REQUIRES(module:cv2)
+        >>> from vtool_ibeis.nearest_neighbors import *  # NOQA
+        >>> from vtool_ibeis import demodata
+        >>> dvecs = demodata.testdata_dummy_sift(300, rng=np.random.RandomState(0))
+        >>> qvecs = demodata.testdata_dummy_sift(50, rng=np.random.RandomState(1))
+        >>> index = Cv2FlannIndex(algorithm='linear')
+        >>> index.build_index(dvecs)
+        >>> brute = BruteForceIndex()
+        >>> brute.build_index(dvecs)
+        >>> idxs, dists = index.nn_index(qvecs, 3)
+        >>> idxs_, dists_ = brute.nn_index(qvecs, 3)
+        >>> assert np.all(idxs == idxs_)
+        >>> assert np.allclose(dists, dists_, rtol=1e-4)
+    """
+    default_params = {'algorithm': 'kdtree', 'trees': 8, 'checks': 32}
+
+    # cv2 does not expose the flann_algorithm_t enum
+    ALGORITHM_CODES = {
+        'linear': 0, 'kdtree': 1, 'kmeans': 2, 'composite': 3,
+        'kdtree_single': 4, 'hierarchical': 5, 'lsh': 6, 'autotuned': 255,
+    }
+
+    def __init__(self, **params):
+        super(Cv2FlannIndex, self).__init__(**params)
+        self.index = None
+        self._fvecs = None
+
+    def _index_params(self):
+        index_params = ut.dict_subset(
+            self.params, ['algorithm', 'trees', 'branching', 'iterations',
+                          'leaf_max_size'], None)
+        index_params = ut.dict_filter_nones(index_params)
+        algorithm = index_params['algorithm']
+        index_params['algorithm'] = self.ALGORITHM_CODES.get(algorithm,
+                                                             algorithm)
+        return index_params
+
+    def _build(self, dvecs):
+        import cv2
+        self._fvecs = np.ascontiguousarray(dvecs, dtype=np.float32)
+        self.index = cv2.flann_Index()
+        self.index.build(self._fvecs, self._index_params())
+
+    def _used_memory(self):
+        if self._fvecs is not self.dvecs:
+            return self._fvecs.nbytes
+        return 0
+
+    def _query(self, qvecs, num_neighbors, checks):
+        qvecs = np.ascontiguousarray(qvecs, dtype=np.float32)
+        search_params = {'checks': -1 if checks is None else int(checks)}
+        idxs, dists = self.index.knnSearch(qvecs, num_neighbors,
+                                           params=search_params)
+        return idxs, dists
+
+    def _save(self, fpath):
+        self.index.save(fpath)
+
+    def _load(self, fpath, dvecs):
+        import cv2
+        self._fvecs = np.ascontiguousarray(dvecs, dtype=np.float32)
+        self.index = cv2.flann_Index()
+        if not self.index.load(self._fvecs, fpath):
+            raise IOError('cannot load %r' % (fpath,))
+
+    def _delete(self):
+        self.index.release()
+        self.index = None
+        self._fvecs = None
+
+
+class AnnoyWrapper(NNIndex):
     """
     Wrapper for annoy to use the FLANN api
+
+    Annoy returns L2 distances, which are squared to match FLANN.
     """
-    def __init__(self):
+    default_params = {
+        'trees': 8,
+        'checks': 512,
+    }
+
+    def __init__(self, **params):
+        super(AnnoyWrapper, self).__init__(**params)
         self.ann = None
-        self.params = {
-            'trees': 8,
-            'checks': 512,
-        }
 
-    def build_index(self, dvecs, **kwargs):
+    def _new_ann(self, dim):
         import annoy
-        self.params.update(kwargs)
-        self.ann = annoy.AnnoyIndex(f=dvecs.shape[1], metric='euclidean')
+        return annoy.AnnoyIndex(dim, metric='euclidean')
+
+    def _build(self, dvecs):
+        self.ann = self._new_ann(dvecs.shape[1])
         for i, dvec in enumerate(dvecs):
             self.ann.add_item(i, dvec)
-        self.ann.build(n_trees=self.params['trees'])
+        self.ann.build(self.params['trees'])
 
-    def nn_index(self, qvecs, num_neighbs, checks=None):
-        if checks is None:
-            checks = self.params['checks']
-        idxs = np.empty((len(qvecs), num_neighbs), dtype=int)
-        dists = np.empty((len(qvecs), num_neighbs), dtype=float)
+    def _used_memory(self):
+        # each item stores its float32 vector and a node header
+        num, dim = self.get_indexed_shape()
+        return num * (dim * 4 + 16) * 2
+
+    def _query(self, qvecs, num_neighbors, checks):
+        search_k = -1 if checks is None else checks
+        idxs = np.empty((len(qvecs), num_neighbors), dtype=np.int32)
+        dists = np.empty((len(qvecs), num_neighbors), dtype=np.float32)
         for i, qvec in enumerate(qvecs):
             idxs[i], dists[i] = self.ann.get_nns_by_vector(
-                qvec, n=num_neighbs, search_k=checks, include_distances=True)
-        return idxs, dists
+                qvec, n=num_neighbors, search_k=search_k,
+                include_distances=True)
+        return idxs, np.square(dists)
+
+    def _save(self, fpath):
+        self.ann.save(fpath)
+
+    def _load(self, fpath, dvecs):
+        self.ann = self._new_ann(dvecs.shape[1])
+        self.ann.load(fpath)
+
+    def _delete(self):
+        self.ann.unload()
+        self.ann = None
+
+
+def _flann_backend_cls():
+    if FLANN_CLS is None:
+        raise ImportError('pyflann_ibeis is not available')
+    return FLANN_CLS
+
+
+def _cv2_backend_cls():
+    import cv2
+    if not hasattr(cv2, 'flann_Index'):
+        raise ImportError('cv2 was built without flann')
+    return Cv2FlannIndex
+
+
+def _annoy_backend_cls():
+    import annoy  # NOQA
+    return AnnoyWrapper
+
+
+def _kdtree_backend_cls():
+    import scipy.spatial  # NOQA
+    return KDTreeIndex
+
+
+def _brute_backend_cls():
+    return BruteForceIndex
+
+
+# Maps a backend name to a function that returns its index class or raises
+# ImportError if the backend is not installed. The classes follow the
+# NNIndex protocol.
+NN_BACKENDS = ub.odict([
+    ('flann', _flann_backend_cls),
+    ('cv2', _cv2_backend_cls),
+    ('annoy', _annoy_backend_cls),
+    ('kdtree', _kdtree_backend_cls),
+    ('brute', _brute_backend_cls),
+])
+
+# Preference order of the approximate backends for large data
+NN_AUTO_BACKENDS = ['flann', 'cv2', 'kdtree']
+
+
+def register_nn_backend(name, get_cls):
+    """
+    Registers a nearest neighbor backend
+
+    Args:
+        name (str): name used by `make_nn_index` and the nn_backend config
+        get_cls (func): returns a class following the `NNIndex` protocol.
+            It should raise ImportError if a dependency is missing.
+    """
+    NN_BACKENDS[name] = get_cls
+
+
+def available_nn_backends():
+    """
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.nearest_neighbors import *  # NOQA
+        >>> backends = available_nn_backends()
+        >>> assert 'brute' in backends and 'kdtree' in backends
+    """
+    names = []
+    for name, get_cls in NN_BACKENDS.items():
+        try:
+            get_cls()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def choose_nn_backend(num_vecs=None):
+    """
+    Picks the exact brute force backend for small data and the first
+    available approximate backend otherwise.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> # xdoctest: +REQUIRES(module:pyflann_ibeis)
+        >>> from vtool_ibeis.nearest_neighbors import *  # NOQA
+        >>> print(choose_nn_backend(10))
+        brute
+        >>> print(choose_nn_backend(NN_BRUTE_FORCE_MAX_VECS + 1))
+        flann
+    """
+    if num_vecs is not None and num_vecs <= NN_BRUTE_FORCE_MAX_VECS:
+        return 'brute'
+    available = available_nn_backends()
+    for name in NN_AUTO_BACKENDS:
+        if name in available:
+            return name
+    return 'brute'
+
+
+def make_nn_index(backend='auto', num_vecs=None, **params):
+    """
+    Creates an unbuilt index of a nearest neighbor backend
+
+    Args:
+        backend (str): a key of NN_BACKENDS or 'auto' to pick one based on
+            num_vecs (see `choose_nn_backend`)
+        num_vecs (int): number of vectors that will be indexed
+        **params: default parameters of the index
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.nearest_neighbors import *  # NOQA
+        >>> from vtool_ibeis import demodata
+        >>> dvecs = demodata.testdata_dummy_sift(100, rng=np.random.RandomState(0))
+        >>> qvecs = demodata.testdata_dummy_sift(10, rng=np.random.RandomState(1))
+        >>> results = {}
+        >>> for backend in ['kdtree', 'brute', 'auto']:
+        >>>     index = make_nn_index(backend, num_vecs=len(dvecs))
+        >>>     index.build_index(dvecs)
+        >>>     results[backend] = index.nn_index(qvecs, 2)[0]
+        >>>     print('%s: %s' % (backend, type(index).__name__))
+        kdtree: KDTreeIndex
+        brute: BruteForceIndex
+        auto: BruteForceIndex
+        >>> assert np.all(results['kdtree'] == results['brute'])
+    """
+    if backend == 'auto':
+        backend = choose_nn_backend(num_vecs)
+    try:
+        get_cls = NN_BACKENDS[backend]
+    except KeyError:
+        raise ValueError('Unknown nn backend=%r. Valid backends are %r' % (
+            backend, list(NN_BACKENDS.keys())))
+    cls = get_cls()
+    return cls(**params)
 
 
 def test_annoy():
@@ -275,10 +798,138 @@ def ann_flann_once(dpts, qpts, num_neighbors, flann_params={}):
     return (qx2_dx, qx2_dist)
 
 
-def assign_to_centroids(dpts, qpts, num_neighbors=1, flann_params={}):
-    """ Helper for akmeans """
-    (qx2_dx, qx2_dist) = FLANN_CLS().nn_index(
-        dpts, qpts, num_neighbors, **flann_params)
+# Number of query vectors per nn_index call of batch_nn_index
+NN_BATCH_CHUNKSIZE = ut.get_argval('--nn-batch-chunksize', type_=int,
+                                   default=2 ** 14)
+
+
+def batch_nn_index(index, qvecs, num_neighbors, checks=None, chunksize=None,
+                   n_workers=None, out=None, progress=None, cancel=None):
+    """
+    Queries an index with chunks of query vectors on a thread pool
+
+    FLANN releases the GIL while it searches, so the chunks run in parallel,
+    and only the chunks in flight need temporary memory.
+
+    pyflann already parallelizes a single query over its cores param, which
+    defaults to all cores. With more than one worker each query is run with
+    cores=1 instead, and the first chunk is run in the calling thread so the
+    worker threads only write the params that the index already has. Note
+    that pyflann keeps cores=1 for later queries of the index.
+
+    Args:
+        index (object): an index with the FLANN api (see NNIndex)
+        qvecs (ndarray): query vectors
+        num_neighbors (int):
+        checks (int): search effort of approximate indexes
+        chunksize (int): defaults to NN_BATCH_CHUNKSIZE
+        n_workers (int): number of threads. Defaults to the number of cpus.
+            Chunks run in the calling thread if it is 0 or 1.
+        out (tuple): preallocated (N, K) int32 idxs and float32 dists arrays
+        progress (func): called as progress(num_done, num_total) in the
+            calling thread after each chunk
+        cancel (threading.Event): chunks are not started after it is set and
+            CancelledError is raised
+
+    Returns:
+        tuple: (idxs, dists) - (N, K) arrays of the indices and squared
+            distances of the nearest neighbors
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.nearest_neighbors import *  # NOQA
+        >>> from vtool_ibeis import demodata
+        >>> import threading
+        >>> dvecs = demodata.testdata_dummy_sift(300, rng=np.random.RandomState(0))
+        >>> qvecs = demodata.testdata_dummy_sift(1000, rng=np.random.RandomState(1))
+        >>> index = BruteForceIndex()
+        >>> index.build_index(dvecs)
+        >>> done = []
+        >>> idxs, dists = batch_nn_index(
+        >>>     index, qvecs, 1, chunksize=300, n_workers=2,
+        >>>     progress=lambda num_done, num_total: done.append(num_done))
+        >>> idxs_, dists_ = index.nn_index(qvecs, 1)
+        >>> assert np.all(idxs.T[0] == idxs_) and np.all(dists.T[0] == dists_)
+        >>> print(idxs.shape, done[-1])
+        (1000, 1) 1000
+        >>> cancel = threading.Event()
+        >>> cancel.set()
+        >>> ut.assert_raises(concurrent.futures.CancelledError, batch_nn_index,
+        >>>                  index, qvecs, 1, chunksize=300, cancel=cancel)
+    """
+    K = num_neighbors
+    num_total = len(qvecs)
+    if chunksize is None:
+        chunksize = NN_BATCH_CHUNKSIZE
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if out is None:
+        idxs = np.empty((num_total, K), dtype=np.int32)
+        dists = np.empty((num_total, K), dtype=np.float32)
+    else:
+        idxs, dists = out
+    kwargs = {} if checks is None else {'checks': checks}
+    if n_workers > 1:
+        kwargs['cores'] = 1
+
+    def _query_chunk(start):
+        stop = min(start + chunksize, num_total)
+        if cancel is not None and cancel.is_set():
+            return 0
+        chunk_idxs, chunk_dists = index.nn_index(qvecs[start:stop], K,
+                                                 **kwargs)
+        idxs[start:stop] = chunk_idxs.reshape(stop - start, K)
+        dists[start:stop] = chunk_dists.reshape(stop - start, K)
+        return stop - start
+
+    starts = range(0, num_total, chunksize)
+    num_done = 0
+    num_inline = len(starts) if n_workers <= 1 else 1
+    for start in starts[0:num_inline]:
+        num_done += _query_chunk(start)
+        if cancel is not None and cancel.is_set():
+            raise concurrent.futures.CancelledError()
+        if progress is not None:
+            progress(num_done, num_total)
+    if num_inline < len(starts):
+        pool = concurrent.futures.ThreadPoolExecutor(n_workers)
+        try:
+            futures = [pool.submit(_query_chunk, start)
+                       for start in starts[num_inline:]]
+            for future in concurrent.futures.as_completed(futures):
+                num_done += future.result()
+                if cancel is not None and cancel.is_set():
+                    raise concurrent.futures.CancelledError()
+                if progress is not None:
+                    progress(num_done, num_total)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+    return idxs, dists
+
+
+def assign_to_centroids(dpts, qpts, num_neighbors=1, flann_params={},
+                        n_workers=None):
+    """
+    Helper for akmeans
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> # xdoctest: +REQUIRES(module:pyflann_ibeis)
+        >>> from vtool_ibeis.nearest_neighbors import *  # NOQA
+        >>> rng = np.random.RandomState(0)
+        >>> centroids = rng.rand(10, 2).astype(np.float32)
+        >>> qpts = centroids.repeat(3, axis=0) + .001
+        >>> qx2_dx = assign_to_centroids(centroids, qpts,
+        >>>                              flann_params={'algorithm': 'linear'})
+        >>> print(qx2_dx)
+        [0 0 0 1 1 1 2 2 2 3 3 3 4 4 4 5 5 5 6 6 6 7 7 7 8 8 8 9 9 9]
+    """
+    flann = FLANN_CLS()
+    flann.build_index(dpts, **flann_params)
+    qx2_dx, qx2_dist = batch_nn_index(flann, qpts, num_neighbors,
+                                      n_workers=n_workers)
+    if num_neighbors == 1:
+        qx2_dx = qx2_dx.T[0]
     return qx2_dx
 
 
@@ -295,8 +946,107 @@ def get_flann_params_cfgstr(flann_params):
     return flann_valsig
 
 
+# How get_flann_cfgstr hashes the indexed data (see get_data_hashstr)
+FLANN_HASH_MODE = ut.get_argval('--flann-hash-mode', type_=str,
+                                default='full')
+
+# Number of rows hashed by the sampled hash mode
+FLANN_HASH_NUM_SAMPLES = 4096
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+def _stream_hash(arr, chunksize=2 ** 24):
+    """
+    Non-cryptographic 64 bit hash of the raw buffer of an array in chunks.
+    Uses xxhash if it is installed and zlib crc32 / adler32 otherwise.
+    """
+    buf = memoryview(np.ascontiguousarray(arr)).cast('B')
+    if xxhash is not None:
+        hasher = xxhash.xxh3_64()
+        for start in range(0, len(buf), chunksize):
+            hasher.update(buf[start:start + chunksize])
+        return 'x' + hasher.hexdigest()
+    import zlib
+    crc = 0
+    adler = 1
+    for start in range(0, len(buf), chunksize):
+        chunk = buf[start:start + chunksize]
+        crc = zlib.crc32(chunk, crc)
+        adler = zlib.adler32(chunk, adler)
+    return 'z%08x%08x' % (crc, adler)
+
+
+def get_data_hashstr(dpts, hash_mode=None, lbl='_DPTS', content_id=None,
+                     num_samples=None):
+    """
+    Hashes the data of a nearest neighbor index for its cache key
+
+    Args:
+        dpts (ndarray): indexed data
+        hash_mode (str): how the data is hashed (defaults to FLANN_HASH_MODE)
+            full - ut.hashstr_arr27 of the data (backwards compatible)
+            fast - non-cryptographic streaming hash of the raw buffer
+            sampled - fast hash of num_samples evenly strided rows. This
+                costs milliseconds on any size of data, but it cannot tell
+                apart arrays that only differ outside the sampled rows.
+        lbl (str): prefix
+        content_id (str): caller supplied id of the data. The data is not
+            hashed when given, so the caller must ensure the id changes when
+            the data does.
+        num_samples (int): rows used by the sampled hash mode
+            (defaults to FLANN_HASH_NUM_SAMPLES)
+
+    The shape and dtype are always part of the hash.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.nearest_neighbors import *  # NOQA
+        >>> rng = np.random.RandomState(1)
+        >>> dpts = rng.randint(0, 255, (10000, 128)).astype(np.uint8)
+        >>> print(get_data_hashstr(dpts, 'full'))
+        _DPTS((10000,128)fujnlpwhttnnwmnv)
+        >>> print(get_data_hashstr(dpts, content_id='annots_v3'))
+        _DPTS((10000,128)uint8_id_annots_v3)
+        >>> fast1 = get_data_hashstr(dpts, 'fast')
+        >>> samp1 = get_data_hashstr(dpts, 'sampled', num_samples=100)
+        >>> dpts[0, 0] += 1
+        >>> fast2 = get_data_hashstr(dpts, 'fast')
+        >>> samp2 = get_data_hashstr(dpts, 'sampled', num_samples=100)
+        >>> dpts[1, 0] += 1
+        >>> samp3 = get_data_hashstr(dpts, 'sampled', num_samples=100)
+        >>> assert fast1 != fast2 and samp1 != samp2
+        >>> # Changes outside of the sampled rows are not detected
+        >>> assert samp2 == samp3
+        >>> assert get_data_hashstr(dpts.astype(np.float32), 'fast') != fast2
+    """
+    if hash_mode is None:
+        hash_mode = FLANN_HASH_MODE
+    if content_id is None and hash_mode == 'full':
+        return ut.hashstr_arr27(dpts, lbl)
+    dpts = np.asarray(dpts)
+    shape_str = ','.join(map(str, dpts.shape))
+    if content_id is not None:
+        hashstr = 'id_' + re.sub(r'[^\w.-]', '_', str(content_id))
+    elif hash_mode == 'fast':
+        hashstr = 'fast_' + _stream_hash(dpts)
+    elif hash_mode == 'sampled':
+        if num_samples is None:
+            num_samples = FLANN_HASH_NUM_SAMPLES
+        if len(dpts) > num_samples:
+            sample_idxs = np.linspace(0, len(dpts) - 1, num_samples)
+            dpts = dpts.take(sample_idxs.astype(np.int64), axis=0)
+        hashstr = 'samp%d_%s' % (num_samples, _stream_hash(dpts))
+    else:
+        raise KeyError('Unknown hash_mode=%r' % (hash_mode,))
+    return '%s((%s)%s_%s)' % (lbl, shape_str, dpts.dtype.name, hashstr)
+
+
 def get_flann_cfgstr(dpts, flann_params, cfgstr='', use_params_hash=True,
-                     use_data_hash=True):
+                     use_data_hash=True, hash_mode=None, content_id=None):
     """
 
     CommandLine:
@@ -322,14 +1072,15 @@ def get_flann_cfgstr(dpts, flann_params, cfgstr='', use_params_hash=True,
     # Generate a unique filename for dpts and flann parameters
     if use_data_hash:
         # flann is dependent on the dpts
-        data_hashstr = ut.hashstr_arr27(dpts, '_DPTS')
+        data_hashstr = get_data_hashstr(dpts, hash_mode, '_DPTS',
+                                        content_id=content_id)
         flann_cfgstr += data_hashstr
     return flann_cfgstr
 
 
 def get_flann_fpath(dpts, cache_dir='default', cfgstr='', flann_params={},
                     use_params_hash=True, use_data_hash=True, appname='vtool_ibeis',
-                    verbose=True):
+                    verbose=True, hash_mode=None, content_id=None):
     """ returns filepath for flann index """
     if cache_dir == 'default':
         if verbose:
@@ -338,7 +1089,8 @@ def get_flann_fpath(dpts, cache_dir='default', cfgstr='', flann_params={},
         ub.ensuredir(cache_dir)
     flann_cfgstr = get_flann_cfgstr(dpts, flann_params, cfgstr,
                                     use_params_hash=use_params_hash,
-                                    use_data_hash=use_data_hash)
+                                    use_data_hash=use_data_hash,
+                                    hash_mode=hash_mode, content_id=content_id)
     if verbose:
         print('...flann_cache cfgstr = %r: ' % flann_cfgstr)
     # Append any user labels
@@ -347,12 +1099,296 @@ def get_flann_fpath(dpts, cache_dir='default', cfgstr='', flann_params={},
     return flann_fpath
 
 
+def get_index_nbytes(index):
+    """
+    Number of bytes used by a nearest neighbor index and its data
+    """
+    nbytes = index.used_memory()
+    if hasattr(index, 'used_memory_dataset'):
+        # pyflann reports the data separately
+        nbytes += index.used_memory_dataset()
+    return nbytes
+
+
+def _index_is_live(index):
+    """ False if the index was freed with delete_index """
+    try:
+        index.get_indexed_shape()
+    except Exception:
+        return False
+    return True
+
+
+class NNIndexRegistry(object):
+    """
+    Process-wide LRU registry of loaded nearest neighbor indexes
+
+    `flann_cache` looks up indexes by their cache path before loading them
+    from disk. Least recently used indexes are evicted when the indexes use
+    more than max_bytes (see `get_index_nbytes`) and freed with
+    `delete_index`.
+
+    Indexes returned by `get` are shared and may be freed by a later
+    eviction. Use `lease` (or `acquire` / `release`) to use an index while
+    other threads register indexes. An evicted index is freed when its last
+    lease is released. Indexes that were freed or resized by their users are
+    dropped on lookup and are not freed on eviction.
+
+    Args:
+        max_bytes (int): memory cap of the registered indexes
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.nearest_neighbors import *  # NOQA
+        >>> from vtool_ibeis import demodata
+        >>> rng = np.random.RandomState(0)
+        >>> dpts = demodata.testdata_dummy_sift(100, rng=rng)
+        >>> registry = NNIndexRegistry(max_bytes=150000)
+        >>> indexes = {}
+        >>> for key in ['a', 'b', 'c']:
+        >>>     indexes[key] = BruteForceIndex()
+        >>>     indexes[key].build_index(dpts)
+        >>>     registry.put(key, indexes[key])
+        >>> print(get_index_nbytes(indexes['c']))
+        64400
+        >>> print(registry.get('a'))
+        None
+        >>> with registry.lease('b') as held:
+        >>>     registry.put('d', registry.get('c'))
+        >>>     # b was evicted, but it is not freed while it is leased
+        >>>     assert held.nn_index(dpts[0:2], 1)[0].tolist() == [0, 1]
+        >>> # a and b were freed
+        >>> assert indexes['a'].dvecs is None and indexes['b'].dvecs is None
+        >>> # Indexes freed by their users are dropped
+        >>> indexes['c'].delete_index()
+        >>> print(registry.get('c'))
+        None
+        >>> print(ub.repr2(registry.stats(), nl=1, precision=2))
+        {
+            'deferred': 1,
+            'evictions': 2,
+            'hit_rate': 0.50,
+            'hits': 2,
+            'max_bytes': 150000,
+            'misses': 2,
+            'num_indexes': 1,
+            'stale': 1,
+            'total_bytes': 64400,
+        }
+        >>> # An index resized by its user is not freed on eviction
+        >>> indexes['e'] = BruteForceIndex()
+        >>> indexes['e'].build_index(dpts)
+        >>> registry.put('e', indexes['e'])
+        >>> indexes['e'].add_points(dpts[0:10])
+        >>> for key in ['f', 'g']:
+        >>>     indexes[key] = BruteForceIndex()
+        >>>     indexes[key].build_index(dpts)
+        >>>     registry.put(key, indexes[key])
+        >>> print(indexes['e'].get_indexed_shape())
+        (110, 128)
+    """
+    def __init__(self, max_bytes=2 ** 30):
+        self.max_bytes = max_bytes
+        # key -> (index, nbytes, shape)
+        self._entries = ub.odict()
+        # id(index) -> number of leases
+        self._users = {}
+        # id(index) -> evicted index that is freed on its last release
+        self._deferred = {}
+        self._lock = threading.RLock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.deferred = 0
+        self.stale = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """ returns the index registered under key and marks it as used """
+        with self._lock:
+            if key in self._entries:
+                index, _, shape = self._entries[key]
+                if not _index_is_live(index) or (
+                        tuple(index.get_indexed_shape()) != shape):
+                    # Freed or modified by a user, who now owns it
+                    self.stale += 1
+                    self.discard(key)
+                else:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return index
+            self.misses += 1
+            return default
+
+    def acquire(self, key):
+        """
+        Returns the index registered under key (or None) and keeps it from
+        being freed until it is released
+        """
+        with self._lock:
+            index = self.get(key)
+            if index is not None:
+                self._users[id(index)] = self._users.get(id(index), 0) + 1
+            return index
+
+    def release(self, index):
+        with self._lock:
+            num_users = self._users.pop(id(index)) - 1
+            if num_users > 0:
+                self._users[id(index)] = num_users
+            elif id(index) in self._deferred:
+                self._deferred.pop(id(index)).delete_index()
+
+    @contextlib.contextmanager
+    def lease(self, key):
+        """ context manager of `acquire` and `release` """
+        index = self.acquire(key)
+        try:
+            yield index
+        finally:
+            if index is not None:
+                self.release(index)
+
+    def put(self, key, index):
+        """
+        Registers an index and evicts the least recently used indexes that
+        do not fit. Indexes larger than max_bytes are not registered.
+        """
+        nbytes = get_index_nbytes(index)
+        shape = tuple(index.get_indexed_shape())
+        with self._lock:
+            self.discard(key)
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (index, nbytes, shape)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                _, (old_index, old_nbytes, old_shape) = self._entries.popitem(
+                    last=False)
+                self.total_bytes -= old_nbytes
+                self.evictions += 1
+                if any(entry[0] is old_index
+                       for entry in self._entries.values()):
+                    # Also registered under another key
+                    continue
+                if not _index_is_live(old_index) or (
+                        tuple(old_index.get_indexed_shape()) != old_shape):
+                    # Freed or modified by a user, who now owns it
+                    self.stale += 1
+                    continue
+                if self._users.get(id(old_index), 0) > 0:
+                    self.deferred += 1
+                    self._deferred[id(old_index)] = old_index
+                else:
+                    old_index.delete_index()
+
+    def discard(self, key):
+        """
+        Unregisters an index without freeing it, e.g. before modifying it
+        """
+        with self._lock:
+            if key in self._entries:
+                _, nbytes, _ = self._entries.pop(key)
+                self.total_bytes -= nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            num_lookups = self.hits + self.misses
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'deferred': self.deferred,
+                'stale': self.stale,
+                'hit_rate': self.hits / num_lookups if num_lookups else 0.0,
+                'num_indexes': len(self._entries),
+                'total_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+            }
+        return stats
+
+
+FLANN_REGISTRY_MAX_BYTES = ut.get_argval('--flann-registry-max-bytes',
+                                         type_=int, default=2 ** 30)
+
+# Indexes loaded or built by flann_cache in this process
+FLANN_INDEX_REGISTRY = NNIndexRegistry(max_bytes=FLANN_REGISTRY_MAX_BYTES)
+
+
 def flann_cache(dpts, cache_dir='default', cfgstr='', flann_params={},
                 use_cache=True, save=True, use_params_hash=True,
-                use_data_hash=True, appname='vtool_ibeis', verbose=None):
+                use_data_hash=True, appname='vtool_ibeis', verbose=None,
+                backend='flann', hash_mode=None, content_id=None,
+                registry=None):
     """
     Tries to load a cached flann index before doing anything
     from vtool_ibeis.nn
+
+    Args:
+        backend (str): name of the nearest neighbor backend in NN_BACKENDS
+            or 'auto' to choose one based on the number of points.
+            Indexes of backends other than flann are cached under their own
+            name.
+        hash_mode (str): how the data is hashed for the cache key. Use
+            'fast' or 'sampled' to make cache hits on large data cheap
+            (see get_data_hashstr).
+        content_id (str): caller supplied id of dpts used instead of a hash
+        registry (NNIndexRegistry): opt-in in memory cache of loaded
+            indexes that is checked before the disk. 'default' uses
+            FLANN_INDEX_REGISTRY. An index from a registry is shared with
+            the other callers and is freed when it is evicted (unless it is
+            leased, see NNIndexRegistry.lease), so only use one for indexes
+            that are not kept or modified with add_points / remove_points.
+            Defaults to None, which returns a new index owned by the caller.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.nearest_neighbors import *  # NOQA
+        >>> from vtool_ibeis import demodata
+        >>> import ubelt as ub
+        >>> cache_dir = ub.ensure_app_cache_dir('vtool_ibeis', 'test_nn_backend')
+        >>> dpts = demodata.testdata_dummy_sift(100, rng=np.random.RandomState(0))
+        >>> registry = NNIndexRegistry()
+        >>> index = flann_cache(dpts, cache_dir, backend='kdtree', verbose=0,
+        >>>                     registry=registry)
+        >>> index2 = flann_cache(dpts, cache_dir, backend='kdtree', verbose=0,
+        >>>                      registry=registry)
+        >>> print(ub.Path(index.flann_fpath).name)
+        flann_index_NN(kdtree)_FLANN()_DPTS((100,128)ddaizqywrofsahcj).flann
+        >>> assert np.all(index.nn_index(dpts[0:5], 2)[0] ==
+        >>>               index2.nn_index(dpts[0:5], 2)[0])
+        >>> # The second call reuses the loaded index
+        >>> assert index2 is index
+        >>> # Without a registry the caller owns a new index
+        >>> index3 = flann_cache(dpts, cache_dir, backend='kdtree', verbose=0)
+        >>> assert index3 is not index
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> # xdoctest: +REQUIRES(module:pyflann_ibeis)
+        >>> from vtool_ibeis.nearest_neighbors import *  # NOQA
+        >>> from vtool_ibeis import demodata
+        >>> import ubelt as ub
+        >>> cache_dir = ub.ensure_app_cache_dir('vtool_ibeis', 'test_nn_backend')
+        >>> dpts = demodata.testdata_dummy_sift(100, rng=np.random.RandomState(1))
+        >>> flann = flann_cache(dpts, cache_dir, verbose=0, registry='default')
+        >>> # A shared index that was freed by a caller is reloaded
+        >>> flann.delete_index()
+        >>> flann2 = flann_cache(dpts, cache_dir, verbose=0, registry='default')
+        >>> assert flann2 is not flann
+        >>> print(flann2.nn_index(dpts[0:3], 1, checks=128)[0])
+        [0 1 2]
     """
     if verbose is None:
         verbose = int(ut.NOT_QUIET)
@@ -363,12 +1399,29 @@ def flann_cache(dpts, cache_dir='default', cfgstr='', flann_params={},
     if len(dpts) == 0:
         raise ValueError(
             'cannot build flann when len(dpts) == 0. (prevents a segfault)')
+    if backend == 'auto':
+        backend = choose_nn_backend(len(dpts))
+    if backend != 'flann':
+        cfgstr = '_NN(%s)' % (backend,) + cfgstr
     flann_fpath = get_flann_fpath(dpts, cache_dir, cfgstr, flann_params,
                                   use_params_hash=use_params_hash,
                                   use_data_hash=use_data_hash, appname=appname,
-                                  verbose=verbose)
+                                  verbose=verbose, hash_mode=hash_mode,
+                                  content_id=content_id)
+    if registry == 'default':
+        registry = FLANN_INDEX_REGISTRY
+    if not use_cache:
+        registry = None
+    if registry is not None:
+        flann = registry.get(flann_fpath)
+        if flann is not None:
+            if verbose > 0:
+                print('...flann registry hit: %d vectors' % (len(dpts)))
+            if verbose > 1:
+                print('L___ END FLANN INDEX ')
+            return flann
     # Load the index if it exists
-    flann = FLANN_CLS()
+    flann = make_nn_index(backend)
     flann.flann_fpath = flann_fpath
 
     if use_cache and exists(flann_fpath):
@@ -378,6 +1431,8 @@ def flann_cache(dpts, cache_dir='default', cfgstr='', flann_params={},
                 print('...flann cache hit: %d vectors' % (len(dpts)))
             if verbose > 1:
                 print('L___ END FLANN INDEX ')
+            if registry is not None:
+                registry.put(flann_fpath, flann)
             return flann
         except Exception as ex:
             ut.printex(ex, '... cannot load index', iswarning=True)
@@ -385,8 +1440,6 @@ def flann_cache(dpts, cache_dir='default', cfgstr='', flann_params={},
     if verbose > 0:
         print('...flann cache miss.')
     num_dpts = len(dpts)
-    if flann is None:
-        flann = FLANN_CLS()
     if verbose > 1 or (verbose > 0 and num_dpts > 1E6):
         print('...building kdtree over %d points (this may take a sec).' % num_dpts)
     if num_dpts == 0:
@@ -398,35 +1451,151 @@ def flann_cache(dpts, cache_dir='default', cfgstr='', flann_params={},
         print('flann.save_index(%r)' % ut.path_ndir_split(flann_fpath, n=2))
     if save:
         flann.save_index(flann_fpath)
+    if registry is not None:
+        registry.put(flann_fpath, flann)
     if verbose > 1:
         print('L___ END CACHED FLANN INDEX ')
     return flann
 
 
+# flann_augment rebuilds the index over all vectors instead of adding to it
+# when the index grows by more than this factor
+FLANN_REBUILD_FACTOR = ut.get_argval('--flann-rebuild-factor', type_=float,
+                                     default=2.0)
+
+
+def get_flann_delta_fpath(flann_fpath, new_cfgstr):
+    """ returns the filepath of a delta saved alongside an index """
+    return splitext(flann_fpath)[0] + new_cfgstr + '.delta.npz'
+
+
+def apply_flann_delta(flann, delta_fpath):
+    """
+    Adds the vectors and removes the ids saved by flann_augment. The index
+    must be the one the delta was saved alongside.
+    """
+    delta = np.load(delta_fpath)
+    new_dpts = delta['new_dpts']
+    removed_ids = delta['removed_ids']
+    if len(new_dpts) > 0:
+        flann.add_points(new_dpts)
+    if len(removed_ids) > 0:
+        flann.remove_points(removed_ids)
+    flann.delta_fpath = delta_fpath
+    return flann
+
+
 def flann_augment(dpts, new_dpts, cache_dir, cfgstr, new_cfgstr, flann_params,
-                  use_cache=True, save=True):
+                  use_cache=True, save=True, idx2_label=None,
+                  remove_labels=None, rebuild_factor=None, hash_mode=None,
+                  content_id=None, verbose=None):
     """
+    Adds new_dpts to the cached index of dpts and removes the vectors of
+    remove_labels without rebuilding the index.
+
+    The index file of dpts is not rewritten. The added vectors and removed
+    ids are saved in a delta file alongside it instead (see
+    apply_flann_delta). If the index would grow by more than rebuild_factor
+    it is rebuilt over all vectors and cached under new_cfgstr. Either way
+    ids are rows of vstack([dpts, new_dpts]) and removed vectors are
+    tombstones that are never returned. Tombstones stay in the index, also
+    when it is rebuilt, so removals alone never trigger a rebuild.
+
+    Args:
+        dpts (ndarray): vectors of the cached index
+        new_dpts (ndarray): vectors to add
+        cache_dir (str): flann cache directory
+        cfgstr (str): cfgstr of the cached index
+        new_cfgstr (str): cfgstr of the augmented index
+        flann_params (dict):
+        use_cache (bool): load the index of dpts if it is cached
+        save (bool): save the delta (or the rebuilt index)
+        idx2_label (ndarray): label of each of the stacked dpts and new_dpts,
+            e.g. the labels returned by invertible_stack. Required to
+            remove labels.
+        remove_labels (list): labels whose vectors are removed
+        rebuild_factor (float): defaults to FLANN_REBUILD_FACTOR
+        hash_mode (str): see get_data_hashstr
+        content_id (str): caller supplied id of dpts
+
+    Returns:
+        flann: index over the stacked vectors
+
     Example:
-        >>> # DISABLE_DOCTEST
+        >>> # ENABLE_DOCTEST
         >>> # xdoctest: +REQUIRES(module:pyflann_ibeis)
         >>> from vtool_ibeis.nearest_neighbors import *  # NOQA
         >>> import vtool_ibeis.demodata as demodata  # NOQA
-        >>> dpts = demodata.get_dummy_dpts(ut.get_nth_prime(10))
-        >>> new_dpts = demodata.get_dummy_dpts(ut.get_nth_prime(9))
-        >>> cache_dir = ut.get_app_resource_dir('vtool_ibeis')
+        >>> rng = np.random.RandomState(0)
+        >>> vecs_list = [demodata.testdata_dummy_sift(n, rng=rng)
+        >>>              for n in [300, 200, 100, 50]]
+        >>> idx2_vec, idx2_label, _ = invertible_stack(vecs_list, [1, 2, 3, 4])
+        >>> dpts, new_dpts = idx2_vec[0:500], idx2_vec[500:]
+        >>> cache_dir = ub.ensure_app_cache_dir('vtool_ibeis', 'test_augment')
         >>> cfgstr = '_testcfg'
         >>> new_cfgstr = '_new_testcfg'
         >>> flann_params = get_kdtree_flann_params()
-        >>> use_cache = False
-        >>> save = False
+        >>> flann = flann_augment(dpts, new_dpts, cache_dir, cfgstr,
+        >>>                       new_cfgstr, flann_params,
+        >>>                       idx2_label=idx2_label, remove_labels=[2],
+        >>>                       verbose=0)
+        >>> # The new vectors were added and label 2 was removed
+        >>> idxs = flann.nn_index(idx2_vec, 1, checks=512)[0]
+        >>> print(np.unique(idx2_label[idxs]))
+        [1 3 4]
+        >>> assert np.all(idxs[500:] == np.arange(500, 650))
+        >>> # Loading the base index and its delta gives the same index
+        >>> flann2 = flann_cache(dpts, cache_dir, cfgstr, flann_params,
+        >>>                      verbose=0)
+        >>> flann2 = apply_flann_delta(flann2, flann.delta_fpath)
+        >>> assert np.all(flann2.nn_index(idx2_vec, 1, checks=512)[0] == idxs)
+        >>> # Labels must cover the stacked vectors
+        >>> ut.assert_raises(ValueError, flann_augment, dpts, new_dpts,
+        >>>                  cache_dir, cfgstr, new_cfgstr, flann_params,
+        >>>                  idx2_label=idx2_label[0:500], remove_labels=[2])
     """
-    flann = flann_cache(dpts, cache_dir, cfgstr, flann_params)
-    flann.add_points(new_dpts)
-    if save:
+    if rebuild_factor is None:
+        rebuild_factor = FLANN_REBUILD_FACTOR
+    if verbose is None:
+        verbose = int(ut.NOT_QUIET)
+    num_base = len(dpts)
+    num_total = num_base + len(new_dpts)
+    if remove_labels is not None and len(remove_labels) > 0:
+        if idx2_label is None or len(idx2_label) != num_total:
+            raise ValueError(
+                'idx2_label must label the %d stacked dpts and new_dpts' % (
+                    num_total,))
+        removed_ids = np.flatnonzero(np.isin(idx2_label, remove_labels))
+    else:
+        removed_ids = np.empty(0, dtype=np.int64)
+    needs_rebuild = num_total > num_base * rebuild_factor
+    if needs_rebuild:
+        if verbose > 0:
+            print('...rebuilding the index over %d points' % (num_total,))
         aug_dpts = np.vstack((dpts, new_dpts))
-        new_flann_fpath = get_flann_fpath(
-            aug_dpts, cache_dir, new_cfgstr, flann_params)
-        flann.save_index(new_flann_fpath)
+        flann = flann_cache(aug_dpts, cache_dir, new_cfgstr, flann_params,
+                            use_cache=use_cache, save=save,
+                            hash_mode=hash_mode, content_id=content_id,
+                            verbose=verbose)
+        added_dpts = new_dpts[0:0]
+    else:
+        flann = flann_cache(dpts, cache_dir, cfgstr, flann_params,
+                            use_cache=use_cache, save=save,
+                            hash_mode=hash_mode, content_id=content_id,
+                            verbose=verbose)
+        if len(new_dpts) > 0:
+            # Our policy decides when to rebuild, not flann's
+            flann.add_points(new_dpts, rebuild_threshold=np.inf)
+        added_dpts = new_dpts
+    if len(removed_ids) > 0:
+        flann.remove_points(removed_ids)
+    flann.delta_fpath = None
+    if save and (len(added_dpts) > 0 or len(removed_ids) > 0):
+        delta_fpath = get_flann_delta_fpath(flann.flann_fpath, new_cfgstr)
+        if verbose > 1:
+            print('...saving flann delta to %r' % (delta_fpath,))
+        np.savez(delta_fpath, new_dpts=added_dpts, removed_ids=removed_ids)
+        flann.delta_fpath = delta_fpath
     return flann
 
 
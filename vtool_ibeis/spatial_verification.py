@@ -27,6 +27,9 @@ Notes:
 """
 from __future__ import absolute_import, division, print_function
 from six.moves import range
+import contextlib
+import threading
+import time
 import warnings  # NOQA
 import six  # NOQA
 import utool as ut
@@ -44,6 +47,8 @@ from .util_math import TAU
 
 try:
     from vtool_ibeis import sver_c_wrapper
+    # The wrapper module imports the extension lazily, so check it here
+    from vtool_ibeis_ext import sver_c_wrapper as _sver_c_ext  # NOQA
     HAVE_SVER_C_WRAPPER = not ut.get_argflag('--no-c')
 except Exception as ex:
     HAVE_SVER_C_WRAPPER = False
@@ -55,9 +60,41 @@ except Exception as ex:
 
 VERBOSE_SVER = ut.get_argflag('--verb-sver')
 
+# Backend of get_best_affine_inliers_: 'auto', 'c', or 'python'
+SVER_BACKEND = ut.get_argval('--sver-backend', type_=str, default='auto')
+# Number of warm runs of each backend the auto backend times per size bucket
+SVER_BACKEND_TRIALS = ut.get_argval('--sver-backend-trials', type_=int,
+                                    default=3)
+# Parity check result and the per size bucket choices of the auto backend
+_SVER_BACKEND_STATE = {
+    'parity': None,
+    'choice': {},
+    'times': {},
+}
+
 SV_DTYPE = np.float64
 INDEX_DTYPE = np.int32
 
+# Approximate number of bytes of working memory the vectorized hypothesis
+# tests may use at once
+SVER_MEM_BUDGET = ut.get_argval('--sver-mem-budget', type_=int, default=2 ** 27)
+# Bytes of temporary memory needed per (hypothesis, correspondence) test
+_SVER_BYTES_PER_TEST = 16 * np.dtype(SV_DTYPE).itemsize
+
+SVER_HYPOTHESIS_STRATEGIES = ['exhaustive', 'topk_by_fs', 'preemptive',
+                              'dedup']
+# Default number of fully scored hypotheses for the budgeted strategies
+SVER_MAX_HYPOTHESES = 256
+# Number of correspondences used in the first round of preemptive scoring
+SVER_PREEMPT_BLOCKSIZE = 32
+# Number of hypothesis cells expanded by the dedup strategy
+SVER_DEDUP_TOPK = ut.get_argval('--sver-dedup-topk', type_=int, default=4)
+# Number of hypotheses of each expanded cell that are fully scored
+SVER_DEDUP_PER_CELL = ut.get_argval('--sver-dedup-per-cell', type_=int,
+                                    default=32)
+# Size of the dedup cells as a fraction of the inlier thresholds
+SVER_DEDUP_BINFRAC = .25
+
 
 def build_lstsqrs_Mx9(xy1_mn, xy2_mn):
     """ Builds the M x 9 least squares matrix
@@ -365,6 +402,198 @@ def compute_homog(xy1_mn, xy2_mn):
     return H
 
 
+# Recorders that are currently collecting instrumentation records
+_SVER_RECORDERS = []
+# Holds the record of the spatially_verify_kpts call in each thread
+_SVER_LOCAL = threading.local()
+
+
+class SverRecorder(ut.NiceRepr):
+    """
+    Opt-in instrumentation of spatially_verify_kpts.
+
+    While a recorder is active (as a context manager), every call to
+    spatially_verify_kpts, in any thread, produces a record. A record is a
+    dict with the following items.
+
+    Counts:
+        num_fm, num_hypotheses, num_aff_inliers, num_refined_inliers
+
+    Timings in seconds (summed if a stage runs more than once):
+        time_total, time_build_hypotheses, time_test_hypotheses,
+        time_normalize, time_estimate_transform, time_test_refined
+
+    Exit reason (exit_reason):
+        'no_matches', 'too_few_aff_inliers', 'too_few_for_refine',
+        'max_inliers', 'linalg_error', 'cv2_error', 'unknown_error', or
+        'success'. If spatially_verify_kpts raises, the record is still
+        finished with the reason 'exception' and the error propagates.
+
+    When the C extension is used, generating and testing the hypotheses
+    is a single call, so it is all counted in time_test_hypotheses.
+
+    Args:
+        callback (func): called with each record as it is finished
+        keep (bool): if False records are only sent to the callback
+
+    CommandLine:
+        python -m vtool_ibeis.spatial_verification SverRecorder
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.spatial_verification import *  # NOQA
+        >>> import vtool_ibeis.demodata as demodata
+        >>> kpts1 = demodata.perterbed_grid_kpts(seed=1, wh_stride=(20, 20))
+        >>> kpts2 = demodata.perterbed_grid_kpts(seed=2, wh_stride=(20, 20))
+        >>> rng = np.random.RandomState(0)
+        >>> fm = np.vstack([np.arange(140), rng.permutation(140)]).T
+        >>> fm[:70, 1] = fm[:70, 0]
+        >>> fm = fm.astype(np.int32)
+        >>> fs = rng.rand(len(fm))
+        >>> with SverRecorder() as recorder:
+        >>>     for num in [0, 3, 140]:
+        >>>         svtup = spatially_verify_kpts(kpts1, kpts2, fm[:num],
+        >>>                                       match_weights=fs[:num])
+        >>> print([record['exit_reason'] for record in recorder.records])
+        ['no_matches', 'too_few_aff_inliers', 'success']
+        >>> record = recorder.records[-1]
+        >>> print(ut.repr2(ut.dict_subset(record, ['num_fm', 'num_hypotheses'])))
+        {'num_fm': 140, 'num_hypotheses': 140}
+        >>> assert record['time_total'] >= record['time_test_refined'] > 0
+        >>> stats = recorder.summary()
+        >>> print(ut.repr2(stats['exit_reason'], sorted_=True))
+        {'no_matches': 1, 'success': 1, 'too_few_aff_inliers': 1}
+        >>> print(stats['num_fm']['hist'].sum())
+        3
+        >>> # A failing call is recorded before the error propagates
+        >>> with SverRecorder() as recorder:
+        >>>     ut.assert_raises(IndexError, spatially_verify_kpts,
+        >>>                      kpts1, kpts2, fm + 1000, match_weights=fs)
+        >>> print(recorder.records[0]['exit_reason'])
+        exception
+    """
+
+    def __init__(recorder, callback=None, keep=True):
+        recorder.callback = callback
+        recorder.keep = keep
+        recorder.records = []
+
+    def __nice__(recorder):
+        return 'num_records=%d' % (len(recorder.records),)
+
+    def __enter__(recorder):
+        _SVER_RECORDERS.append(recorder)
+        return recorder
+
+    def __exit__(recorder, ex_type, ex_value, ex_traceback):
+        _SVER_RECORDERS.remove(recorder)
+
+    def _add_record(recorder, record):
+        if recorder.keep:
+            recorder.records.append(record)
+        if recorder.callback is not None:
+            recorder.callback(record)
+
+    def summary(recorder, time_bins=None, count_bins=None):
+        """
+        Aggregates the records into histograms.
+
+        Args:
+            time_bins (ndarray): bin edges for timings (default is log spaced
+                from 1us to 10s)
+            count_bins (ndarray): bin edges for counts (default is powers of 2)
+
+        Returns:
+            dict: stats - for each timing and count key the number of
+                records, total, mean, median, max and histogram. The exit
+                reasons are counted.
+        """
+        if time_bins is None:
+            time_bins = np.logspace(-6, 1, 22)
+        if count_bins is None:
+            count_bins = np.hstack([[0], 2 ** np.arange(0, 16)])
+        records = recorder.records
+        keys = sorted(set(ut.flatten([record.keys() for record in records])))
+        stats = ut.odict()
+        for key in keys:
+            if key == 'exit_reason':
+                continue
+            vals = np.array([record[key] for record in records if key in record],
+                            dtype=np.float64)
+            bins = time_bins if key.startswith('time_') else count_bins
+            hist = np.histogram(vals, bins=bins)[0]
+            stats[key] = ut.odict([
+                ('num', len(vals)),
+                ('total', vals.sum()),
+                ('mean', vals.mean()),
+                ('median', np.median(vals)),
+                ('max', vals.max()),
+                ('bins', bins),
+                ('hist', hist),
+            ])
+        stats['exit_reason'] = ut.dict_hist(
+            [record['exit_reason'] for record in records
+             if 'exit_reason' in record])
+        return stats
+
+
+def _begin_sver_record():
+    """ Starts a record for this thread if any recorder is active """
+    if not _SVER_RECORDERS:
+        return None
+    record = {'_start': time.perf_counter()}
+    _SVER_LOCAL.record = record
+    return record
+
+
+def _finish_sver_record(record, exit_reason=None):
+    if record is None:
+        return
+    _SVER_LOCAL.record = None
+    record['time_total'] = time.perf_counter() - record.pop('_start')
+    if exit_reason is not None:
+        record['exit_reason'] = exit_reason
+    for recorder in list(_SVER_RECORDERS):
+        recorder._add_record(record)
+
+
+def _note_sver(key, value):
+    """ Sets a value in the current record (if one exists) """
+    record = getattr(_SVER_LOCAL, 'record', None)
+    if record is not None:
+        record[key] = value
+
+
+@contextlib.contextmanager
+def _paused_sver_record():
+    """ Keeps extra work (e.g. backend timing) out of the current record """
+    record = getattr(_SVER_LOCAL, 'record', None)
+    _SVER_LOCAL.record = None
+    try:
+        yield
+    finally:
+        _SVER_LOCAL.record = record
+
+
+class _SverStage(object):
+    """ Adds the time spent in a with block to the current record """
+    __slots__ = ('key', 'record', 'start')
+
+    def __init__(stage, name):
+        stage.key = 'time_' + name
+
+    def __enter__(stage):
+        stage.record = getattr(_SVER_LOCAL, 'record', None)
+        if stage.record is not None:
+            stage.start = time.perf_counter()
+
+    def __exit__(stage, ex_type, ex_value, ex_traceback):
+        if stage.record is not None:
+            duration = time.perf_counter() - stage.start
+            record = stage.record
+            record[stage.key] = record.get(stage.key, 0.0) + duration
+
+
 def testdata_matching_affine_inliers():
     import vtool_ibeis.demodata as demodata
     import vtool_ibeis as vt
@@ -476,6 +705,239 @@ def _test_hypothesis_inliers(Aff, invVR1s_m, xy2_m, det2_m, ori2_m,
     return hypo_inliers, hypo_errors
 
 
+class KptsGeometry(ut.NiceRepr):
+    """
+    The keypoint geometry used to build and test affine hypotheses,
+    precomputed once per annotation.
+
+    An annotation is typically verified against many others, so this avoids
+    redoing the 3x3 algebra for every pair. Anywhere spatial verification
+    accepts keypoints, it also accepts a KptsGeometry. The matched rows are
+    then gathered with `take`.
+
+    Attributes:
+        kpts (ndarray): (N, 6) float64 keypoints
+        invVR (ndarray): (N, 3, 3) keypoint shapes (see get_invVR_mats3x3)
+        RV (ndarray): (N, 3, 3) inverted keypoint shapes
+        xy (ndarray): (2, N) keypoint locations
+        det (ndarray): (N,) squared keypoint scales
+        ori (ndarray): (N,) keypoint orientations
+
+    CommandLine:
+        python -m vtool_ibeis.spatial_verification KptsGeometry
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.spatial_verification import *  # NOQA
+        >>> import vtool_ibeis.demodata as demodata
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((100, 100))
+        >>> fm = demodata.make_dummy_fm(len(kpts1)).astype(np.int32)
+        >>> fs = np.ones(len(fm))
+        >>> geom1, geom2 = KptsGeometry(kpts1), KptsGeometry(kpts2)
+        >>> print(geom1.take(fm.T[0][0:3]))
+        <KptsGeometry(nKpts=3)>
+        >>> svtup1 = spatially_verify_kpts(kpts1, kpts2, fm, match_weights=fs)
+        >>> svtup2 = spatially_verify_kpts(geom1, geom2, fm, match_weights=fs)
+        >>> assert np.all(svtup1[0] == svtup2[0])
+        >>> assert np.allclose(svtup1[2], svtup2[2])
+    """
+
+    def __init__(geom, kpts):
+        kpts = np.asarray(kpts).astype(np.float64, casting='same_kind',
+                                       copy=False)
+        geom.kpts = kpts
+        geom.invVR = ktool.get_invVR_mats3x3(kpts)
+        geom.RV = ktool.invert_invV_mats(geom.invVR)
+        geom.xy = ktool.get_xys(kpts)
+        geom.det = ktool.get_sqrd_scales(kpts)
+        geom.ori = ktool.get_oris(kpts)
+
+    @classmethod
+    def _from_parts(cls, kpts, invVR, RV, xy, det, ori):
+        geom = cls.__new__(cls)
+        geom.kpts = kpts
+        geom.invVR = invVR
+        geom.RV = RV
+        geom.xy = xy
+        geom.det = det
+        geom.ori = ori
+        return geom
+
+    @classmethod
+    def concatenate(cls, geom_list):
+        """ stacks the geometry of several sets of keypoints """
+        return cls._from_parts(
+            np.vstack([geom.kpts for geom in geom_list]),
+            np.concatenate([geom.invVR for geom in geom_list], axis=0),
+            np.concatenate([geom.RV for geom in geom_list], axis=0),
+            np.hstack([geom.xy for geom in geom_list]),
+            np.hstack([geom.det for geom in geom_list]),
+            np.hstack([geom.ori for geom in geom_list]))
+
+    def __nice__(geom):
+        return 'nKpts=%d' % (len(geom),)
+
+    def __len__(geom):
+        return len(geom.kpts)
+
+    def take(geom, indices, axis=0):
+        """ gathers the geometry of a subset of keypoints (like ndarray.take) """
+        assert axis == 0, 'can only take keypoints along the first axis'
+        return geom._from_parts(
+            geom.kpts.take(indices, axis=0), geom.invVR.take(indices, axis=0),
+            geom.RV.take(indices, axis=0), geom.xy.take(indices, axis=1),
+            geom.det.take(indices), geom.ori.take(indices))
+
+    def compress(geom, flags, axis=0):
+        """ gathers the geometry where flags is True (like ndarray.compress) """
+        return geom.take(np.where(flags)[0], axis=axis)
+
+
+def _unpack_kpts(kpts):
+    """
+    Returns the float64 keypoints and the object to build hypotheses from,
+    which is the KptsGeometry if one was given.
+    """
+    if isinstance(kpts, KptsGeometry):
+        return kpts.kpts, kpts
+    # Cast keypoints to float64 to avoid numerical issues
+    kpts = kpts.astype(np.float64, casting='same_kind', copy=False)
+    return kpts, kpts
+
+
+def _stack_kpts(kpts_list):
+    """ stacks keypoints or their KptsGeometry from several pairs """
+    if any(isinstance(kpts, KptsGeometry) for kpts in kpts_list):
+        return KptsGeometry.concatenate([
+            kpts if isinstance(kpts, KptsGeometry) else KptsGeometry(kpts)
+            for kpts in kpts_list])
+    return np.vstack(kpts_list)
+
+
+def _build_affine_hypotheses(kpts1_m, kpts2_m):
+    """
+    Builds one affine hypothesis per correspondence and the components of
+    the matched keypoints in image 2 that each hypothesis is tested against.
+
+    The inputs can be keypoints stacked from any number of annotation pairs.
+    Each output row only depends on its own correspondence. Either input may
+    be a KptsGeometry, in which case its precomputed arrays are used.
+
+    Returns:
+        tuple: Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m
+    """
+    # Get keypoints to project in matrix form
+    #invVR2s_m = ktool.get_invV_mats(kpts2_m, with_trans=True, with_ori=True)
+    #invVR1s_m = ktool.get_invV_mats(kpts1_m, with_trans=True, with_ori=True)
+    if isinstance(kpts1_m, KptsGeometry):
+        invVR1s_m = kpts1_m.invVR
+        RV1s_m    = kpts1_m.RV
+    else:
+        invVR1s_m = ktool.get_invVR_mats3x3(kpts1_m)
+        RV1s_m    = ktool.invert_invV_mats(invVR1s_m)  # 539 us
+    if isinstance(kpts2_m, KptsGeometry):
+        invVR2s_m = kpts2_m.invVR
+        xy2_m  = kpts2_m.xy
+        det2_m = kpts2_m.det
+        ori2_m = kpts2_m.ori
+    else:
+        invVR2s_m = ktool.get_invVR_mats3x3(kpts2_m)
+        # Get components to test projects against
+        xy2_m  = ktool.get_xys(kpts2_m)
+        det2_m = ktool.get_sqrd_scales(kpts2_m)
+        ori2_m = ktool.get_oris(kpts2_m)
+    # BUILD ALL HYPOTHESIS TRANSFORMS: The transform from kp1 to kp2 is:
+    Aff_mats = op.matmul(invVR2s_m, RV1s_m)
+    # SLOWER EQUIVALENT
+    # RV1s_m    = ktool.get_V_mats(kpts1_m, with_trans=True, with_ori=True)  # 5.2 ms
+    # xy2_m  = ktool.get_invVR_mats_xys(invVR2s_m)
+    # ori2_m = ktool.get_invVR_mats_oris(invVR2s_m)
+    # assert np.all(ktool.get_oris(kpts2_m) == ktool.get_invVR_mats_oris(invVR2s_m))
+    # assert np.all(ktool.get_xys(kpts2_m) == ktool.get_invVR_mats_xys(invVR2s_m))
+    return Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m
+
+
+def _test_hypotheses_errors(Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m):
+    """
+    Broadcasting version of the error computation in _test_hypothesis_inliers.
+
+    Instead of one hypothesis against all correspondences, this evaluates any
+    broadcastable arrangement of hypotheses and correspondences at once (e.g.
+    a (B, N) block or a flat list of (hypothesis, correspondence) pairs).
+    Because both Aff and invVR are affine, the projected shape is computed in
+    closed form without building the intermediate 3x3 products.
+
+    Args:
+        Aff_mats (ndarray): (..., 3, 3) affine hypotheses
+        invVR1s_m (ndarray): (..., 3, 3) keypoint shapes in image 1
+        xy2_m (ndarray): (2, ...) keypoint locations in image 2
+        det2_m (ndarray): (...) squared keypoint scales in image 2
+        ori2_m (ndarray): (...) keypoint orientations in image 2
+
+    Returns:
+        tuple: (xy_err, ori_err, scale_err) broadcast to a common shape
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.spatial_verification import *  # NOQA
+        >>> from vtool_ibeis.spatial_verification import _test_hypothesis_inliers  # NOQA
+        >>> from vtool_ibeis.spatial_verification import _build_affine_hypotheses  # NOQA
+        >>> from vtool_ibeis.spatial_verification import _test_hypotheses_errors  # NOQA
+        >>> import vtool_ibeis.demodata as demodata
+        >>> kpts1, kpts2 = demodata.get_dummy_kpts_pair((100, 100))
+        >>> parts = _build_affine_hypotheses(kpts1, kpts2)
+        >>> Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m = parts
+        >>> errors = _test_hypotheses_errors(
+        >>>     Aff_mats[:, None], invVR1s_m[None, :], xy2_m[:, None, :],
+        >>>     det2_m[None, :], ori2_m[None, :])
+        >>> assert errors[0].shape == (len(kpts1), len(kpts1))
+        >>> for Aff, xy_err, ori_err, scale_err in zip(Aff_mats, *errors):
+        >>>     _, hypo_errors = _test_hypothesis_inliers(
+        >>>         Aff, invVR1s_m, xy2_m, det2_m, ori2_m, 1, 1, 1)
+        >>>     assert np.allclose(hypo_errors[0], xy_err)
+        >>>     assert np.allclose(hypo_errors[1], ori_err)
+        >>>     assert np.allclose(hypo_errors[2], scale_err)
+    """
+    a11 = Aff_mats[..., 0, 0]
+    a12 = Aff_mats[..., 0, 1]
+    a13 = Aff_mats[..., 0, 2]
+    a21 = Aff_mats[..., 1, 0]
+    a22 = Aff_mats[..., 1, 1]
+    a23 = Aff_mats[..., 1, 2]
+    r11 = invVR1s_m[..., 0, 0]
+    r12 = invVR1s_m[..., 0, 1]
+    r21 = invVR1s_m[..., 1, 0]
+    r22 = invVR1s_m[..., 1, 1]
+    x1 = invVR1s_m[..., 0, 2]
+    y1 = invVR1s_m[..., 1, 2]
+    # Map keypoint locations from image 1 onto image 2
+    dx = a11 * x1 + a12 * y1 + a13 - xy2_m[0]
+    dy = a21 * x1 + a22 * y1 + a23 - xy2_m[1]
+    xy_err = dx * dx + dy * dy
+    # Squared scale is the determinant of the mapped shape
+    _det1_mt = (a11 * a22 - a12 * a21) * (r11 * r22 - r12 * r21)
+    scale_err = _det1_mt / det2_m
+    # Flip ratios that are less than 1 (same as distance.det_distance)
+    scale_err = np.where(scale_err < 1, np.reciprocal(scale_err), scale_err)
+    # Orientation only needs the first row of the mapped shape
+    _iv11s = a11 * r11 + a12 * r21
+    _iv12s = a11 * r12 + a12 * r22
+    _ori1_mt = (-np.arctan2(_iv12s, _iv11s)) % TAU
+    ori_err = vtool_ibeis.distance.ori_distance(_ori1_mt, ori2_m)
+    return xy_err, ori_err, scale_err
+
+
+def _flag_hypotheses_inliers(xy_err, ori_err, scale_err, xy_thresh_sqrd,
+                             scale_thresh_sqrd, ori_thresh):
+    """ Marks the errors from _test_hypotheses_errors that are inliers """
+    hypo_inliers_flag = np.less(xy_err, xy_thresh_sqrd)
+    np.logical_and(hypo_inliers_flag, np.less(ori_err, ori_thresh),
+                   out=hypo_inliers_flag)
+    np.logical_and(hypo_inliers_flag, np.less(scale_err, scale_thresh_sqrd),
+                   out=hypo_inliers_flag)
+    return hypo_inliers_flag
+
+
 def get_affine_inliers(kpts1, kpts2, fm, fs,
                         xy_thresh_sqrd,
                         scale_thresh_sqrd,
@@ -523,24 +985,8 @@ def get_affine_inliers(kpts1, kpts2, fm, fs,
     kpts1_m = kpts1.take(fm.T[0], axis=0)
     kpts2_m = kpts2.take(fm.T[1], axis=0)
 
-    # Get keypoints to project in matrix form
-    #invVR2s_m = ktool.get_invV_mats(kpts2_m, with_trans=True, with_ori=True)
-    #invVR1s_m = ktool.get_invV_mats(kpts1_m, with_trans=True, with_ori=True)
-    invVR2s_m = ktool.get_invVR_mats3x3(kpts2_m)
-    invVR1s_m = ktool.get_invVR_mats3x3(kpts1_m)
-    RV1s_m    = ktool.invert_invV_mats(invVR1s_m)  # 539 us
-    # BUILD ALL HYPOTHESIS TRANSFORMS: The transform from kp1 to kp2 is:
-    Aff_mats = op.matmul(invVR2s_m, RV1s_m)
-    # Get components to test projects against
-    xy2_m  = ktool.get_xys(kpts2_m)
-    det2_m = ktool.get_sqrd_scales(kpts2_m)
-    ori2_m = ktool.get_oris(kpts2_m)
-    # SLOWER EQUIVALENT
-    # RV1s_m    = ktool.get_V_mats(kpts1_m, with_trans=True, with_ori=True)  # 5.2 ms
-    # xy2_m  = ktool.get_invVR_mats_xys(invVR2s_m)
-    # ori2_m = ktool.get_invVR_mats_oris(invVR2s_m)
-    # assert np.all(ktool.get_oris(kpts2_m) == ktool.get_invVR_mats_oris(invVR2s_m))
-    # assert np.all(ktool.get_xys(kpts2_m) == ktool.get_invVR_mats_xys(invVR2s_m))
+    Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m = _build_affine_hypotheses(
+        kpts1_m, kpts2_m)
 
     # The previous versions of this function were all roughly comparable.
     # The for loop one was the slowest. I'm deciding to go with the one
@@ -557,6 +1003,369 @@ def get_affine_inliers(kpts1, kpts2, fm, fs,
     return aff_inliers_list, aff_errors_list, Aff_mats
 
 
+def _get_affine_hypothesis_weights(Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m,
+                                   fs, xy_thresh_sqrd, scale_thresh_sqrd,
+                                   ori_thresh, mem_budget=None):
+    """
+    Computes the total inlier weight of every hypothesis by testing blocks of
+    hypotheses against all correspondences as a single (B, N) broadcast.
+
+    The number of hypotheses B in a block is chosen such that the temporary
+    arrays fit in mem_budget bytes. No per-hypothesis inlier lists are built.
+
+    Returns:
+        ndarray: weight_list - summed fs of the inliers of each hypothesis
+    """
+    if mem_budget is None:
+        mem_budget = SVER_MEM_BUDGET
+    num_hypo = len(Aff_mats)
+    num_corr = len(invVR1s_m)
+    blocksize = max(1, int(mem_budget // max(1, num_corr * _SVER_BYTES_PER_TEST)))
+    weight_list = np.empty(num_hypo, dtype=SV_DTYPE)
+    fs = np.asarray(fs, dtype=SV_DTYPE)
+    for hx1 in range(0, num_hypo, blocksize):
+        hx2 = min(hx1 + blocksize, num_hypo)
+        errors = _test_hypotheses_errors(
+            Aff_mats[hx1:hx2, None], invVR1s_m[None, :], xy2_m[:, None, :],
+            det2_m[None, :], ori2_m[None, :])
+        flags = _flag_hypotheses_inliers(*errors, xy_thresh_sqrd=xy_thresh_sqrd,
+                                         scale_thresh_sqrd=scale_thresh_sqrd,
+                                         ori_thresh=ori_thresh)
+        weight_list[hx1:hx2] = flags.dot(fs)
+    return weight_list
+
+
+def get_best_affine_inliers_vectorized(kpts1, kpts2, fm, fs, xy_thresh_sqrd,
+                                       scale_thresh, ori_thresh,
+                                       mem_budget=None):
+    """
+    Pure numpy equivalent of get_best_affine_inliers.
+
+    All hypotheses are scored in memory bounded blocks and only the inliers
+    and errors of the winning hypothesis are computed. This avoids the python
+    loop over hypotheses in get_affine_inliers and is used when the C
+    extension is unavailable.
+
+    Args:
+        mem_budget (int): bytes of working memory to use per block.
+            Defaults to SVER_MEM_BUDGET (set with --sver-mem-budget)
+
+    Returns:
+        tuple: aff_inliers, aff_errors, Aff
+
+    CommandLine:
+        python -m vtool_ibeis.spatial_verification get_best_affine_inliers_vectorized
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.spatial_verification import *  # NOQA
+        >>> import vtool_ibeis.demodata as demodata
+        >>> _kw1 = dict(seed=12, damping=1.2, wh_stride=(30, 30))
+        >>> _kw2 = dict(seed=24, damping=1.6, wh_stride=(30, 30))
+        >>> kpts1 = demodata.perterbed_grid_kpts(**_kw1).astype(np.float64)
+        >>> kpts2 = demodata.perterbed_grid_kpts(**_kw2).astype(np.float64)
+        >>> fm = demodata.make_dummy_fm(len(kpts1)).astype(np.int32)
+        >>> fs = np.random.RandomState(0).rand(len(fm))
+        >>> xy_thresh_sqrd = ktool.get_kpts_dlen_sqrd(kpts2) * .01
+        >>> scale_thresh, ori_thresh = 2.0, TAU / 4
+        >>> # Test with a budget that forces several blocks
+        >>> output = get_best_affine_inliers_vectorized(
+        >>>     kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh,
+        >>>     mem_budget=len(fm) * 1000)
+        >>> aff_inliers_list, aff_errors_list, Aff_mats = get_affine_inliers(
+        >>>     kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
+        >>> weight_list = [fs[inliers].sum() for inliers in aff_inliers_list]
+        >>> best_index = np.argmax(weight_list)
+        >>> aff_inliers, aff_errors, Aff = output
+        >>> assert np.all(aff_inliers == aff_inliers_list[best_index])
+        >>> assert np.all(Aff == Aff_mats[best_index])
+        >>> for err1, err2 in zip(aff_errors, aff_errors_list[best_index]):
+        >>>     assert np.allclose(err1, err2)
+        >>> print('nInliers=%r' % (len(aff_inliers),))
+        nInliers=63
+    """
+    with _SverStage('build_hypotheses'):
+        kpts1_m = kpts1.take(fm.T[0], axis=0)
+        kpts2_m = kpts2.take(fm.T[1], axis=0)
+        Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m = _build_affine_hypotheses(
+            kpts1_m, kpts2_m)
+    _note_sver('num_hypotheses', len(Aff_mats))
+    with _SverStage('test_hypotheses'):
+        weight_list = _get_affine_hypothesis_weights(
+            Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m, fs, xy_thresh_sqrd,
+            scale_thresh, ori_thresh, mem_budget=mem_budget)
+        best_index = weight_list.argmax()
+        Aff = Aff_mats[best_index]
+        aff_inliers, aff_errors = _get_hypothesis_inliers(
+            Aff, invVR1s_m, xy2_m, det2_m, ori2_m, xy_thresh_sqrd, scale_thresh,
+            ori_thresh)
+    return aff_inliers, aff_errors, Aff
+
+
+def _get_hypothesis_inliers(Aff, invVR1s_m, xy2_m, det2_m, ori2_m,
+                            xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh):
+    """ Only the winning hypothesis needs its inliers and errors """
+    aff_errors = _test_hypotheses_errors(Aff, invVR1s_m, xy2_m, det2_m, ori2_m)
+    flags = _flag_hypotheses_inliers(*aff_errors, xy_thresh_sqrd=xy_thresh_sqrd,
+                                     scale_thresh_sqrd=scale_thresh_sqrd,
+                                     ori_thresh=ori_thresh)
+    aff_inliers = np.where(flags)[0]
+    return aff_inliers, aff_errors
+
+
+def _quantize_affine_hypotheses(Aff_mats, xy_thresh_sqrd, scale_thresh,
+                                ori_thresh, binfrac=None):
+    """
+    Assigns each affine hypothesis to a cell in (translation, log-scale,
+    rotation, shear) space. The cell size is a fraction of the thresholds used
+    to test inliers, so hypotheses in a cell agree on almost all inliers.
+
+    The 2x2 part of each hypothesis is decomposed as A = R(theta) U, where U
+    is upper triangular with a shear of U[0, 1] / U[1, 1].
+
+    Returns:
+        ndarray: cellxs - the cell index of each hypothesis
+    """
+    if binfrac is None:
+        binfrac = SVER_DEDUP_BINFRAC
+    a11 = Aff_mats[:, 0, 0]
+    a12 = Aff_mats[:, 0, 1]
+    a21 = Aff_mats[:, 1, 0]
+    a22 = Aff_mats[:, 1, 1]
+    det = a11 * a22 - a12 * a21
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_scale = .5 * np.log(np.abs(det))
+        shear = (a11 * a12 + a21 * a22) / det
+    theta = np.arctan2(a21, a11) % TAU
+    # The scale threshold applies to squared scales
+    log_scale_step = .5 * np.log(scale_thresh)
+    params = np.vstack([
+        Aff_mats[:, 0, 2] / np.sqrt(xy_thresh_sqrd),
+        Aff_mats[:, 1, 2] / np.sqrt(xy_thresh_sqrd),
+        log_scale / log_scale_step,
+        theta / ori_thresh,
+        shear / log_scale_step,
+    ]).T / binfrac
+    params[~np.isfinite(params)] = 0
+    cell_keys = np.floor(params).astype(np.int64)
+    _, cellxs = np.unique(cell_keys, axis=0, return_inverse=True)
+    return cellxs.ravel()
+
+
+def _dedup_affine_hypotheses(Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m, fs,
+                             xy_thresh_sqrd, scale_thresh, ori_thresh,
+                             topk=None, per_cell=None, mem_budget=None):
+    """
+    Scores one representative hypothesis per cell and returns the per_cell
+    most heavily weighted hypotheses of each of the topk best cells.
+
+    Hypotheses in a cell are nearly identical, so the number of candidates is
+    bounded by topk * per_cell even when a dense rigid region puts most
+    hypotheses in the same cell.
+
+    Returns:
+        ndarray: hypoxs - sorted indices of the candidate hypotheses
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.spatial_verification import *  # NOQA
+        >>> from vtool_ibeis.spatial_verification import _build_affine_hypotheses  # NOQA
+        >>> from vtool_ibeis.spatial_verification import _dedup_affine_hypotheses  # NOQA
+        >>> from vtool_ibeis.spatial_verification import _quantize_affine_hypotheses  # NOQA
+        >>> import vtool_ibeis.demodata as demodata
+        >>> # A dense rigid region with 20% outliers
+        >>> kpts1 = demodata.perterbed_grid_kpts(seed=1, wh_stride=(5, 5))
+        >>> M = np.array([[1.1, .1, 20], [-.1, .9, 10], [0, 0, 1]])
+        >>> kpts2 = demodata.perterb_kpts(
+        >>>     ktool.transform_kpts(kpts1, M), xy_std=(1, 1),
+        >>>     invV_std=(.3, .3, .3), ori_std=.02, seed=2)
+        >>> rng = np.random.RandomState(0)
+        >>> fm = np.vstack([np.arange(len(kpts1))] * 2).T
+        >>> fm[::5, 1] = rng.permutation(fm[::5, 1])
+        >>> fs = rng.rand(len(fm))
+        >>> xy_thresh_sqrd = ktool.get_kpts_dlen_sqrd(kpts2) * .01
+        >>> parts = _build_affine_hypotheses(kpts1[fm.T[0]], kpts2[fm.T[1]])
+        >>> thresh = (xy_thresh_sqrd, 2.0, TAU / 4)
+        >>> cellxs = _quantize_affine_hypotheses(parts[0], *thresh)
+        >>> hypoxs = _dedup_affine_hypotheses(*parts, fs, *thresh)
+        >>> # Nearly every inlier hypothesis is deduplicated
+        >>> num_cells = cellxs.max() + 1
+        >>> print('num_cells < 1.2 * num_outliers = %r' % (
+        >>>     bool(num_cells < 1.2 * len(fm[::5])),))
+        num_cells < 1.2 * num_outliers = True
+        >>> # At most per_cell hypotheses of a cell are expanded
+        >>> assert len(hypoxs) <= SVER_DEDUP_TOPK * SVER_DEDUP_PER_CELL
+        >>> assert max(ut.dict_hist(cellxs[hypoxs]).values()) <= SVER_DEDUP_PER_CELL
+        >>> # The best hypothesis is among the candidates
+        >>> args = (kpts1, kpts2, fm, fs) + thresh
+        >>> full = get_best_affine_inliers_vectorized(*args)
+        >>> dedup = get_best_affine_inliers_sampled(*args, hypothesis_strategy='dedup')
+        >>> assert np.all(full[0] == dedup[0])
+    """
+    if topk is None:
+        topk = SVER_DEDUP_TOPK
+    if per_cell is None:
+        per_cell = SVER_DEDUP_PER_CELL
+    cellxs = _quantize_affine_hypotheses(Aff_mats, xy_thresh_sqrd,
+                                         scale_thresh, ori_thresh)
+    # The representative of a cell is its most heavily weighted hypothesis
+    sortx = np.lexsort((-fs, cellxs))
+    is_first = np.ones(len(sortx), dtype=bool)
+    is_first[1:] = cellxs[sortx[1:]] != cellxs[sortx[:-1]]
+    rep_hypoxs = sortx[is_first]
+    rep_weights = _get_affine_hypothesis_weights(
+        Aff_mats.take(rep_hypoxs, axis=0), invVR1s_m, xy2_m, det2_m, ori2_m,
+        fs, xy_thresh_sqrd, scale_thresh, ori_thresh, mem_budget=mem_budget)
+    top_cellxs = cellxs[rep_hypoxs[
+        np.argsort(-rep_weights, kind='stable')[:topk]]]
+    # Rank of each hypothesis by weight within its cell
+    startxs = np.where(is_first)[0]
+    cell_sizes = np.diff(np.append(startxs, len(sortx)))
+    ranks = np.arange(len(sortx)) - np.repeat(startxs, cell_sizes)
+    flags = (ranks < per_cell) & np.isin(cellxs.take(sortx), top_cellxs)
+    hypoxs = np.sort(sortx[flags])
+    return hypoxs
+
+
+def get_best_affine_inliers_sampled(kpts1, kpts2, fm, fs, xy_thresh_sqrd,
+                                    scale_thresh, ori_thresh,
+                                    hypothesis_strategy='preemptive',
+                                    max_hypotheses=None, rng=None,
+                                    mem_budget=None):
+    """
+    Finds the best affine hypothesis while only fully scoring a bounded number
+    of hypotheses. This bounds the otherwise quadratic cost of verifying pairs
+    with many matches.
+
+    Args:
+        hypothesis_strategy (str): how hypotheses are chosen. Can be:
+            'exhaustive' - every correspondence is a hypothesis. If
+                max_hypotheses is given a random subset of that size is used.
+            'topk_by_fs' - the max_hypotheses correspondences with the highest
+                match weight are used as hypotheses.
+            'preemptive' - all hypotheses are scored on a growing random
+                subset of the correspondences. After each round only the best
+                half survives until max_hypotheses remain, which are then
+                scored on all correspondences.
+            'dedup' - near identical hypotheses are grouped into cells (see
+                _dedup_affine_hypotheses). One representative per cell is
+                scored and only the SVER_DEDUP_PER_CELL heaviest hypotheses of
+                the top SVER_DEDUP_TOPK cells are expanded.
+        max_hypotheses (int): number of hypotheses scored on every
+            correspondence. Defaults to SVER_MAX_HYPOTHESES for the
+            'topk_by_fs' and 'preemptive' strategies. Unused by 'dedup'.
+        rng (int | RandomState): seed used for random choices. Defaults to 0
+            so results are deterministic.
+
+    Returns:
+        tuple: aff_inliers, aff_errors, Aff
+
+    CommandLine:
+        python -m vtool_ibeis.spatial_verification get_best_affine_inliers_sampled
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.spatial_verification import *  # NOQA
+        >>> import vtool_ibeis.demodata as demodata
+        >>> _kw1 = dict(seed=12, damping=1.2, wh_stride=(10, 10))
+        >>> _kw2 = dict(seed=24, damping=1.6, wh_stride=(10, 10))
+        >>> kpts1 = demodata.perterbed_grid_kpts(**_kw1).astype(np.float64)
+        >>> kpts2 = demodata.perterbed_grid_kpts(**_kw2).astype(np.float64)
+        >>> fm = demodata.make_dummy_fm(len(kpts1)).astype(np.int32)
+        >>> # Corrupt half of the matches
+        >>> rng = np.random.RandomState(0)
+        >>> fm[::2, 1] = rng.permutation(fm[::2, 1])
+        >>> fs = rng.rand(len(fm))
+        >>> xy_thresh_sqrd = ktool.get_kpts_dlen_sqrd(kpts2) * .01
+        >>> scale_thresh, ori_thresh = 2.0, TAU / 4
+        >>> args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
+        >>> full = get_best_affine_inliers_vectorized(*args)
+        >>> # Budgets larger than the number of matches are exhaustive
+        >>> for strategy in ['exhaustive', 'topk_by_fs', 'preemptive']:
+        >>>     out = get_best_affine_inliers_sampled(
+        >>>         *args, hypothesis_strategy=strategy, max_hypotheses=len(fm))
+        >>>     assert np.all(out[0] == full[0])
+        >>> # Small budgets still find a good hypothesis
+        >>> nInliers_list = [len(full[0])]
+        >>> for strategy in ['exhaustive', 'topk_by_fs', 'preemptive', 'dedup']:
+        >>>     out = get_best_affine_inliers_sampled(
+        >>>         *args, hypothesis_strategy=strategy, max_hypotheses=16)
+        >>>     nInliers_list.append(len(out[0]))
+        >>> print('len(fm)=%r, nInliers_list=%r' % (len(fm), nInliers_list))
+        len(fm)=576, nInliers_list=[307, 302, 266, 307, 307]
+    """
+    import vtool_ibeis as vt
+    if hypothesis_strategy not in SVER_HYPOTHESIS_STRATEGIES:
+        raise KeyError('Unknown hypothesis_strategy=%r' % (hypothesis_strategy,))
+    if hypothesis_strategy == 'dedup':
+        max_hypotheses = None
+    elif max_hypotheses is None and hypothesis_strategy != 'exhaustive':
+        max_hypotheses = SVER_MAX_HYPOTHESES
+    rng = vt.ensure_rng(0 if rng is None else rng)
+    fs = np.asarray(fs, dtype=SV_DTYPE)
+    with _SverStage('build_hypotheses'):
+        kpts1_m = kpts1.take(fm.T[0], axis=0)
+        kpts2_m = kpts2.take(fm.T[1], axis=0)
+        Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m = _build_affine_hypotheses(
+            kpts1_m, kpts2_m)
+    with _SverStage('test_hypotheses'):
+        aff_inliers, aff_errors, Aff = _select_sampled_hypothesis(
+            Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m, fs, xy_thresh_sqrd,
+            scale_thresh, ori_thresh, hypothesis_strategy, max_hypotheses,
+            rng, mem_budget)
+    return aff_inliers, aff_errors, Aff
+
+
+def _select_sampled_hypothesis(Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m, fs,
+                               xy_thresh_sqrd, scale_thresh, ori_thresh,
+                               hypothesis_strategy, max_hypotheses, rng,
+                               mem_budget):
+    """ Hypothesis selection and scoring of get_best_affine_inliers_sampled """
+    num_corr = len(fs)
+    if hypothesis_strategy == 'dedup':
+        hypoxs = _dedup_affine_hypotheses(
+            Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m, fs, xy_thresh_sqrd,
+            scale_thresh, ori_thresh, mem_budget=mem_budget)
+    elif max_hypotheses is None or max_hypotheses >= num_corr:
+        hypoxs = np.arange(num_corr)
+    elif hypothesis_strategy == 'exhaustive':
+        hypoxs = np.sort(rng.choice(num_corr, max_hypotheses, replace=False))
+    elif hypothesis_strategy == 'topk_by_fs':
+        hypoxs = np.sort(np.argsort(-fs, kind='stable')[:max_hypotheses])
+    else:
+        hypoxs = np.arange(num_corr)
+    Aff_mats = Aff_mats.take(hypoxs, axis=0)
+    if hypothesis_strategy == 'preemptive' and len(hypoxs) > max_hypotheses:
+        # Preemptive scoring on a growing random subset of correspondences
+        order = rng.permutation(num_corr)
+        score_list = np.zeros(len(hypoxs), dtype=SV_DTYPE)
+        blocksize = SVER_PREEMPT_BLOCKSIZE
+        start = 0
+        while len(hypoxs) > max_hypotheses and start < num_corr:
+            corrxs = order[start:start + blocksize]
+            score_list += _get_affine_hypothesis_weights(
+                Aff_mats, invVR1s_m[corrxs], xy2_m[:, corrxs], det2_m[corrxs],
+                ori2_m[corrxs], fs[corrxs], xy_thresh_sqrd, scale_thresh,
+                ori_thresh, mem_budget=mem_budget)
+            start += len(corrxs)
+            blocksize *= 2
+            # Keep the best half, but no fewer than the budget
+            num_keep = max(max_hypotheses, len(hypoxs) // 2)
+            keepx = np.sort(np.argsort(-score_list, kind='stable')[:num_keep])
+            hypoxs = hypoxs.take(keepx)
+            Aff_mats = Aff_mats.take(keepx, axis=0)
+            score_list = score_list.take(keepx)
+    _note_sver('num_hypotheses', len(hypoxs))
+    weight_list = _get_affine_hypothesis_weights(
+        Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m, fs, xy_thresh_sqrd,
+        scale_thresh, ori_thresh, mem_budget=mem_budget)
+    Aff = Aff_mats[weight_list.argmax()]
+    aff_inliers, aff_errors = _get_hypothesis_inliers(
+        Aff, invVR1s_m, xy2_m, det2_m, ori2_m, xy_thresh_sqrd, scale_thresh,
+        ori_thresh)
+    return aff_inliers, aff_errors, Aff
+
+
 def get_best_affine_inliers(kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh,
                             ori_thresh, forcepy=False):
     """ Tests each hypothesis and returns only the best transformation and inliers
@@ -564,14 +1373,15 @@ def get_best_affine_inliers(kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh,
     # Test each affine hypothesis
     # get list if inliers, errors, the affine matrix for each hypothesis
     if HAVE_SVER_C_WRAPPER and not forcepy:
-        aff_inliers_list, aff_errors_list, Aff_mats = sver_c_wrapper.get_affine_inliers_cpp(
-            kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
+        kpts1, kpts2 = _unpack_kpts(kpts1)[0], _unpack_kpts(kpts2)[0]
+        _note_sver('num_hypotheses', len(fm))
+        with _SverStage('test_hypotheses'):
+            aff_inliers_list, aff_errors_list, Aff_mats = sver_c_wrapper.get_affine_inliers_cpp(
+                kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
     else:
-        aff_inliers_list, aff_errors_list, Aff_mats = get_affine_inliers(kpts1, kpts2,
-                                                                         fm, fs,
-                                                                         xy_thresh_sqrd,
-                                                                         scale_thresh,
-                                                                         ori_thresh)
+        # The vectorized engine never builds the per-hypothesis inlier lists
+        return get_best_affine_inliers_vectorized(
+            kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
 
     #ut.embed()
     # Determine the best hypothesis using the number of inliers
@@ -622,30 +1432,32 @@ def estimate_refined_transform(kpts1, kpts2, fm, aff_inliers, refine_method='hom
     References:
         http://docs.opencv.org/2.4/modules/calib3d/doc/camera_calibration_and_3d_reconstruction.html
     """
-    xy1_man, xy2_man, T1, T2 = get_normalized_affine_inliers(kpts1, kpts2, fm, aff_inliers)
+    with _SverStage('normalize'):
+        xy1_man, xy2_man, T1, T2 = get_normalized_affine_inliers(kpts1, kpts2, fm, aff_inliers)
     # Compute homgraphy transform from chip1 -> chip2 using affine inliers
     # homographys assume the two images are planar, or the camera is
     # rotating around the subject
 
-    if refine_method == 'homog':
-        H_prime = compute_homog(xy1_man, xy2_man)
-    elif refine_method == 'affine':
-        H_prime = compute_affine(xy1_man, xy2_man)
-    elif refine_method == 'cv2-homog':
-        H_prime, mask = cv2.findHomography(xy1_man.T, xy2_man.T, method=0)
-    elif refine_method == 'cv2-ransac-homog':
-        H_prime, mask = cv2.findHomography(
-            xy1_man.T, xy2_man.T, method=cv2.RANSAC,
-            ransacReprojThreshold=3)
-    elif refine_method == 'cv2-lmeds-homog':
-        H_prime, mask = cv2.findHomography(xy1_man.T, xy2_man.T, method=cv2.LMEDS)
-    #elif refine_method == 'fund':
-    #    # the fundamental matrix only implies: x'.T.dot(F).dot(x) == 0
-    #    # it maps a point from one image onto a line in the second image.
-    #    H_prime = cv2.findFundamentalMat(xy1_man.T, xy2_man.T, method=cv2.FM_LMEDS)[0]
-    #    H_prime = cv2.findFundamentalMat(xy1_man.T, xy2_man.T, method=cv2.FM_8POINT)[0]
-    else:
-        raise NotImplementedError('[vtool_ibeis] Unknown refine_method=%r' % (refine_method,))
+    with _SverStage('estimate_transform'):
+        if refine_method == 'homog':
+            H_prime = compute_homog(xy1_man, xy2_man)
+        elif refine_method == 'affine':
+            H_prime = compute_affine(xy1_man, xy2_man)
+        elif refine_method == 'cv2-homog':
+            H_prime, mask = cv2.findHomography(xy1_man.T, xy2_man.T, method=0)
+        elif refine_method == 'cv2-ransac-homog':
+            H_prime, mask = cv2.findHomography(
+                xy1_man.T, xy2_man.T, method=cv2.RANSAC,
+                ransacReprojThreshold=3)
+        elif refine_method == 'cv2-lmeds-homog':
+            H_prime, mask = cv2.findHomography(xy1_man.T, xy2_man.T, method=cv2.LMEDS)
+        #elif refine_method == 'fund':
+        #    # the fundamental matrix only implies: x'.T.dot(F).dot(x) == 0
+        #    # it maps a point from one image onto a line in the second image.
+        #    H_prime = cv2.findFundamentalMat(xy1_man.T, xy2_man.T, method=cv2.FM_LMEDS)[0]
+        #    H_prime = cv2.findFundamentalMat(xy1_man.T, xy2_man.T, method=cv2.FM_8POINT)[0]
+        else:
+            raise NotImplementedError('[vtool_ibeis] Unknown refine_method=%r' % (refine_method,))
 
     #H_prime /= H_prime[2, 2]
     # Different methods?
@@ -654,8 +1466,9 @@ def estimate_refined_transform(kpts1, kpts2, fm, aff_inliers, refine_method='hom
     #H_prime = cv2.findHomography(xy1_man.T, xy2_man.T)[0]
     #H = compute_affine(xy1_ma, xy2_ma)
     #print(H)
-    H = unnormalize_transform(H_prime, T1, T2)
-    rank = npl.matrix_rank(H)
+    with _SverStage('estimate_transform'):
+        H = unnormalize_transform(H_prime, T1, T2)
+        rank = npl.matrix_rank(H)
     #print(rank)
     if rank != 3:
         raise npl.LinAlgError('Rank defficient homography ')
@@ -885,29 +1698,192 @@ def refine_inliers(kpts1, kpts2, fm, aff_inliers, xy_thresh_sqrd,
     """
     H = estimate_refined_transform(kpts1, kpts2, fm, aff_inliers,
                                    refine_method=refine_method)
-    if refine_method.endswith('homog'):
-        homog_tup1 = test_homog_errors(H, kpts1, kpts2, fm, xy_thresh_sqrd,
-                                       scale_thresh, ori_thresh, full_homog_checks)
-    #elif refine_method == 'cv2-homog':
-    #    homog_tup1 = test_homog_errors(H, kpts1, kpts2, fm, xy_thresh_sqrd,
-    #                                   scale_thresh, ori_thresh, full_homog_checks)
-    elif refine_method == 'affine':
-        homog_tup1 = test_affine_errors(H, kpts1, kpts2, fm, xy_thresh_sqrd,
-                                        scale_thresh, ori_thresh)
+    with _SverStage('test_refined'):
+        if refine_method.endswith('homog'):
+            homog_tup1 = test_homog_errors(H, kpts1, kpts2, fm, xy_thresh_sqrd,
+                                           scale_thresh, ori_thresh, full_homog_checks)
+        #elif refine_method == 'cv2-homog':
+        #    homog_tup1 = test_homog_errors(H, kpts1, kpts2, fm, xy_thresh_sqrd,
+        #                                   scale_thresh, ori_thresh, full_homog_checks)
+        elif refine_method == 'affine':
+            homog_tup1 = test_affine_errors(H, kpts1, kpts2, fm, xy_thresh_sqrd,
+                                            scale_thresh, ori_thresh)
     return homog_tup1
 
 
-def get_best_affine_inliers_(kpts1, kpts2, fm, fs, xy_thresh_sqrd,
-                             scale_thresh, ori_thresh):
-    if HAVE_SVER_C_WRAPPER:
+def _sver_size_bucket(num_matches):
+    """ Size class of a pair (buckets double in size) """
+    return int(num_matches).bit_length()
+
+
+def check_sver_backend_parity(num_matches=64, inlier_ratio=.5, seed=0,
+                              rtol=1e-6):
+    """
+    Checks that the C extension and the vectorized python path agree on a
+    synthetic pair.
+
+    Ties between hypotheses with the same inliers may be broken differently,
+    so the inliers and their total weight are compared instead of the affine
+    matrices.
+
+    Returns:
+        bool: True if the backends agree (or if there is no C extension)
+
+    CommandLine:
+        python -m vtool_ibeis.spatial_verification check_sver_backend_parity
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.spatial_verification import *  # NOQA
+        >>> assert check_sver_backend_parity()
+        >>> assert check_sver_backend_parity(300, inlier_ratio=.2, seed=1)
+    """
+    if not HAVE_SVER_C_WRAPPER:
+        return True
+    import vtool_ibeis.demodata as demodata
+    kpts1, kpts2, fm, fs = demodata.testdata_sver_pair(
+        num_matches, inlier_ratio=inlier_ratio, seed=seed)
+    kpts1 = kpts1.astype(np.float64)
+    kpts2 = kpts2.astype(np.float64)
+    xy_thresh_sqrd = ktool.get_kpts_dlen_sqrd(kpts2) * .01
+    args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, 2.0, TAU / 4.0)
+    inliers_c = sver_c_wrapper.get_best_affine_inliers_cpp(*args)[0]
+    inliers_py = get_best_affine_inliers_vectorized(*args)[0]
+    weight_c = fs.take(inliers_c).sum()
+    weight_py = fs.take(inliers_py).sum()
+    return (len(inliers_c) == len(inliers_py) and
+            bool(np.isclose(weight_c, weight_py, rtol=rtol)))
+
+
+def choose_sver_backend(num_matches):
+    """
+    Returns the affine hypothesis backend ('c' or 'python') that
+    get_best_affine_inliers_ uses for a pair with `num_matches` matches.
+
+    With --sver-backend=auto (the default) the choice is made per size bucket
+    of fm. The first pair of a bucket is timed with both backends (the best
+    of SVER_BACKEND_TRIALS warm runs each) and the faster one is remembered,
+    so None is returned while a bucket is undecided. If the backends fail the parity check the C extension is
+    always used.
+    """
+    if not HAVE_SVER_C_WRAPPER:
+        return 'python'
+    if SVER_BACKEND != 'auto':
+        return SVER_BACKEND
+    state = _SVER_BACKEND_STATE
+    if state['parity'] is None:
+        with _paused_sver_record():
+            state['parity'] = check_sver_backend_parity()
+        if not state['parity']:
+            warnings.warn('[sver] the C and python backends disagree. '
+                          'Always using the C backend')
+    if not state['parity']:
+        return 'c'
+    return state['choice'].get(_sver_size_bucket(num_matches), None)
+
+
+def sver_backend_report():
+    """
+    Summarizes how get_best_affine_inliers_ picks its backend.
+
+    Returns:
+        dict: the backend setting, the parity check result, and the chosen
+            backend and timings of every decided size bucket (keyed by the
+            largest number of matches in the bucket)
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.spatial_verification import *  # NOQA
+        >>> report = sver_backend_report()
+        >>> print(sorted(report.keys()))
+        ['backend', 'buckets', 'have_c', 'parity']
+    """
+    state = _SVER_BACKEND_STATE
+    buckets = ut.odict()
+    for bucket in sorted(state['choice'].keys()):
+        buckets[2 ** bucket - 1] = ut.odict([
+            ('choice', state['choice'][bucket]),
+            ('times', state['times'][bucket]),
+        ])
+    report = ut.odict([
+        ('have_c', HAVE_SVER_C_WRAPPER),
+        ('backend', SVER_BACKEND),
+        ('parity', state['parity']),
+        ('buckets', buckets),
+    ])
+    return report
+
+
+def _get_best_affine_inliers_c(kpts1, kpts2, fm, fs, xy_thresh_sqrd,
+                               scale_thresh, ori_thresh):
+    kpts1, kpts2 = _unpack_kpts(kpts1)[0], _unpack_kpts(kpts2)[0]
+    _note_sver('num_hypotheses', len(fm))
+    with _SverStage('test_hypotheses'):
         aff_inliers, aff_errors, Aff = sver_c_wrapper.get_best_affine_inliers_cpp(
             kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
-    else:
+    return aff_inliers, aff_errors, Aff
+
+
+def _time_sver_backend(func, args, trials=None):
+    """ Best time of a few warm runs of an affine hypothesis backend """
+    if trials is None:
+        trials = SVER_BACKEND_TRIALS
+    t = ut.Timerit(max(trials, 1), verbose=0)
+    for timer in t:
+        with timer:
+            func(*args)
+    return t.min()
+
+
+def get_best_affine_inliers_(kpts1, kpts2, fm, fs, xy_thresh_sqrd,
+                             scale_thresh, ori_thresh):
+    """
+    Returns the inliers, errors and matrix of the best affine hypothesis using
+    the backend given by choose_sver_backend.
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.spatial_verification import *  # NOQA
+        >>> import vtool_ibeis.demodata as demodata
+        >>> kpts1, kpts2, fm, fs = demodata.testdata_sver_pair(100, seed=0)
+        >>> bucket = _sver_size_bucket(len(fm))
+        >>> _SVER_BACKEND_STATE['choice'].pop(bucket, None)
+        >>> # The timing runs of an undecided bucket are not recorded
+        >>> with SverRecorder() as recorder:
+        >>>     svtup = spatially_verify_kpts(kpts1, kpts2, fm,
+        >>>                                   match_weights=fs)
+        >>> record, = recorder.records
+        >>> assert record['num_aff_inliers'] > 0
+        >>> if HAVE_SVER_C_WRAPPER and SVER_BACKEND == 'auto':
+        >>>     assert record['num_hypotheses'] == len(fm)
+        >>>     assert 'time_build_hypotheses' not in record
+        >>>     assert _SVER_BACKEND_STATE['choice'][bucket] in {'c', 'python'}
+    """
+    if not HAVE_SVER_C_WRAPPER:
         if ut.NOT_QUIET:
             print('WARNING: sver has not been compiled')
-        aff_inliers, aff_errors, Aff = get_best_affine_inliers(
+        return get_best_affine_inliers(
             kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
-    return aff_inliers, aff_errors, Aff
+    args = (kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
+    backend = choose_sver_backend(len(fm))
+    if backend == 'c':
+        return _get_best_affine_inliers_c(*args)
+    elif backend == 'python':
+        return get_best_affine_inliers_vectorized(*args)
+    # The first run warms up both backends and gives the result
+    aff_tup = _get_best_affine_inliers_c(*args)
+    # Time both backends on the first pair of this size bucket
+    with _paused_sver_record():
+        get_best_affine_inliers_vectorized(*args)
+        time_c = _time_sver_backend(_get_best_affine_inliers_c, args)
+        time_py = _time_sver_backend(get_best_affine_inliers_vectorized, args)
+    bucket = _sver_size_bucket(len(fm))
+    _SVER_BACKEND_STATE['times'][bucket] = {'c': time_c, 'python': time_py}
+    _SVER_BACKEND_STATE['choice'][bucket] = 'c' if time_c <= time_py else 'python'
+    if VERBOSE_SVER:
+        print('[sver] using the %s backend for %d matches' % (
+            _SVER_BACKEND_STATE['choice'][bucket], len(fm)))
+    return aff_tup
 
 
 def spatially_verify_kpts(kpts1, kpts2, fm,
@@ -921,6 +1897,9 @@ def spatially_verify_kpts(kpts1, kpts2, fm,
                           full_homog_checks=True,
                           refine_method='homog',
                           max_nInliers=5000,
+                          hypothesis_strategy='exhaustive',
+                          max_hypotheses=None,
+                          rng=None,
                           ):
     """
     Driver function
@@ -942,10 +1921,20 @@ def spatially_verify_kpts(kpts1, kpts2, fm,
         min_nInliers (int): default=4
         returnAff (bool): returns best affine hypothesis as well
         max_nInliers (int): homog is not considered after this threshold
+        hypothesis_strategy (str): 'exhaustive', 'topk_by_fs',
+            'preemptive', or 'dedup' (see SVER_HYPOTHESIS_STRATEGIES and
+            get_best_affine_inliers_sampled).
+        max_hypotheses (int): bounds the number of fully scored hypotheses
+            (unused by 'dedup')
+        rng (int | RandomState): seed for the sampled strategies
 
     Returns:
         tuple : (refined_inliers, refined_errors, H, aff_inliers, aff_errors, Aff) if success else None
 
+    Note:
+        Stage timings and counts of each call are collected by an active
+        SverRecorder.
+
     CommandLine:
         python -m vtool_ibeis.spatial_verification --test-spatially_verify_kpts --show
         python -m vtool_ibeis.spatial_verification --test-spatially_verify_kpts --show --refine-method='affine'
@@ -994,14 +1983,37 @@ def spatially_verify_kpts(kpts1, kpts2, fm,
         >>> pt.draw_sv.show_sv(rchip1, rchip2, kpts1, kpts2, fm, aff_tup=aff_tup, homog_tup=homog_tup, refine_method=refine_method)
         >>> pt.show_if_requested()
     """
+    record = _begin_sver_record()
+    try:
+        svtup = _spatially_verify_kpts(
+            kpts1, kpts2, fm, xy_thresh, scale_thresh, ori_thresh, dlen_sqrd2,
+            min_nInliers, match_weights, returnAff, full_homog_checks,
+            refine_method, max_nInliers, hypothesis_strategy, max_hypotheses,
+            rng)
+    except Exception:
+        _finish_sver_record(record, 'exception')
+        raise
+    _finish_sver_record(record)
+    return svtup
+
+
+def _spatially_verify_kpts(kpts1, kpts2, fm, xy_thresh, scale_thresh,
+                           ori_thresh, dlen_sqrd2, min_nInliers, match_weights,
+                           returnAff, full_homog_checks, refine_method,
+                           max_nInliers, hypothesis_strategy, max_hypotheses,
+                           rng):
+    """ Body of spatially_verify_kpts (the caller manages the record) """
+    _note_sver('num_fm', len(fm))
     if len(fm) == 0:
         if VERBOSE_SVER:
             print('[sver] Cannot verify with no matches')
+        _note_sver('exit_reason', 'no_matches')
         svtup = None
         return svtup
     # Cast keypoints to float64 to avoid numerical issues
-    kpts1 = kpts1.astype(np.float64, casting='same_kind', copy=False)
-    kpts2 = kpts2.astype(np.float64, casting='same_kind', copy=False)
+    # (hypotheses use the precomputed geometry if given)
+    kpts1, geom1 = _unpack_kpts(kpts1)
+    kpts2, geom2 = _unpack_kpts(kpts2)
     #kpts1 = kpts1.astype(np.float64)
     #kpts2 = kpts2.astype(np.float64)
     assert match_weights is not None, 'provide at least ones please for match_weights'
@@ -1012,16 +2024,42 @@ def spatially_verify_kpts(kpts1, kpts2, fm,
         dlen_sqrd2 = ktool.get_kpts_dlen_sqrd(kpts2_m)
     # Determine the best hypothesis transformation and get its inliers
     xy_thresh_sqrd = dlen_sqrd2 * xy_thresh
-    aff_inliers, aff_errors, Aff = get_best_affine_inliers_(
-        kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
+    if hypothesis_strategy == 'exhaustive' and max_hypotheses is None:
+        aff_inliers, aff_errors, Aff = get_best_affine_inliers_(
+            geom1, geom2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh)
+    else:
+        aff_inliers, aff_errors, Aff = get_best_affine_inliers_sampled(
+            geom1, geom2, fm, fs, xy_thresh_sqrd, scale_thresh, ori_thresh,
+            hypothesis_strategy=hypothesis_strategy,
+            max_hypotheses=max_hypotheses, rng=rng)
     #print(aff_inliers)
+    svtup = _refine_best_affine_hypothesis(
+        kpts1, kpts2, fm, aff_inliers, aff_errors, Aff, xy_thresh_sqrd,
+        scale_thresh, ori_thresh, min_nInliers, returnAff, full_homog_checks,
+        refine_method, max_nInliers)
+    return svtup
+
+
+def _refine_best_affine_hypothesis(kpts1, kpts2, fm, aff_inliers, aff_errors,
+                                   Aff, xy_thresh_sqrd, scale_thresh,
+                                   ori_thresh, min_nInliers, returnAff,
+                                   full_homog_checks, refine_method,
+                                   max_nInliers):
+    """
+    Second half of spatially_verify_kpts. Checks that the best affine
+    hypothesis has enough inliers and refines them with a homography.
 
+    Returns:
+        tuple : svtup if success else None
+    """
+    _note_sver('num_aff_inliers', len(aff_inliers))
     # Return if there are not enough inliers to compute homography
     if len(aff_inliers) < min_nInliers:
         # Test user defined param
         if VERBOSE_SVER:
             print('[sver] Failed spatial verification len(aff_inliers) = %r' %
                   (len(aff_inliers),))
+        _note_sver('exit_reason', 'too_few_aff_inliers')
         svtup = None
         return svtup
     if ((refine_method.endswith('homog') and len(aff_inliers) < 7) or
@@ -1032,12 +2070,14 @@ def spatially_verify_kpts(kpts1, kpts2, fm,
         if VERBOSE_SVER:
             print('[sver] Failed spatial verification len(aff_inliers) = %r' %
                   (len(aff_inliers),))
+        _note_sver('exit_reason', 'too_few_for_refine')
         svtup = None
         return svtup
 
     if len(aff_inliers) >= max_nInliers:
         # If there are a very large number of affine inliers, then the affine
         # matrix is probably good enough.
+        _note_sver('exit_reason', 'max_inliers')
         svtup = (aff_inliers, aff_errors, Aff, aff_inliers, aff_errors, Aff)
         return svtup
 
@@ -1050,10 +2090,12 @@ def spatially_verify_kpts(kpts1, kpts2, fm,
     except npl.LinAlgError as ex:
         if ut.VERYVERBOSE and ut.SUPER_STRICT:
             ut.printex(ex, 'numeric error in homog estimation.', iswarning=True)
+        _note_sver('exit_reason', 'linalg_error')
         return None
     except ValueError as ex:
         if ut.VERYVERBOSE and ut.SUPER_STRICT:
             ut.printex(ex, 'error cv2 in homog estimation.', iswarning=True)
+        _note_sver('exit_reason', 'cv2_error')
         return None
     except IndexError:
         raise
@@ -1063,12 +2105,15 @@ def spatially_verify_kpts(kpts1, kpts2, fm,
         ut.printex(ex, 'Unknown error in homog estimation.',
                       keys=['kpts1', 'kpts2',  'fm', 'fm.shape', 'kpts1.shape',
                             (len, 'aff_inliers'),
-                            'kpts2.shape', 'xy_thresh', 'scale_thresh',
-                            'dlen_sqrd2', 'min_nInliers'])
+                            'kpts2.shape', 'xy_thresh_sqrd', 'scale_thresh',
+                            'min_nInliers'])
         if ut.SUPER_STRICT:
             print('SUPER_STRICT is on. Reraising')
             raise
+        _note_sver('exit_reason', 'unknown_error')
         return None
+    _note_sver('num_refined_inliers', len(refined_inliers))
+    _note_sver('exit_reason', 'success')
     if VERBOSE_SVER:
         print('[sver] Succesfully finished spatial verification.')
     if returnAff:
@@ -1079,6 +2124,346 @@ def spatially_verify_kpts(kpts1, kpts2, fm,
         return svtup
 
 
+def _take_errors(errors, idxs):
+    """ subindexes per-correspondence errors (which may contain None) """
+    return tuple(None if err is None else err.take(idxs) for err in errors)
+
+
+def spatially_verify_kpts_nested(kpts1, kpts2, fm, match_weights,
+                                 subset_flags_list,
+                                 xy_thresh=.01,
+                                 scale_thresh=2.0,
+                                 ori_thresh=TAU / 4.0,
+                                 dlen_sqrd2=None,
+                                 min_nInliers=4,
+                                 returnAff=False,
+                                 full_homog_checks=True,
+                                 refine_method='homog',
+                                 max_nInliers=5000,
+                                 mem_budget=None):
+    """
+    Spatially verifies several subsets of the same matches at once.
+
+    This is meant for nested subsets (e.g. the matches that pass a sequence of
+    ratio thresholds). Hypotheses and their errors are computed once on the
+    union of the subsets and each subset is answered by masking. Refinement
+    is only rerun when the affine inliers of a subset differ from those of a
+    subset that was already refined. The result for each subset is the same
+    as calling spatially_verify_kpts on fm[flags] and match_weights[flags].
+
+    Args:
+        subset_flags_list (list): boolean masks over fm, one per subset
+
+    Returns:
+        list: svtup_list - the svtup (or None) of each subset. Indices are
+            relative to the subset.
+
+    CommandLine:
+        python -m vtool_ibeis.spatial_verification spatially_verify_kpts_nested
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.spatial_verification import *  # NOQA
+        >>> import vtool_ibeis.demodata as demodata
+        >>> kpts1 = demodata.perterbed_grid_kpts(seed=1, wh_stride=(20, 20))
+        >>> kpts2 = demodata.perterbed_grid_kpts(seed=2, wh_stride=(20, 20))
+        >>> rng = np.random.RandomState(0)
+        >>> fm = np.vstack([np.arange(140), rng.permutation(140)]).T
+        >>> fm[:70, 1] = fm[:70, 0]
+        >>> fm = fm.astype(np.int32)
+        >>> fs = rng.rand(len(fm))
+        >>> ratio = rng.rand(len(fm))
+        >>> subset_flags_list = [ratio < t for t in [.01, .2, .5, .8, 1.0]]
+        >>> svtup_list = spatially_verify_kpts_nested(
+        >>>     kpts1, kpts2, fm, fs, subset_flags_list, returnAff=True)
+        >>> for flags, svtup in zip(subset_flags_list, svtup_list):
+        >>>     svtup_ = spatially_verify_kpts(
+        >>>         kpts1, kpts2, fm[flags], match_weights=fs[flags],
+        >>>         returnAff=True)
+        >>>     assert (svtup is None) == (svtup_ is None)
+        >>>     if svtup is not None:
+        >>>         assert np.all(svtup[0] == svtup_[0])
+        >>>         assert np.allclose(svtup[1][0], svtup_[1][0])
+        >>>         assert np.allclose(svtup[2], svtup_[2])
+        >>>         assert np.all(svtup[3] == svtup_[3])
+        >>> print([None if t is None else len(t[0]) for t in svtup_list])
+        [None, 11, 38, 56, 65]
+    """
+    if mem_budget is None:
+        mem_budget = SVER_MEM_BUDGET
+    subset_flags_list = [np.asarray(flags, dtype=bool)
+                         for flags in subset_flags_list]
+    svtup_list = [None] * len(subset_flags_list)
+    union_flags = np.logical_or.reduce(
+        [np.zeros(len(fm), dtype=bool)] + subset_flags_list)
+    if not np.any(union_flags):
+        return svtup_list
+    kpts1, geom1 = _unpack_kpts(kpts1)
+    kpts2, geom2 = _unpack_kpts(kpts2)
+    assert match_weights is not None, 'provide at least ones please for match_weights'
+    # Work with all matches that belong to at least one subset
+    fm_u = fm.compress(union_flags, axis=0)
+    fs_u = np.asarray(match_weights).compress(union_flags).astype(SV_DTYPE)
+    masks = np.array([flags.compress(union_flags)
+                      for flags in subset_flags_list])
+    # The threshold of each subset depends on its own matches if not given
+    if dlen_sqrd2 is None:
+        kpts2_m = kpts2.take(fm_u.T[1], axis=0)
+        xy_thresh_sqrds = [
+            ktool.get_kpts_dlen_sqrd(kpts2_m.compress(mask, axis=0)) * xy_thresh
+            if np.any(mask) else np.nan for mask in masks]
+    else:
+        xy_thresh_sqrds = [dlen_sqrd2 * xy_thresh] * len(masks)
+    Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m = _build_affine_hypotheses(
+        geom1.take(fm_u.T[0], axis=0), geom2.take(fm_u.T[1], axis=0))
+    # weight_grid[h, b] is the weight of hypothesis h on subset b
+    num_corr = len(fm_u)
+    weight_grid = np.zeros((num_corr, len(masks)), dtype=SV_DTYPE)
+    blocksize = max(1, int(mem_budget // max(1, num_corr * _SVER_BYTES_PER_TEST)))
+    masked_fs = masks * fs_u[None, :]
+    for hx1 in range(0, num_corr, blocksize):
+        hx2 = min(hx1 + blocksize, num_corr)
+        errors = _test_hypotheses_errors(
+            Aff_mats[hx1:hx2, None], invVR1s_m[None, :], xy2_m[:, None, :],
+            det2_m[None, :], ori2_m[None, :])
+        for bx, xy_thresh_sqrd in enumerate(xy_thresh_sqrds):
+            flags = _flag_hypotheses_inliers(
+                *errors, xy_thresh_sqrd=xy_thresh_sqrd,
+                scale_thresh_sqrd=scale_thresh, ori_thresh=ori_thresh)
+            weight_grid[hx1:hx2, bx] = flags.dot(masked_fs[bx])
+    # Refinement results on the union keyed by the affine inliers
+    refine_cache = {}
+    for bx, (mask, xy_thresh_sqrd) in enumerate(zip(masks, xy_thresh_sqrds)):
+        subxs = np.where(mask)[0]
+        if len(subxs) == 0:
+            continue
+        # Only hypotheses from the subset compete
+        best_hypox = subxs[weight_grid[subxs, bx].argmax()]
+        Aff = Aff_mats[best_hypox]
+        aff_inliers_u, aff_errors_u = _get_hypothesis_inliers(
+            Aff, invVR1s_m, xy2_m, det2_m, ori2_m, xy_thresh_sqrd,
+            scale_thresh, ori_thresh)
+        aff_inliers_u = aff_inliers_u.compress(mask[aff_inliers_u])
+        key = (xy_thresh_sqrd, aff_inliers_u.tobytes())
+        if key not in refine_cache:
+            refine_cache[key] = _refine_best_affine_hypothesis(
+                kpts1, kpts2, fm_u, aff_inliers_u, aff_errors_u, Aff,
+                xy_thresh_sqrd, scale_thresh, ori_thresh, min_nInliers, True,
+                full_homog_checks, refine_method, max_nInliers)
+        svtup_u = refine_cache[key]
+        if svtup_u is None:
+            continue
+        # Map results on the union back onto the subset
+        refined_inliers_u, refined_errors_u, H = svtup_u[0:3]
+        refined_flags_u = np.zeros(num_corr, dtype=bool)
+        refined_flags_u[refined_inliers_u] = True
+        refined_inliers = np.where(refined_flags_u.take(subxs))[0]
+        refined_inliers = refined_inliers.astype(refined_inliers_u.dtype)
+        refined_errors = _take_errors(refined_errors_u, subxs)
+        if returnAff:
+            aff_inliers = np.searchsorted(subxs, aff_inliers_u)
+            aff_errors = _take_errors(aff_errors_u, subxs)
+            svtup_list[bx] = (refined_inliers, refined_errors, H,
+                              aff_inliers, aff_errors, Aff)
+        else:
+            svtup_list[bx] = (refined_inliers, refined_errors, H,
+                              None, None, None)
+    return svtup_list
+
+
+# Maximum number of (hypothesis, correspondence) pairs tested at once by
+# spatially_verify_kpts_batch
+SVER_BATCH_CHUNKSIZE = 2 ** 20
+
+
+def _ragged_arange(sizes):
+    """ concatenation of np.arange(size) for each size in sizes """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    total = sizes.sum()
+    starts = np.cumsum(sizes) - sizes
+    ramp = np.arange(total, dtype=np.int64) - np.repeat(starts, sizes)
+    return ramp
+
+
+def _get_best_affine_inliers_batch(pairx_list, offsets, Aff_mats, invVR1s_m,
+                                   xy2_m, det2_m, ori2_m, fs, xy_thresh_sqrds,
+                                   scale_thresh, ori_thresh,
+                                   chunksize=SVER_BATCH_CHUNKSIZE):
+    """
+    Tests every hypothesis of every pair against the correspondences of its own
+    pair, operating on correspondences stacked over the entire batch.
+
+    Args:
+        pairx_list (ndarray): pair index of each stacked correspondence
+        offsets (ndarray): start of each pair in the stack (len = num_pairs + 1)
+        xy_thresh_sqrds (ndarray): xy threshold of each pair
+
+    Returns:
+        tuple: (best_hypox, inlier_flags, errors) where best_hypox indexes the
+            stack and the flags / errors are stacked w.r.t the best hypothesis
+            of each pair.
+    """
+    sizes = np.diff(offsets)
+    num_pairs = len(sizes)
+    # Each hypothesis is tested against all correspondences in its pair
+    hypo_sizes = sizes[pairx_list]
+    hypo_ends = np.cumsum(hypo_sizes)
+    weight_list = np.empty(len(pairx_list), dtype=np.float64)
+    # Split hypotheses into chunks that keep the number of tests bounded
+    hx1 = 0
+    while hx1 < len(pairx_list):
+        done = hypo_ends[hx1] - hypo_sizes[hx1]
+        hx2 = np.searchsorted(hypo_ends, done + chunksize, side='right')
+        hx2 = max(hx2, hx1 + 1)
+        hypoxs = np.arange(hx1, hx2)
+        flat_hypoxs = np.repeat(hypoxs, hypo_sizes[hx1:hx2])
+        flat_corrxs = (offsets[pairx_list[flat_hypoxs]] +
+                       _ragged_arange(hypo_sizes[hx1:hx2]))
+        errors = _test_hypotheses_errors(
+            Aff_mats[flat_hypoxs], invVR1s_m[flat_corrxs],
+            xy2_m.T[flat_corrxs].T, det2_m[flat_corrxs], ori2_m[flat_corrxs])
+        flags = _flag_hypotheses_inliers(
+            *errors, xy_thresh_sqrd=xy_thresh_sqrds[pairx_list[flat_hypoxs]],
+            scale_thresh_sqrd=scale_thresh, ori_thresh=ori_thresh)
+        flat_weights = fs[flat_corrxs] * flags
+        starts = np.cumsum(hypo_sizes[hx1:hx2]) - hypo_sizes[hx1:hx2]
+        weight_list[hx1:hx2] = np.add.reduceat(flat_weights, starts)
+        hx1 = hx2
+    # Choose the first hypothesis with maximum weight in each pair
+    sortx = np.lexsort((np.arange(len(pairx_list)), -weight_list, pairx_list))
+    best_hypox = sortx[offsets[:-1]]
+    assert len(best_hypox) == num_pairs
+    # Recompute the errors of only the best hypotheses
+    best_flat = best_hypox[pairx_list]
+    errors = _test_hypotheses_errors(
+        Aff_mats[best_flat], invVR1s_m, xy2_m, det2_m, ori2_m)
+    inlier_flags = _flag_hypotheses_inliers(
+        *errors, xy_thresh_sqrd=xy_thresh_sqrds[pairx_list],
+        scale_thresh_sqrd=scale_thresh, ori_thresh=ori_thresh)
+    return best_hypox, inlier_flags, errors
+
+
+def spatially_verify_kpts_batch(kpts1_list, kpts2_list, fm_list,
+                                match_weights_list, dlen_sqrd2_list=None,
+                                xy_thresh=.01,
+                                scale_thresh=2.0,
+                                ori_thresh=TAU / 4.0,
+                                min_nInliers=4,
+                                returnAff=False,
+                                full_homog_checks=True,
+                                refine_method='homog',
+                                max_nInliers=5000,
+                                chunksize=SVER_BATCH_CHUNKSIZE):
+    """
+    Spatially verifies many annotation pairs at once.
+
+    The correspondences of all pairs are stacked so the hypothesis generation
+    and inlier tests run as array operations over the whole batch instead of
+    once per pair. Only the final refinement of each pair's best hypothesis is
+    done per pair. The result is the same as calling spatially_verify_kpts on
+    each pair with the pure python backend (up to ties between hypotheses with
+    equal weight).
+
+    Args:
+        kpts1_list (list): keypoints in image 1 of each pair
+        kpts2_list (list): keypoints in image 2 of each pair
+        fm_list (list): feature matches of each pair
+        match_weights_list (list): match weights of each pair
+        dlen_sqrd2_list (list): diagonal length squared of chip 2 of each pair.
+            Entries may be None, in which case they are computed as in
+            spatially_verify_kpts.
+        chunksize (int): maximum number of hypothesis tests done at once
+
+    Returns:
+        list: svtup_list - the svtup (or None) of each pair
+
+    CommandLine:
+        python -m vtool_ibeis.spatial_verification spatially_verify_kpts_batch
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.spatial_verification import *  # NOQA
+        >>> import vtool_ibeis.demodata as demodata
+        >>> kpts1 = demodata.perterbed_grid_kpts(seed=1, wh_stride=(20, 20))
+        >>> kpts2 = demodata.perterbed_grid_kpts(seed=2, wh_stride=(20, 20))
+        >>> rng = np.random.RandomState(0)
+        >>> fm_list, fs_list = [], []
+        >>> for num in [0, 3, 50, 140]:
+        >>>     fm = np.vstack([np.arange(num), rng.permutation(num)]).T
+        >>>     fm[:num // 2, 1] = fm[:num // 2, 0]
+        >>>     fm_list.append(fm.astype(np.int32))
+        >>>     fs_list.append(rng.rand(num))
+        >>> n = len(fm_list)
+        >>> svtup_list = spatially_verify_kpts_batch(
+        >>>     [kpts1] * n, [kpts2] * n, fm_list, fs_list, returnAff=True)
+        >>> for fm, fs, svtup in zip(fm_list, fs_list, svtup_list):
+        >>>     svtup_ = spatially_verify_kpts(
+        >>>         kpts1, kpts2, fm, match_weights=fs, returnAff=True)
+        >>>     assert (svtup is None) == (svtup_ is None)
+        >>>     if svtup is not None:
+        >>>         assert np.all(svtup[0] == svtup_[0])
+        >>>         assert np.allclose(svtup[2], svtup_[2])
+        >>>         assert np.all(svtup[3] == svtup_[3])
+        >>> print([None if t is None else len(t[3]) for t in svtup_list])
+        [None, None, 28, 67]
+    """
+    num_pairs = len(fm_list)
+    if dlen_sqrd2_list is None:
+        dlen_sqrd2_list = [None] * num_pairs
+    svtup_list = [None] * num_pairs
+    # Only pairs with matches are verified
+    valid_pxs = [px for px, fm in enumerate(fm_list) if len(fm) > 0]
+    if VERBOSE_SVER:
+        print('[sver] Batch verifying %d / %d pairs' % (len(valid_pxs),
+                                                      num_pairs))
+    if len(valid_pxs) == 0:
+        return svtup_list
+    # Keypoints may be given as raw arrays or as KptsGeometry
+    kpts1_list, geom1_list = zip(*[_unpack_kpts(kpts1_list[px])
+                                   for px in valid_pxs])
+    kpts2_list, geom2_list = zip(*[_unpack_kpts(kpts2_list[px])
+                                   for px in valid_pxs])
+    fm_list_ = [fm_list[px] for px in valid_pxs]
+    fs_list = [match_weights_list[px] for px in valid_pxs]
+    assert all(fs is not None for fs in fs_list), (
+        'provide at least ones please for match_weights')
+    kpts1_m_list = [geom1.take(fm.T[0], axis=0)
+                    for geom1, fm in zip(geom1_list, fm_list_)]
+    kpts2_m_list = [geom2.take(fm.T[1], axis=0)
+                    for geom2, fm in zip(geom2_list, fm_list_)]
+    # Get diagonal length of each pair if not provided
+    xy_thresh_sqrds = np.array([
+        (ktool.get_kpts_dlen_sqrd(kpts2.take(fm.T[1], axis=0))
+         if dlen_sqrd2_list[px] is None else dlen_sqrd2_list[px]) * xy_thresh
+        for px, kpts2, fm in zip(valid_pxs, kpts2_list, fm_list_)],
+        dtype=np.float64)
+
+    # Stack the correspondences of all pairs
+    sizes = np.array(list(map(len, fm_list_)), dtype=np.int64)
+    offsets = np.hstack([[0], np.cumsum(sizes)])
+    pairx_list = np.repeat(np.arange(len(sizes)), sizes)
+    fs = np.hstack(fs_list).astype(np.float64)
+    Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m = _build_affine_hypotheses(
+        _stack_kpts(kpts1_m_list), _stack_kpts(kpts2_m_list))
+
+    best_hypox, inlier_flags, errors = _get_best_affine_inliers_batch(
+        pairx_list, offsets, Aff_mats, invVR1s_m, xy2_m, det2_m, ori2_m, fs,
+        xy_thresh_sqrds, scale_thresh, ori_thresh, chunksize=chunksize)
+
+    # Refinement of the best hypothesis is done on a per-pair basis
+    for count, px in enumerate(valid_pxs):
+        sl = slice(offsets[count], offsets[count + 1])
+        aff_inliers = np.where(inlier_flags[sl])[0]
+        aff_errors = tuple(err[sl] for err in errors)
+        Aff = Aff_mats[best_hypox[count]]
+        svtup_list[px] = _refine_best_affine_hypothesis(
+            kpts1_list[count], kpts2_list[count], fm_list_[count],
+            aff_inliers, aff_errors, Aff, xy_thresh_sqrds[count],
+            scale_thresh, ori_thresh, min_nInliers, returnAff,
+            full_homog_checks, refine_method, max_nInliers)
+    return svtup_list
+
+
 if __name__ == '__main__':
     """
     CommandLine:
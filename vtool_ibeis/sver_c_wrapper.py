@@ -50,7 +50,7 @@ def get_affine_inliers_cpp(kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh_sq
     """
     from vtool_ibeis_ext import sver_c_wrapper
     out_inliers, out_errors, out_mats = sver_c_wrapper.get_affine_inliers_cpp(
-        kpts2, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh)
+        kpts1, kpts2, fm, fs, xy_thresh_sqrd, scale_thresh_sqrd, ori_thresh)
     return out_inliers, out_errors, out_mats
 
 
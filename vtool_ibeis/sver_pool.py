@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+Process pool backed spatial verification of many annotation pairs.
+
+Each annotation's keypoints are written once into shared memory. Tasks only
+carry annotation keys and the fm / fs arrays of the pairs, and workers attach
+to the keypoints without copying them.
+
+cv2 and BLAS each start their own thread pools, which oversubscribes the
+machine when several processes are used (and cv2 is the usual culprit for
+multiprocessing freezes, see chip.extract_chip_from_img). Workers are
+therefore started with the spawn method and pin cv2 and BLAS to
+`threads_per_worker` threads. BLAS is only pinned if threadpoolctl is
+installed.
+"""
+import collections
+import multiprocessing
+import warnings
+from concurrent import futures
+from multiprocessing import shared_memory
+import numpy as np
+import utool as ut
+
+
+# Number of annotations whose keypoint geometry each worker keeps around
+SVER_WORKER_CACHE_SIZE = 256
+
+# Per-process state of a worker
+_WORKER_STATE = {
+    'cache': collections.OrderedDict(),
+    'limits': None,
+}
+
+
+def _init_sver_worker(threads_per_worker):
+    """ Pins the number of threads used by cv2 and BLAS in a worker """
+    import cv2
+    cv2.setNumThreads(threads_per_worker)
+    try:
+        import threadpoolctl
+    except ImportError:
+        warnings.warn('[sver_pool] threadpoolctl is not installed. The BLAS '
+                      'threads of the workers are not limited')
+    else:
+        _WORKER_STATE['limits'] = threadpoolctl.threadpool_limits(
+            limits=threads_per_worker)
+
+
+def _forget_removed(removed_names):
+    """ Detaches a worker from annotations the parent removed """
+    cache = _WORKER_STATE['cache']
+    for name in removed_names:
+        entry = cache.pop(name, None)
+        if entry is not None:
+            shm, geom = entry
+            del geom
+            shm.close()
+
+
+def _worker_cache_names():
+    """ The shared memory names a worker is attached to """
+    return list(_WORKER_STATE['cache'].keys())
+
+
+def _worker_geometry(shm_info):
+    """ Attaches to the shared keypoints of an annotation in a worker """
+    from vtool_ibeis import spatial_verification as sver
+    cache = _WORKER_STATE['cache']
+    name, shape, dtype = shm_info
+    if name in cache:
+        cache.move_to_end(name)
+        shm, geom = cache[name]
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+        kpts = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        geom = sver.KptsGeometry(kpts)
+        cache[name] = (shm, geom)
+        while len(cache) > SVER_WORKER_CACHE_SIZE:
+            _, (old_shm, old_geom) = cache.popitem(last=False)
+            del old_geom
+            old_shm.close()
+    return geom
+
+
+def _sver_worker_task(task, sver_kw, removed_names=()):
+    """ Verifies a chunk of pairs in a worker """
+    from vtool_ibeis import spatial_verification as sver
+    _forget_removed(removed_names)
+    result_list = []
+    for pairx, shm_info1, shm_info2, fm, fs, dlen_sqrd2 in task:
+        geom1 = _worker_geometry(shm_info1)
+        geom2 = _worker_geometry(shm_info2)
+        svtup = sver.spatially_verify_kpts(
+            geom1, geom2, fm, match_weights=fs, dlen_sqrd2=dlen_sqrd2,
+            **sver_kw)
+        result_list.append((pairx, svtup))
+    return result_list
+
+
+class SverPool(ut.NiceRepr):
+    """
+    Spatially verifies annotation pairs in a pool of worker processes.
+
+    Keypoints are registered once per annotation with `add_annot`. Pairs are
+    then verified with `verify`, which streams back the results as they
+    finish.
+
+    Args:
+        n_workers (int): number of worker processes (defaults to cpu count)
+        sver_kw (dict): keyword arguments for spatially_verify_kpts
+        threads_per_worker (int): number of cv2 / BLAS threads in a worker
+        chunksize (int): number of pairs sent to a worker at once
+        start_method (str): multiprocessing start method (default = spawn)
+
+    CommandLine:
+        python -m vtool_ibeis.sver_pool SverPool
+
+    Example:
+        >>> # ENABLE_DOCTEST
+        >>> from vtool_ibeis.sver_pool import *  # NOQA
+        >>> from vtool_ibeis import spatial_verification as sver
+        >>> import vtool_ibeis.demodata as demodata
+        >>> kpts_list = [demodata.perterbed_grid_kpts(seed=s, wh_stride=(20, 20))
+        >>>              for s in range(3)]
+        >>> rng = np.random.RandomState(0)
+        >>> pairs = []
+        >>> for aid1, aid2 in [(0, 1), (0, 2), (1, 2), (2, 0)]:
+        >>>     fm = np.vstack([np.arange(100), rng.permutation(100)]).T
+        >>>     fm[:50, 1] = fm[:50, 0]
+        >>>     pairs.append((aid1, aid2, fm.astype(np.int32), rng.rand(100)))
+        >>> with SverPool(n_workers=2, chunksize=1) as pool:
+        >>>     for aid, kpts in enumerate(kpts_list):
+        >>>         pool.add_annot(aid, kpts)
+        >>>     results = dict(pool.verify(pairs))
+        >>> for pairx, (aid1, aid2, fm, fs) in enumerate(pairs):
+        >>>     svtup = sver.spatially_verify_kpts(
+        >>>         kpts_list[aid1], kpts_list[aid2], fm, match_weights=fs)
+        >>>     assert np.all(results[pairx][0] == svtup[0])
+        >>> print(sorted(results.keys()))
+        [0, 1, 2, 3]
+    """
+
+    def __init__(pool, n_workers=None, sver_kw=None, threads_per_worker=1,
+                 chunksize=64, start_method='spawn'):
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        pool.n_workers = n_workers
+        pool.sver_kw = {} if sver_kw is None else sver_kw
+        pool.threads_per_worker = threads_per_worker
+        pool.chunksize = chunksize
+        pool.start_method = start_method
+        # Maps annotation keys to their shared memory and dlen_sqrd
+        pool._shm_dict = {}
+        pool._dlen_sqrd_dict = {}
+        # Shared memory names removed since the workers started. Every task
+        # carries them so workers drop their attachments.
+        pool._removed_names = []
+        pool._executor = None
+
+    def __nice__(pool):
+        return 'n_workers=%d, nAnnots=%d' % (pool.n_workers,
+                                              len(pool._shm_dict))
+
+    def __enter__(pool):
+        return pool
+
+    def __exit__(pool, ex_type, ex_value, ex_traceback):
+        pool.close()
+
+    def _ensure_executor(pool):
+        if pool._executor is None:
+            mp_context = multiprocessing.get_context(pool.start_method)
+            pool._executor = futures.ProcessPoolExecutor(
+                max_workers=pool.n_workers, mp_context=mp_context,
+                initializer=_init_sver_worker,
+                initargs=(pool.threads_per_worker,))
+        return pool._executor
+
+    def add_annot(pool, key, kpts, dlen_sqrd=None):
+        """
+        Places the keypoints of an annotation into shared memory.
+
+        Args:
+            key (hashable): identifies the annotation in `verify`
+            kpts (ndarray): keypoints of the annotation
+            dlen_sqrd (float): diagonal length squared of the chip. Used as
+                dlen_sqrd2 when this annotation is the second in a pair.
+        """
+        if key in pool._shm_dict:
+            pool.remove_annot(key)
+        kpts = np.ascontiguousarray(kpts, dtype=np.float64)
+        # Shared memory of size zero is not allowed
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=max(1, kpts.nbytes))
+        shared_kpts = np.ndarray(kpts.shape, dtype=kpts.dtype, buffer=shm.buf)
+        shared_kpts[:] = kpts
+        pool._shm_dict[key] = (shm, kpts.shape, kpts.dtype.str)
+        pool._dlen_sqrd_dict[key] = dlen_sqrd
+
+    def remove_annot(pool, key):
+        """
+        Frees the shared memory of an annotation.
+
+        Workers keep the segment mapped until a later task tells them it was
+        removed. Once more than SVER_WORKER_CACHE_SIZE annotations have been
+        removed, the next `verify` restarts the workers instead.
+
+        Example:
+            >>> # ENABLE_DOCTEST
+            >>> from vtool_ibeis.sver_pool import *  # NOQA
+            >>> import vtool_ibeis.demodata as demodata
+            >>> kpts = demodata.perterbed_grid_kpts(seed=0, wh_stride=(20, 20))
+            >>> fm = np.vstack([np.arange(100)] * 2).T.astype(np.int32)
+            >>> pairs = [(0, 1, fm, np.ones(100))]
+            >>> def get_names(pool):
+            >>>     return pool._executor.submit(_worker_cache_names).result()
+            >>> with SverPool(n_workers=1) as pool:
+            >>>     pool.add_annot(0, kpts)
+            >>>     pool.add_annot(1, kpts)
+            >>>     results = list(pool.verify(pairs))
+            >>>     old_name = pool._shm_info(0)[0]
+            >>>     assert old_name in get_names(pool)
+            >>>     pool.add_annot(0, kpts)
+            >>>     results = list(pool.verify(pairs))
+            >>>     names = get_names(pool)
+            >>> assert old_name not in names
+            >>> assert len(names) == 2
+        """
+        shm = pool._shm_dict.pop(key)[0]
+        pool._dlen_sqrd_dict.pop(key)
+        if pool._executor is not None:
+            pool._removed_names.append(shm.name)
+        shm.close()
+        shm.unlink()
+
+    def _shm_info(pool, key):
+        shm, shape, dtype = pool._shm_dict[key]
+        return (shm.name, shape, dtype)
+
+    def verify(pool, pairs):
+        """
+        Verifies pairs of annotations that were added with `add_annot`.
+
+        Only a bounded number of chunks are in flight at once, so `pairs` can
+        be a long generator.
+
+        Args:
+            pairs (iterable): of (key1, key2, fm, fs) tuples
+
+        Yields:
+            tuple: (pairx, svtup) in the order the pairs finish, where pairx
+                is the index of the pair in `pairs`.
+        """
+        if len(pool._removed_names) > SVER_WORKER_CACHE_SIZE:
+            # Restarting is cheaper than sending every removed name
+            pool._shutdown_executor()
+        executor = pool._ensure_executor()
+        removed_names = tuple(pool._removed_names)
+        max_pending = 2 * pool.n_workers
+
+        def _chunks():
+            task = []
+            for pairx, (key1, key2, fm, fs) in enumerate(pairs):
+                task.append((pairx, pool._shm_info(key1), pool._shm_info(key2),
+                             np.asarray(fm), np.asarray(fs),
+                             pool._dlen_sqrd_dict[key2]))
+                if len(task) >= pool.chunksize:
+                    yield task
+                    task = []
+            if task:
+                yield task
+
+        task_iter = _chunks()
+        pending = set()
+        for task in task_iter:
+            pending.add(executor.submit(_sver_worker_task, task, pool.sver_kw,
+                                        removed_names))
+            if len(pending) >= max_pending:
+                break
+        while pending:
+            done, pending = futures.wait(
+                pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                for result in future.result():
+                    yield result
+                # Keep the workers busy
+                for task in task_iter:
+                    pending.add(executor.submit(_sver_worker_task, task,
+                                                pool.sver_kw, removed_names))
+                    break
+
+    def _shutdown_executor(pool):
+        if pool._executor is not None:
+            pool._executor.shutdown(wait=True)
+            pool._executor = None
+        pool._removed_names = []
+
+    def close(pool):
+        """ Shuts down the workers and frees all shared memory """
+        pool._shutdown_executor()
+        for key in list(pool._shm_dict.keys()):
+            pool.remove_annot(key)
+
+
+if __name__ == '__main__':
+    """
+    CommandLine:
+        python -m vtool_ibeis.sver_pool all
+    """
+    import xdoctest
+    xdoctest.doctest_module(__file__)